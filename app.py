@@ -1,9 +1,56 @@
 import streamlit as st
-import google.generativeai as genai
-import json
-import re
-import csv
+import itertools
+import os
+import tempfile
+import time
+import threading
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import engine
+import exports
+import ingest
+from cache import ClassificationCache
+from packing import BatchPacker
+from cascade import Cascade
+from prefilter import PreClassifier
+from dedupe import group_titles
+from metrics import metrics
+from ratelimit import CircuitOpenError, is_rate_limit_error
+from results_store import ResultsStore, confidence_value
+from jobs import ACTIVE_STATUSES, JobQueue
+from taxonomy import TaxonomyRegistry
+
+# On-disk classification cache settings
+CACHE_PATH = os.environ.get("CLASSIFIER_CACHE_PATH", "classification_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.environ.get("CLASSIFIER_CACHE_MAX_ENTRIES", "100000"))
+
+# Per-session history: results kept in memory before older ones spill to disk
+HISTORY_PATH = os.environ.get("CLASSIFIER_HISTORY_PATH", "classification_history.sqlite3")
+HISTORY_WINDOW = int(os.environ.get("CLASSIFIER_HISTORY_WINDOW", "1000"))
+# Rows per page of the results table; the table itself only draws the rows in view
+RESULTS_PAGE_SIZE = 100
+RESULTS_SORT_ORDERS = {
+    "Newest first": 'newest',
+    "Oldest first": 'oldest',
+    "Most confident first": 'confidence_desc',
+    "Least confident first": 'confidence_asc',
+}
+# Shown instead of an explanation for results Gemini did not write one for
+CLASSIFIED_BY_NOTES = {
+    'prefilter': "No explanation: classified locally from the title's terms, without calling Gemini",
+    'screening': "No explanation: settled by the quick screening pass, which asks Gemini for the strategy only",
+}
+
+# Background jobs: progress file, worker threads and how often the page polls them
+JOBS_PATH = os.environ.get("CLASSIFIER_JOBS_PATH", "classification_jobs.sqlite3")
+JOB_WORKERS = int(os.environ.get("CLASSIFIER_JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = 1.0
+
+# Default client-side quota per API key (Gemini free tier for gemini-1.5-flash)
+DEFAULT_REQUESTS_PER_MINUTE = int(os.environ.get("CLASSIFIER_REQUESTS_PER_MINUTE", "15"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.environ.get("CLASSIFIER_TOKENS_PER_MINUTE", "1000000"))
 
 # Page configuration
 st.set_page_config(
@@ -23,11 +70,11 @@ st.sidebar.header("⚙️ Configuration")
 api_key = st.sidebar.text_input(
     "Enter your Google Gemini API Key:",
     type="password",
-    help="Get your free API key from https://makersuite.google.com/app/apikey"
+    help="Get your free API key from https://makersuite.google.com/app/apikey. "
+         "Separate several keys with commas to spread the work over all of them."
 )
 
 if api_key:
-    genai.configure(api_key=api_key)
     st.sidebar.success("✅ API key configured")
 
 # Classification options
@@ -36,227 +83,340 @@ include_confidence = st.sidebar.checkbox("Include confidence score", value=True)
 include_keywords = st.sidebar.checkbox("Extract key terms", value=True)
 include_field_suggestions = st.sidebar.checkbox("Suggest related fields", value=False)
 
-def create_classification_prompt(title, include_confidence, include_keywords, include_field_suggestions):
-    """Create the classification prompt for Gemini based on single title"""
-    
-    optional_fields = []
-    if include_confidence:
-        optional_fields.append('"confidence_score": "number between 1-10"')
-    if include_keywords:
-        optional_fields.append('"keywords": ["array", "of", "key", "technical", "terms", "from", "title"]')
-    if include_field_suggestions:
-        optional_fields.append('"related_fields": ["array", "of", "related", "research", "areas"]')
-    
-    optional_fields_str = ",\n    ".join(optional_fields)
-    if optional_fields_str:
-        optional_fields_str = ",\n    " + optional_fields_str
-    
-    prompt = f"""
-You are an expert research paper classifier. Based ONLY on the research paper title provided, classify the research using the predefined primary strategies below.
-
-PRIMARY STRATEGIES (choose the most appropriate one):
-
-1. Advancing Data Science and Computing for Biology - Develop AI/ML methods and improve data management systems to predict biological functions and enable multimodal data analysis across scales, while ensuring ethical AI standards and data security.
-2. Growing Next-Generation Omics and Gene-Editing Tools - Develop and apply advanced molecular profiling technologies including next-generation sequencing platforms, high-throughput metabolomics pipelines, and precision gene-editing systems. Focus on creating new analytical methods, laboratory techniques, computational frameworks, and bioinformatics workflows for processing multi-omics data to characterize biological systems at unprecedented resolution and scale. This category emphasizes technology development and methodological advancement rather than applying existing genomic techniques to study specific organisms, ecosystems, or ecological questions. It includes creating new tools, workflows, and analytical capabilities, not genome sequencing projects, taxonomic studies, or microbial characterization using standard methods.
-3. Developing Hardware to Support and Understand Biology - Create advanced bioreactors, growth chambers, sensors, and imaging systems to measure biological phenomena at relevant scales, including quantum sensing and transportable field systems.
-4. Accelerating Experimentation by Integrating Technologies - Build integrated, automated laboratory systems moving toward self-driving labs that seamlessly combine data collection, robotics, and AI to accelerate biological discovery.
-5. Developing New, Sustainable, Effective Bioproducts - Identify and engineer biological pathways to create renewable alternatives to petroleum-based materials, including polymers, chemicals, fuels, and coatings with improved properties.
-6. Enabling Optimized Bioconversion of Diverse Feedstocks - Design and engineer microbial systems, enzyme pathways, and bioprocessing technologies to convert renewable and waste materials into target products. Emphasize optimization of conversion efficiency, pathway engineering, and bioprocess scale-up for transforming lignocellulosic biomass, organic waste streams, and non-food feedstocks into fuels, chemicals, and materials.
-7. Discovering Fundamentals in Photosynthesis and Beyond - Understand and improve natural photosynthetic processes and develop artificial photosynthesis systems to directly convert sunlight into fuels and chemicals.
-8. Uncovering Molecular Foundations for Predictive Ecology - Investigate fundamental molecular mechanisms that drive ecological processes and community dynamics in natural environments using molecular techniques to understand biological interactions. Focus on applying genomic, transcriptomic, and other molecular approaches to study species interactions, ecosystem function, environmental responses, and ecological relationships through controlled experimentation and molecular characterization of ecological phenomena. This category includes genome sequencing of environmental organisms, microbial ecology studies, taxonomic characterization, strain isolation, and molecular analysis of ecological communities rather than developing new analytical technologies or computational methods.
-9. Building Models to Bridge the Gap Between Lab and Natural Systems - Construct mathematical, computational, and theoretical frameworks that translate mechanistic understanding from controlled laboratory conditions to complex natural environments. Develop multi-scale modeling approaches, parameter estimation methods, and validation strategies that account for environmental variability and system complexity.
-10. Accelerating Environmental Solutions with Biology - Apply biological approaches to address environmental challenges like carbon sequestration, ecosystem resilience, and nutrient cycling from bench to field scale.
-11. Understanding Biological Processes Vital to Health - Study fundamental human biology to establish health baselines, identify disease biomarkers, and understand genetic variations that affect disease susceptibility and treatment response.
-12. Addressing Environmental Impacts on People - Investigate how environmental factors like air pollution, radiation, heat, and chemical exposures affect human health and the human microbiome.
-13. Developing Diagnostics, Treatments, and Mitigations for Biopreparedness - Engineer biosensing platforms, therapeutic delivery systems, and countermeasure technologies for detecting and responding to biological threats. Could also be to secure a more stable supply chain for crucial biological products like crops and drugs. Focus on developing portable diagnostic devices, novel antimicrobial strategies, and preventive biotechnologies that can be rapidly deployed for public health protection and biosecurity applications. 
-
-Please return your response as a valid JSON object with the following structure:
-
-{{
-    "primary_strategy": "string (must be exactly one of the 13 strategies listed above)",
-    "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
-}}
-
-Research Paper Title: "{title}"
-
-Analyze the title carefully and select the most appropriate primary strategy from the 13 options above. Provide only the JSON response, no additional text.
-"""
-    
-    return prompt
+# Performance options
+st.sidebar.header("⚡ Performance")
+max_concurrency = st.sidebar.slider(
+    "Max concurrent batches",
+    min_value=1,
+    max_value=16,
+    value=4,
+    help="How many batches of titles are sent to Gemini at the same time"
+)
+output_token_budget = st.sidebar.slider(
+    "Output token budget per request",
+    min_value=1000,
+    max_value=8000,
+    value=4000,
+    step=500,
+    help="Titles are packed into each request until their expected response size reaches this budget"
+)
+compact_responses = st.sidebar.checkbox(
+    "Compact responses",
+    value=False,
+    help="Ask Gemini for just a strategy number and the extras above, without repeating the title or "
+         "explaining the choice, so several times as many titles fit in each request"
+)
+stream_results = st.sidebar.checkbox(
+    "Stream results as they arrive",
+    value=True,
+    help="Show each title's classification as soon as Gemini finishes it instead of waiting for the whole batch"
+)
+run_in_background = st.sidebar.checkbox(
+    "Run as a background job",
+    value=False,
+    help="Queue the titles as a job on the server. It keeps running when you change settings or close the tab; "
+         "reopen the page's link to follow it"
+)
+use_cache = st.sidebar.checkbox(
+    "Reuse cached classifications",
+    value=True,
+    help="Titles classified before with the same options are answered from the local cache without calling Gemini"
+)
+cache_status = st.sidebar.empty()
+merge_near_duplicates = st.sidebar.checkbox(
+    "Merge near-duplicate titles",
+    value=False,
+    help="Titles that differ only by British/American spelling (tumour/tumor, modelling/modeling), a word "
+         "written apart or together (bio plastic/bioplastic) or a/an/the are classified once and share the result. "
+         "Case, punctuation and spacing differences are always merged"
+)
+use_prefilter = st.sidebar.checkbox(
+    "Classify obvious titles locally",
+    value=False,
+    help="Titles that clearly match one strategy's description or earlier results are classified without calling Gemini"
+)
+prefilter_min_score = prefilter_min_margin = None
+if use_prefilter:
+    prefilter_min_score = st.sidebar.slider(
+        "Local match threshold",
+        min_value=0.1,
+        max_value=0.9,
+        value=0.35,
+        step=0.05,
+        help="Minimum similarity between a title and a strategy for the local answer to be accepted"
+    )
+    prefilter_min_margin = st.sidebar.slider(
+        "Required lead over the runner-up",
+        min_value=0.0,
+        max_value=0.5,
+        value=0.12,
+        step=0.01,
+        help="How much better the best strategy must match than the second best; closer calls go to Gemini"
+    )
+prefilter_status = st.sidebar.empty()
+use_cascade = st.sidebar.checkbox(
+    "Quick screening pass first",
+    value=False,
+    help="Ask Gemini for just a strategy and a confidence first; only uncertain titles get the full "
+         "classification with a description and the extras above. Titles settled by the screening pass "
+         "have no description, key terms or related fields, and are marked as screened in the results"
+)
+cascade_min_confidence = None
+if use_cascade:
+    cascade_min_confidence = st.sidebar.slider(
+        "Confidence to skip the full pass",
+        min_value=1,
+        max_value=10,
+        value=7,
+        help="Screened titles at or above this confidence keep the quick answer; lower ones are sent again in full"
+    )
+cascade_status = st.sidebar.empty()
+requests_per_minute = st.sidebar.number_input(
+    "Requests per minute",
+    min_value=1,
+    max_value=10000,
+    value=DEFAULT_REQUESTS_PER_MINUTE,
+    help="Your key's Gemini request quota. Requests are paced to stay under it, and rate-limit errors are retried"
+)
+tokens_per_minute = st.sidebar.number_input(
+    "Tokens per minute",
+    min_value=1000,
+    max_value=100000000,
+    value=DEFAULT_TOKENS_PER_MINUTE,
+    step=100000,
+    help="Your key's Gemini token quota (prompt plus response tokens)"
+)
+quota_status = st.sidebar.empty()
+
+# Diagnostics, filled in at the end of the script run
+diagnostics_panel = st.sidebar.expander("🩺 Diagnostics")
+
+@st.cache_resource
+def load_engine():
+    """Import the Gemini SDK and precompile the prompts once per server process, not on every rerun
+
+    The taxonomy version is recorded too, so results tagged with it can
+    be reclassified incrementally after the strategies are edited.
+    """
+    engine.warm_up()
+    TaxonomyRegistry(CACHE_PATH).register(engine.TAXONOMY)
+    return engine
+
+load_engine()
+
+# This session's own client rather than engine.configure(), which would switch every other
+# session and background job to this key. Cheap after the first call: clients are shared
+# per key, as is the limiter, so concurrent users of a key stay within its quota
+api_client = engine.client_for_key(api_key, int(requests_per_minute), int(tokens_per_minute)) if api_key else None
+
+@st.cache_resource
+def get_classification_cache():
+    """Open the on-disk classification cache once per server process"""
+    return ClassificationCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_batch_packer(include_confidence, include_keywords, include_field_suggestions, output_token_budget,
+                     compact=False):
+    """Share one batch packer per option set so its size estimates keep learning across reruns"""
+    return BatchPacker(
+        include_confidence, include_keywords, include_field_suggestions,
+        output_token_budget=output_token_budget, compact=compact,
+    )
 
-def create_batch_classification_prompt(titles, include_confidence, include_keywords, include_field_suggestions):
-    """Create the classification prompt for multiple titles in one request"""
-    
-    optional_fields = []
-    if include_confidence:
-        optional_fields.append('"confidence_score": "number between 1-10"')
-    if include_keywords:
-        optional_fields.append('"keywords": ["array", "of", "key", "technical", "terms", "from", "title"]')
-    if include_field_suggestions:
-        optional_fields.append('"related_fields": ["array", "of", "related", "research", "areas"]')
-    
-    optional_fields_str = ",\n        ".join(optional_fields)
-    if optional_fields_str:
-        optional_fields_str = ",\n        " + optional_fields_str
-    
-    # Create numbered list of titles for the prompt
-    titles_list = ""
-    for i, title in enumerate(titles, 1):
-        titles_list += f"{i}. \"{title}\"\n"
-    
-    prompt = f"""
-You are an expert research paper classifier. Based ONLY on the research paper titles provided, classify each research using the predefined primary strategies below.
-
-PRIMARY STRATEGIES (choose the most appropriate one for each title):
-
-1. Advancing Data Science and Computing for Biology - Develop AI/ML methods and improve data management systems to predict biological functions and enable multimodal data analysis across scales, while ensuring ethical AI standards and data security.
-2. Growing Next-Generation Omics and Gene-Editing Tools - Develop and apply advanced molecular profiling technologies including next-generation sequencing platforms, high-throughput metabolomics pipelines, and precision gene-editing systems. Focus on creating new analytical methods, laboratory techniques, computational frameworks, and bioinformatics workflows for processing multi-omics data to characterize biological systems at unprecedented resolution and scale. This category emphasizes technology development and methodological advancement rather than applying existing genomic techniques to study specific organisms, ecosystems, or ecological questions. It includes creating new tools, workflows, and analytical capabilities, not genome sequencing projects, taxonomic studies, or microbial characterization using standard methods.
-3. Developing Hardware to Support and Understand Biology - Create advanced bioreactors, growth chambers, sensors, and imaging systems to measure biological phenomena at relevant scales, including quantum sensing and transportable field systems.
-4. Accelerating Experimentation by Integrating Technologies - Build integrated, automated laboratory systems moving toward self-driving labs that seamlessly combine data collection, robotics, and AI to accelerate biological discovery.
-5. Developing New, Sustainable, Effective Bioproducts - Identify and engineer biological pathways to create renewable alternatives to petroleum-based materials, including polymers, chemicals, fuels, and coatings with improved properties.
-6. Enabling Optimized Bioconversion of Diverse Feedstocks - Design and engineer microbial systems, enzyme pathways, and bioprocessing technologies to convert renewable and waste materials into target products. Emphasize optimization of conversion efficiency, pathway engineering, and bioprocess scale-up for transforming lignocellulosic biomass, organic waste streams, and non-food feedstocks into fuels, chemicals, and materials.
-7. Discovering Fundamentals in Photosynthesis and Beyond - Understand and improve natural photosynthetic processes and develop artificial photosynthesis systems to directly convert sunlight into fuels and chemicals.
-8. Uncovering Molecular Foundations for Predictive Ecology - Investigate fundamental molecular mechanisms that drive ecological processes and community dynamics in natural environments using molecular techniques to understand biological interactions. Focus on applying genomic, transcriptomic, and other molecular approaches to study species interactions, ecosystem function, environmental responses, and ecological relationships through controlled experimentation and molecular characterization of ecological phenomena. This category includes genome sequencing of environmental organisms, microbial ecology studies, taxonomic characterization, strain isolation, and molecular analysis of ecological communities rather than developing new analytical technologies or computational methods.
-9. Building Models to Bridge the Gap Between Lab and Natural Systems - Construct mathematical, computational, and theoretical frameworks that translate mechanistic understanding from controlled laboratory conditions to complex natural environments. Develop multi-scale modeling approaches, parameter estimation methods, and validation strategies that account for environmental variability and system complexity.
-10. Accelerating Environmental Solutions with Biology - Apply biological approaches to address environmental challenges like carbon sequestration, ecosystem resilience, and nutrient cycling from bench to field scale.
-11. Understanding Biological Processes Vital to Health - Study fundamental human biology to establish health baselines, identify disease biomarkers, and understand genetic variations that affect disease susceptibility and treatment response.
-12. Addressing Environmental Impacts on People - Investigate how environmental factors like air pollution, radiation, heat, and chemical exposures affect human health and the human microbiome.
-13. Developing Diagnostics, Treatments, and Mitigations for Biopreparedness - Engineer biosensing platforms, therapeutic delivery systems, and countermeasure technologies for detecting and responding to biological threats. Could also be to secure a more stable supply chain for crucial biological products like crops and drugs. Focus on developing portable diagnostic devices, novel antimicrobial strategies, and preventive biotechnologies that can be rapidly deployed for public health protection and biosecurity applications. 
-
-Research Paper Titles to Classify:
-{titles_list}
-
-Please return your response as a valid JSON array where each object corresponds to the title with the same number, in order. Use this structure:
-
-[
-    {{
-        "title_number": 1,
-        "title": "exact title text",
-        "primary_strategy": "string (must be exactly one of the 13 strategies listed above)",
-        "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
-    }},
-    {{
-        "title_number": 2,
-        "title": "exact title text",
-        "primary_strategy": "string (must be exactly one of the 13 strategies listed above)",
-        "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
-    }}
-    // ... continue for all titles
-]
-
-Analyze each title carefully and select the most appropriate primary strategy from the 13 options above. Provide only the JSON array response, no additional text.
-"""
-    
-    return prompt
+@st.cache_resource(ttl=600)
+def get_pre_classifier(use_cache):
+    """Build the local pre-classifier, seeded with cached labels; rebuilt every 10 minutes to pick up new ones"""
+    labelled_titles = get_classification_cache().labelled_titles() if use_cache else ()
+    return PreClassifier(engine.STRATEGIES, labelled_titles)
+
+@st.cache_resource
+def get_cascade(min_confidence):
+    """Share one cascade per threshold so its per-tier counts cover every run"""
+    return Cascade(min_confidence=min_confidence)
+
+@st.cache_resource
+def get_job_queue():
+    """Start the background job workers once per server process"""
+    return JobQueue(JOBS_PATH, workers=JOB_WORKERS)
+
+def job_settings():
+    """Run settings for a background job, taken from the sidebar"""
+    return dict(
+        requests_per_minute=int(requests_per_minute),
+        tokens_per_minute=int(tokens_per_minute),
+        cache=get_classification_cache() if use_cache else None,
+        packer=get_batch_packer(
+            include_confidence, include_keywords, include_field_suggestions, output_token_budget, compact_responses
+        ),
+        pre_classifier=get_pre_classifier(use_cache) if use_prefilter else None,
+        prefilter_min_score=prefilter_min_score if use_prefilter else None,
+        prefilter_min_margin=prefilter_min_margin if use_prefilter else None,
+        cascade=get_cascade(cascade_min_confidence) if use_cascade else None,
+        stream=stream_results,
+        concurrency=max_concurrency,
+    )
+
+def follow_jobs():
+    """Keep this session's job ids in the page URL so a reopened tab picks them up again"""
+    st.experimental_set_query_params(job=list(st.session_state.jobs))
+
+def iter_uploaded_titles(uploaded_file, input_format, title_field):
+    """Titles of an uploaded file, parsed as they are read"""
+    with ingest.open_binary(uploaded_file) as f:
+        yield from ingest.iter_titles(f, input_format, title_field)
+
+def collect_titles(title_input, batch_input, uploaded_titles=()):
+    """Titles from the text inputs and an uploaded file, without exact duplicates, in order
+
+    A generator, so a large upload can go straight into a background job.
+    """
+    typed_titles = [title_input] if title_input else []
+    if batch_input:
+        typed_titles.extend(batch_input.split('\n'))
+    seen = set()
+    for title in itertools.chain(typed_titles, uploaded_titles):
+        title = title.strip()
+        if title and title not in seen:
+            seen.add(title)
+            yield title
+
+def show_api_error(e):
+    """Report a Gemini API error in the UI"""
+    st.error(f"Gemini API Error: {str(e)}")
+    if is_rate_limit_error(e) or isinstance(e, CircuitOpenError):
+        st.warning("Gemini kept rejecting requests. Lower \"Requests per minute\" in the sidebar to match your key's quota.")
+    if "API_KEY_INVALID" in str(e):
+        st.error(f"Please check your API key. Get one from: {engine.API_KEY_HELP_URL}")
 
 def classify_single_title(title, api_key):
     """Classify a single title using Google Gemini API"""
-    prompt = create_classification_prompt(
-        title, include_confidence, include_keywords, include_field_suggestions
-    )
-    
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=500,
-            )
+        return engine.request_single_classification(
+            title, include_confidence, include_keywords, include_field_suggestions, client=api_client
         )
-        return response.text
-            
     except Exception as e:
-        st.error(f"Gemini API Error: {str(e)}")
-        if "API_KEY_INVALID" in str(e):
-            st.error("Please check your API key. Get one from: https://makersuite.google.com/app/apikey")
+        show_api_error(e)
         return None
 
-def classify_multiple_titles(titles, api_key):
-    """Classify multiple titles using Google Gemini API in a single request"""
-    prompt = create_batch_classification_prompt(
-        titles, include_confidence, include_keywords, include_field_suggestions
-    )
-    
+def parse_json_response(response_text, is_batch=False):
+    """Parse the JSON response from Gemini, reporting failures in the UI"""
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=4000,  # Increased for multiple titles
-                candidate_count=1,
-            )
-        )
-        return response.text
-            
-    except Exception as e:
-        st.error(f"Gemini API Error: {str(e)}")
-        if "API_KEY_INVALID" in str(e):
-            st.error("Please check your API key. Get one from: https://makersuite.google.com/app/apikey")
+        return engine.parse_json_response(response_text, is_batch=is_batch)
+    except engine.ResponseParseError as e:
+        st.error(str(e))
+        if e.response_text is not None:
+            st.error("Raw response preview:")
+            st.code(e.response_text[:500] + "..." if len(e.response_text) > 500 else e.response_text)
         return None
 
-def fallback_individual_processing(titles, api_key):
-    """Fallback to process titles individually if batch processing fails"""
-    st.warning("Batch processing failed. Falling back to individual processing...")
-    results = []
-    
-    progress_bar = st.progress(0)
-    for i, title in enumerate(titles):
-        st.write(f"Processing {i+1}/{len(titles)}: {title[:50]}...")
-        
-        response = classify_single_title(title, api_key)
-        if response:
-            classification_result = parse_json_response(response, is_batch=False)
-            if classification_result:
-                classification_result['title'] = title
-                classification_result['timestamp'] = datetime.now().isoformat()
-                results.append(classification_result)
-        
-        progress_bar.progress((i + 1) / len(titles))
-    
-    return results
+def process_batch(titles, api_key, packer, stream=False, on_result=None, cascade=None):
+    """Classify one batch of titles, re-requesting only the titles Gemini left out
 
-def parse_json_response(response_text, is_batch=False):
-    """Parse the JSON response from Gemini with improved error handling"""
+    With a Cascade, the batch is screened first and only uncertain titles
+    get the full classification. Returns a (batch_results, failed_titles,
+    recovery_stats, elapsed_seconds) tuple.
+    """
+    started = time.perf_counter()
+    classify = cascade.classify if cascade else engine.classify_batch_with_recovery
     try:
-        # Clean the response text
-        response_text = response_text.strip()
-        
-        # Remove any markdown formatting
-        response_text = re.sub(r'```json\n?', '', response_text)
-        response_text = re.sub(r'```\n?', '', response_text)
-        response_text = re.sub(r'```', '', response_text)
-        
-        # Additional cleaning for common issues
-        response_text = response_text.replace('\n', ' ')
-        response_text = re.sub(r'\s+', ' ', response_text)
-        
-        # Try to find JSON in the response
-        if is_batch:
-            # For batch responses, look for array structure
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-        else:
-            # For single responses, look for object structure
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            
-        if json_match:
-            json_str = json_match.group()
-            # Additional cleaning of the JSON string
-            json_str = re.sub(r',\s*}', '}', json_str)  # Remove trailing commas before }
-            json_str = re.sub(r',\s*]', ']', json_str)  # Remove trailing commas before ]
-            return json.loads(json_str)
-        else:
-            return json.loads(response_text)
-            
-    except json.JSONDecodeError as e:
-        st.error(f"JSON parsing error: {str(e)}")
-        st.error("Raw response preview:")
-        st.code(response_text[:500] + "..." if len(response_text) > 500 else response_text)
-        return None
+        batch_results, failed_titles, recovery_stats = classify(
+            titles, include_confidence, include_keywords, include_field_suggestions,
+            packer=packer, stream=stream, on_result=on_result, compact=compact_responses, client=api_client,
+        )
     except Exception as e:
-        st.error(f"Error parsing AI response: {str(e)}")
-        return None
+        show_api_error(e)
+        batch_results, failed_titles, recovery_stats = [], [], None
+
+    return batch_results, failed_titles, recovery_stats, time.perf_counter() - started
+
+def classify_batches_concurrently(batches, api_key, max_concurrency, packer, stream=False, on_result=None,
+                                  cascade=None):
+    """Classify several batches in parallel and return the results in input order
+
+    on_result, if given, is called on the script thread with each result as
+    soon as a worker receives it. Returns a (results, stats) tuple where
+    stats records the wall-clock time, the time to the first result, the
+    speedup over running the same batches one after another and how many
+    extra requests were needed to recover incomplete responses.
+    """
+    ctx = get_script_run_ctx()
+    batch_outputs = [None] * len(batches)
+    progress_bar = st.progress(0.0)
+    status = st.empty()
+    arrived = queue.Queue()
+    first_result_seconds = None
+
+    started = time.perf_counter()
+
+    def drain_arrived():
+        nonlocal first_result_seconds
+        while True:
+            try:
+                result = arrived.get_nowait()
+            except queue.Empty:
+                return
+            if first_result_seconds is None:
+                first_result_seconds = time.perf_counter() - started
+            if on_result:
+                on_result(result)
+
+    # Worker threads need the script run context to be able to show errors
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_concurrency, len(batches))),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    ) as executor:
+        futures = {
+            executor.submit(process_batch, batch, api_key, packer, stream, arrived.put, cascade): batch_idx
+            for batch_idx, batch in enumerate(batches)
+        }
+        pending = set(futures)
+        completed = 0
+        while pending:
+            # Wake up regularly so streamed results show up while batches are still running
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            drain_arrived()
+            for future in done:
+                completed += 1
+                batch_idx = futures[future]
+                batch_outputs[batch_idx] = future.result()
+                status.write(
+                    f"Finished batch {batch_idx + 1} ({completed}/{len(batches)}) "
+                    f"in {batch_outputs[batch_idx][3]:.1f}s"
+                )
+                progress_bar.progress(completed / len(batches))
+    drain_arrived()
+    wall_seconds = time.perf_counter() - started
+
+    results = []
+    failed_titles = []
+    retry_requests = 0
+    for batch_results, batch_failed, recovery_stats, _ in batch_outputs:
+        results.extend(batch_results)
+        failed_titles.extend(batch_failed)
+        if recovery_stats:
+            retry_requests += recovery_stats['retry_requests']
+
+    if retry_requests:
+        st.info(f"🔁 Re-requested titles missing from incomplete responses with {retry_requests} extra request(s)")
+    if failed_titles:
+        st.warning(
+            f"Could not classify {len(failed_titles)} title(s): "
+            + "; ".join(title[:50] for title in failed_titles[:10])
+            + ("..." if len(failed_titles) > 10 else "")
+        )
+
+    sequential_seconds = sum(output[3] for output in batch_outputs)
+    stats = {
+        'batches': len(batches),
+        'max_concurrency': max_concurrency,
+        'wall_seconds': wall_seconds,
+        'sequential_seconds': sequential_seconds,
+        'speedup': sequential_seconds / wall_seconds if wall_seconds > 0 else 1.0,
+        'retry_requests': retry_requests,
+        'failed_titles': len(failed_titles),
+        'first_result_seconds': first_result_seconds,
+    }
+    return results, stats
 
 def display_results(title, classification_result):
     """Display classification results in a nice format"""
@@ -272,7 +432,9 @@ def display_results(title, classification_result):
     with col1:
         st.subheader("📋 Primary Strategy")
         strategy = classification_result.get('primary_strategy', 'Unknown')
-        description = classification_result.get('strategy_description', 'No description provided')
+        description = classification_result.get('strategy_description') or CLASSIFIED_BY_NOTES.get(
+            classification_result.get('classified_by'), 'No description provided'
+        )
         
         st.write(f"**Strategy:** {strategy}")
         st.write(f"**Explanation:** {description}")
@@ -293,9 +455,69 @@ def display_results(title, classification_result):
         related_fields = classification_result['related_fields']
         st.write(", ".join(related_fields))
 
+def result_row(result):
+    """Flatten a result into one row of the results table"""
+    row = engine.result_to_csv_row(result)
+    del row['strategy_description']
+    if 'confidence_score' in row:
+        # A number or nothing, so the column sorts numerically
+        row['confidence_score'] = confidence_value(row['confidence_score'])
+    row['classified_by'] = result.get('classified_by', 'gemini')
+    return row
+
+def show_results_table(store, key, start=0):
+    """Page through results in one table with filters; detail cards are drawn only for the rows picked
+
+    The number of elements on the page stays the same however many
+    results there are, so large runs do not slow the browser down.
+    """
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        strategy = st.selectbox("Strategy", ["All strategies"] + store.strategies(), key=f"{key}_strategy")
+        strategy = None if strategy == "All strategies" else strategy
+    with col2:
+        min_confidence = st.slider("Minimum confidence", 0, 10, 0, key=f"{key}_min_confidence") or None
+    with col3:
+        sort = RESULTS_SORT_ORDERS[st.selectbox("Sort", list(RESULTS_SORT_ORDERS), key=f"{key}_sort")]
+    total = store.count(strategy, min_confidence, start)
+    page_count = max(1, -(-total // RESULTS_PAGE_SIZE))
+    page_number = st.number_input(
+        f"Page (of {page_count}, {total:,} result(s))", min_value=1, max_value=page_count, value=1,
+        key=f"{key}_page",
+    )
+    offset = (min(page_number, page_count) - 1) * RESULTS_PAGE_SIZE
+    results = store.page(offset, RESULTS_PAGE_SIZE, strategy, min_confidence, sort, start)
+    with metrics.span('render'):
+        st.dataframe(
+            [result_row(result) for result in results],
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'title': st.column_config.TextColumn("Title", width="large"),
+                'primary_strategy': st.column_config.TextColumn("Strategy", width="medium"),
+                'confidence_score': st.column_config.NumberColumn("Confidence", format="%d/10"),
+                'keywords': "Key terms",
+                'related_fields': "Related fields",
+                'classified_by': "Classified by",
+            },
+        )
+        labels = [f"{offset + i + 1}. {result.get('title', 'Unknown Title')}" for i, result in enumerate(results)]
+        picked = st.multiselect(
+            "Show details for", labels, default=labels if len(labels) == 1 else None, max_selections=10,
+            key=f"{key}_details",
+        )
+        for label in picked:
+            result = results[labels.index(label)]
+            display_results(result.get('title', 'Unknown Title'), result)
+
 # Initialize session state for storing results
 if 'results_history' not in st.session_state:
-    st.session_state.results_history = []
+    st.session_state.results_history = ResultsStore(HISTORY_PATH, window=HISTORY_WINDOW)
+if 'jobs' not in st.session_state:
+    # Job id -> last result sequence number copied into the history
+    st.session_state.jobs = {job_id: 0 for job_id in st.experimental_get_query_params().get('job', [])}
+if 'prefilter_savings' not in st.session_state:
+    st.session_state.prefilter_savings = {'titles': 0, 'requests': 0, 'tokens': 0}
 
 # Main interface
 st.header("📝 Enter Research Paper Title")
@@ -317,175 +539,310 @@ Machine Learning Approaches for Protein Structure Prediction
 Sustainable Biofuel Production from Algae Biomass"""
 )
 
+# File upload option
+st.subheader("📂 Or upload a file")
+uploaded_file = st.file_uploader(
+    "CSV, TSV, JSONL, BibTeX or RIS export (or a text file with one title per line)",
+    type=['csv', 'tsv', 'tab', 'txt', 'jsonl', 'ndjson', 'bib', 'bibtex', 'ris'],
+)
+uploaded_titles = ()
+if uploaded_file is not None:
+    upload_format = ingest.detect_format(uploaded_file.name)
+    try:
+        with ingest.open_binary(uploaded_file) as f:
+            upload_fields = ingest.sample_fields(f, upload_format)
+    except ingest.IngestError as e:
+        upload_fields = []
+        st.error(f"Could not read {uploaded_file.name}: {e}")
+    if upload_fields:
+        upload_title_field = st.selectbox(
+            "Column or field holding the titles",
+            upload_fields,
+            index=upload_fields.index(ingest.guess_title_field(upload_fields)),
+        )
+        uploaded_titles = iter_uploaded_titles(uploaded_file, upload_format, upload_title_field)
+        if uploaded_file.size > 1024 * 1024 and not run_in_background:
+            st.caption("💡 For large files, tick \"Run as a background job\" in the sidebar")
+    elif upload_format != 'txt':
+        st.warning(f"No records found in {uploaded_file.name}")
+
 # Process button
 if st.button("🔍 Classify Title(s)", type="primary"):
     if not api_key:
         st.error("Please enter your Google Gemini API key in the sidebar")
         st.info("Get your free API key from: https://makersuite.google.com/app/apikey")
-    elif not title_input and not batch_input:
+    elif not title_input and not batch_input and not uploaded_titles:
         st.error("Please enter at least one research paper title")
+    elif run_in_background:
+        # Hand the titles to the job workers as they are parsed; the job panel below follows its progress
+        st.session_state.last_run_start = len(st.session_state.results_history)
+        try:
+            job_id = get_job_queue().submit(
+                collect_titles(title_input, batch_input, uploaded_titles), api_key,
+                {
+                    'include_confidence': include_confidence,
+                    'include_keywords': include_keywords,
+                    'include_field_suggestions': include_field_suggestions,
+                },
+                near_duplicates=merge_near_duplicates,
+                compact=compact_responses,
+                **job_settings(),
+            )
+        except ingest.IngestError as e:
+            st.error(f"Could not read {uploaded_file.name}: {e}")
+        else:
+            st.session_state.jobs[job_id] = 0
+            follow_jobs()
+            st.info(
+                f"🗂️ Queued {get_job_queue().status(job_id)['total']:,} title(s) as background job {job_id[:8]}"
+            )
     else:
-        # Determine which titles to process
-        titles_to_process = []
-        if title_input:
-            titles_to_process.append(title_input.strip())
-        if batch_input:
-            batch_titles = [title.strip() for title in batch_input.split('\n') if title.strip()]
-            titles_to_process.extend(batch_titles)
+        try:
+            titles_to_process = list(collect_titles(title_input, batch_input, uploaded_titles))
+        except ingest.IngestError as e:
+            st.error(f"Could not read {uploaded_file.name}: {e}")
+            titles_to_process = []
+        # Where this run's results start in the history, for "Latest run" downloads
+        st.session_state.last_run_start = len(st.session_state.results_history)
         
-        # Remove duplicates while preserving order
-        titles_to_process = list(dict.fromkeys(titles_to_process))
+        # Classify one representative per group of near-identical titles
+        title_groups = group_titles(titles_to_process, near_duplicates=merge_near_duplicates)
+        representatives = title_groups.representatives
+        if title_groups.duplicates:
+            st.info(
+                f"🔗 {title_groups.duplicates} title(s) differ from another title only in case, "
+                f"punctuation or a word or two and will share its classification"
+            )
+        
+        # Answer previously classified titles from the cache
+        cache_options = {
+            'include_confidence': include_confidence,
+            'include_keywords': include_keywords,
+            'include_field_suggestions': include_field_suggestions,
+        }
+        prompt_version = engine.get_prompt_version(
+            include_confidence, include_keywords, include_field_suggestions, compact=compact_responses
+        )
+        cached_results = {}
+        if use_cache:
+            cached_results = get_classification_cache().get_many(
+                representatives, cache_options, prompt_version
+            )
+            if cached_results:
+                st.info(f"♻️ {len(cached_results)} title(s) answered from the cache")
+        titles_to_send = [title for title in representatives if title not in cached_results]
         
-        results = []
+        # Answer obvious titles locally and only send the ambiguous ones to Gemini
+        prefiltered_results = []
+        if use_prefilter and titles_to_send:
+            pre_classifier = get_pre_classifier(use_cache)
+            accepted, ambiguous = pre_classifier.split(
+                titles_to_send, prefilter_min_score, prefilter_min_margin
+            )
+            if accepted:
+                accepted_titles = [titles_to_send[i] for i in accepted]
+                prefiltered_results = [
+                    pre_classifier.make_result(
+                        titles_to_send[i], prediction,
+                        include_confidence, include_keywords, include_field_suggestions,
+                    )
+                    for i, prediction in accepted.items()
+                ]
+                requests_saved, tokens_saved = engine.estimate_api_usage(
+                    accepted_titles, include_confidence, include_keywords, include_field_suggestions,
+                    packer=get_batch_packer(
+                        include_confidence, include_keywords, include_field_suggestions, output_token_budget,
+                        compact_responses,
+                    ),
+                    compact=compact_responses,
+                )
+                savings = st.session_state.prefilter_savings
+                savings['titles'] += len(accepted_titles)
+                savings['requests'] += requests_saved
+                savings['tokens'] += tokens_saved
+                st.info(
+                    f"🎯 {len(accepted_titles)} title(s) classified locally, "
+                    f"saving about {requests_saved} request(s) and {tokens_saved:,} tokens"
+                )
+            titles_to_send = [titles_to_send[i] for i in ambiguous]
+        new_results = []
+        streamed_ids = set()
         
-        if len(titles_to_process) == 1:
-            # Single title processing
+        if len(titles_to_send) == 1 and not (compact_responses or use_cascade):
+            # Single title processing; compact and cascade runs take the batch
+            # path even for one title so the result matches its prompt_version
             with st.spinner("Analyzing title with Google Gemini..."):
-                response = classify_single_title(titles_to_process[0], api_key)
+                response = classify_single_title(titles_to_send[0], api_key)
                 
                 if response:
                     classification_result = parse_json_response(response, is_batch=False)
                     if classification_result:
                         # Add timestamp and title to result
-                        classification_result['title'] = titles_to_process[0]
+                        classification_result['title'] = titles_to_send[0]
                         classification_result['timestamp'] = datetime.now().isoformat()
-                        results.append(classification_result)
-                        
-                        # Add to session history
-                        st.session_state.results_history.append(classification_result)
-        else:
-            # Multiple titles processing - send all in one request
-            with st.spinner(f"Analyzing {len(titles_to_process)} titles with Google Gemini in batch..."):
-                # Limit batch size to avoid token limits
-                max_batch_size = 10
-                if len(titles_to_process) > max_batch_size:
-                    st.warning(f"Processing {len(titles_to_process)} titles in batches of {max_batch_size}...")
-                    
-                    # Process in chunks
-                    for i in range(0, len(titles_to_process), max_batch_size):
-                        batch = titles_to_process[i:i + max_batch_size]
-                        st.write(f"Processing batch {i//max_batch_size + 1}...")
-                        
-                        response = classify_multiple_titles(batch, api_key)
-                        if response:
-                            batch_results = parse_json_response(response, is_batch=True)
-                            if batch_results and isinstance(batch_results, list):
-                                for result in batch_results:
-                                    if isinstance(result, dict):
-                                        result['timestamp'] = datetime.now().isoformat()
-                                        results.append(result)
-                                        st.session_state.results_history.append(result)
-                            else:
-                                # Fallback to individual processing for this batch
-                                fallback_results = fallback_individual_processing(batch, api_key)
-                                results.extend(fallback_results)
-                                for result in fallback_results:
-                                    st.session_state.results_history.append(result)
-                else:
-                    # Process all at once if under limit
-                    response = classify_multiple_titles(titles_to_process, api_key)
-                    
-                    if response:
-                        batch_results = parse_json_response(response, is_batch=True)
-                        if batch_results and isinstance(batch_results, list):
-                            for result in batch_results:
-                                if isinstance(result, dict):
-                                    # Ensure title is included
-                                    if 'title' not in result and 'title_number' in result:
-                                        title_idx = result['title_number'] - 1
-                                        if 0 <= title_idx < len(titles_to_process):
-                                            result['title'] = titles_to_process[title_idx]
-                                    
-                                    result['timestamp'] = datetime.now().isoformat()
-                                    results.append(result)
-                                    st.session_state.results_history.append(result)
-                        else:
-                            # Fallback to individual processing
-                            st.warning("Batch processing returned unexpected format. Using individual processing...")
-                            fallback_results = fallback_individual_processing(titles_to_process, api_key)
-                            results.extend(fallback_results)
-                            for result in fallback_results:
-                                st.session_state.results_history.append(result)
+                        classification_result['taxonomy_version'] = engine.TAXONOMY.version
+                        new_results.append(classification_result)
+        elif titles_to_send:
+            # Multiple titles processing - send batches concurrently
+            with st.spinner(f"Analyzing {len(titles_to_send)} titles with Google Gemini in batch..."):
+                # Pack titles into batches that fit the output token budget
+                packer = get_batch_packer(
+                    include_confidence, include_keywords, include_field_suggestions, output_token_budget,
+                    compact_responses,
+                )
+                batches = list(packer.pack(titles_to_send))
+                if len(batches) > 1:
+                    st.warning(
+                        f"Processing {len(titles_to_send)} titles in {len(batches)} batches "
+                        f"({max_concurrency} at a time)..."
+                    )
+
+                # One line updated in place, however many results stream in
+                live_results = st.empty()
+
+                def show_streamed_result(result):
+                    """Show the latest result as soon as it arrives and keep it in the session history"""
+                    streamed_ids.add(id(result))
+                    st.session_state.results_history.append(result)
+                    live_results.write(
+                        f"✅ {len(streamed_ids):,} received, latest: **{result.get('title', 'Unknown Title')}** → "
+                        f"{engine.clean_strategy_name(result.get('primary_strategy', 'Unknown'))}"
+                    )
+
+                batch_results, dispatch_stats = classify_batches_concurrently(
+                    batches, api_key, max_concurrency, packer,
+                    stream=stream_results,
+                    on_result=show_streamed_result if stream_results else None,
+                    cascade=get_cascade(cascade_min_confidence) if use_cascade else None,
+                )
+                new_results.extend(batch_results)
+                st.session_state.last_dispatch_stats = dispatch_stats
+
+                if len(batches) > 1:
+                    packer_stats = packer.stats()
+                    st.caption(
+                        f"⚡ {dispatch_stats['batches']} batches finished in "
+                        f"{dispatch_stats['wall_seconds']:.1f}s "
+                        f"({dispatch_stats['speedup']:.1f}x faster than one at a time); "
+                        f"{packer_stats['avg_titles_per_batch']:.1f} titles per request on average, "
+                        f"{packer_stats['truncations']} truncated response(s) so far"
+                    )
+                if dispatch_stats['first_result_seconds'] is not None:
+                    st.caption(f"⏱️ First result after {dispatch_stats['first_result_seconds']:.1f}s")
+        
+        # Screened results lack the description and optional fields, so only full ones are cached
+        full_results = [result for result in new_results if result.get('classified_by') != 'screening']
+        if use_cache and full_results:
+            get_classification_cache().put_many(full_results, cache_options, prompt_version)
+        
+        # Merge cached, local and new results back into input order, then share
+        # each representative's result with its duplicates
+        results = engine.order_results(representatives, cached_results, new_results + prefiltered_results)
+        results = title_groups.fan_out(results)
+        # Streamed results were added to the history as they arrived
+        st.session_state.results_history.extend(
+            result for result in results if id(result) not in streamed_ids
+        )
+        # One structured log line per run for log-based dashboards
+        metrics.log_snapshot('classification_run')
         
         if results:
             st.success(f"✅ Successfully classified {len(results)} title(s)!")
-            
-            # Display results
-            for result in results:
-                with st.container():
-                    title_to_display = result.get('title', 'Unknown Title')
-                    display_results(title_to_display, result)
-                    st.markdown("---")
-            
-            # Download options
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                # Clean results for JSON download - remove any numbering from primary strategies
-                clean_results = []
-                for result in results:
-                    clean_result = result.copy()
-                    # Clean the primary strategy to remove any numbering
-                    primary_strategy = clean_result.get('primary_strategy', '')
-                    clean_result['primary_strategy'] = re.sub(r'^\d+[\.\-\s]*', '', primary_strategy).strip()
-                    clean_results.append(clean_result)
-                
-                # JSON download
-                st.download_button(
-                    label="📥 Download Results (JSON)",
-                    data=json.dumps(clean_results, indent=2),
-                    file_name=f"classification_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                    mime="application/json"
-                )
-            
-            with col2:
-                # CSV download
-                csv_data = []
-                for result in results:
-                    # Clean the primary strategy to remove any numbering
-                    primary_strategy = result.get('primary_strategy', '')
-                    # Remove any leading numbers and dots/dashes (e.g., "1. Strategy Name" -> "Strategy Name")
-                    primary_strategy = re.sub(r'^\d+[\.\-\s]*', '', primary_strategy).strip()
-                    
-                    row = {
-                        'title': result.get('title', ''),
-                        'primary_strategy': primary_strategy,
-                        'strategy_description': result.get('strategy_description', ''),
-                    }
-                    if 'confidence_score' in result:
-                        row['confidence_score'] = result['confidence_score']
-                    if 'keywords' in result:
-                        row['keywords'] = ', '.join(result['keywords']) if isinstance(result['keywords'], list) else str(result['keywords'])
-                    if 'related_fields' in result:
-                        row['related_fields'] = ', '.join(result['related_fields']) if isinstance(result['related_fields'], list) else str(result['related_fields'])
-                    csv_data.append(row)
-                
-                # Convert to CSV string
-                import io
-                output = io.StringIO()
-                if csv_data:
-                    writer = csv.DictWriter(output, fieldnames=csv_data[0].keys())
-                    writer.writeheader()
-                    writer.writerows(csv_data)
-                    csv_string = output.getvalue()
-                    
-                    st.download_button(
-                        label="📊 Download Results (CSV)",
-                        data=csv_string,
-                        file_name=f"classification_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                        mime="text/csv"
-                    )
+
+# Background jobs of this session: copy new results into the history and show progress
+jobs_active = False
+if st.session_state.jobs:
+    job_queue = get_job_queue()
+    st.header("🗂️ Background Jobs")
+    for job_id, cursor in list(st.session_state.jobs.items()):
+        job = job_queue.status(job_id)
+        if job is None:
+            del st.session_state.jobs[job_id]
+            follow_jobs()
+            continue
+        while True:
+            job_results, cursor = job_queue.results(job_id, cursor)
+            if not job_results:
+                break
+            st.session_state.results_history.extend(job_results)
+        st.session_state.jobs[job_id] = cursor
+        jobs_active = jobs_active or job['status'] in ACTIVE_STATUSES
+
+        st.progress(job['progress'], text=(
+            f"Job {job_id[:8]}: {job['status']}, {job['done']:,} of {job['total']:,} title(s) classified"
+            + (f", {job['failed']:,} failed" if job['failed'] else "")
+        ))
+        job_stats = job['stats']
+        if job_stats.get('cached') or job_stats.get('local') or job_stats.get('duplicates') or job_stats.get('screened'):
+            st.caption(
+                f"{job_stats.get('duplicates', 0):,} duplicate(s) merged, {job_stats.get('cached', 0):,} "
+                f"from the cache, {job_stats.get('local', 0):,} classified locally, "
+                f"{job_stats.get('screened', 0):,} settled by screening"
+            )
+        if job['error']:
+            st.warning(f"Job {job_id[:8]}: {job['error']}")
+        col1, col2 = st.columns(2)
+        with col1:
+            if job['status'] in ACTIVE_STATUSES:
+                if st.button("⏹️ Cancel", key=f"cancel_{job_id}"):
+                    job_queue.cancel(job_id)
+                    st.rerun()
+            elif (job['status'] in ('interrupted', 'failed') or job['failed']) and api_key:
+                if st.button("▶️ Resume", key=f"resume_{job_id}"):
+                    job_queue.resume(job_id, api_key, **job_settings())
+                    st.rerun()
+        with col2:
+            if job['status'] not in ACTIVE_STATUSES and st.button("✖️ Dismiss", key=f"dismiss_{job_id}"):
+                del st.session_state.jobs[job_id]
+                follow_jobs()
+                st.rerun()
+
+# The latest run's results, read a page at a time from the history so they survive reruns
+history = st.session_state.results_history
+last_run_start = st.session_state.get('last_run_start', 0)
+if len(history) > last_run_start:
+    st.header("📊 Results")
+    show_results_table(history, "latest", start=last_run_start)
 
 # Show history if available
-if st.session_state.results_history:
-    with st.expander(f"📚 Classification History ({len(st.session_state.results_history)} titles)"):
-        for result in reversed(st.session_state.results_history[-10:]):  # Show last 10
-            title_display = result.get('title', 'Unknown Title')
-            st.write(f"**{title_display}** → {result.get('primary_strategy', 'Unknown')}")
+if history:
+    with st.expander(f"📚 Classification History ({len(history)} titles)"):
+        # Query one page at a time; older results are read back from disk
+        show_results_table(history, "history")
+        if history.spilled:
+            st.caption(f"{history.spilled:,} older result(s) are kept on disk")
         
         if st.button("🗑️ Clear History"):
-            st.session_state.results_history = []
-            st.experimental_rerun()
+            history.clear()
+            st.rerun()
+
+    # Exports are only built when asked for, streamed from the history in chunks
+    st.subheader("📥 Download Results")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        export_scope = st.radio("Results", ["Latest run", "Whole history"], horizontal=True, key="export_scope")
+    with col2:
+        export_format = st.selectbox("Format", exports.available_formats(), key="export_format")
+    with col3:
+        if st.button("Prepare download"):
+            export_start = st.session_state.get('last_run_start', 0) if export_scope == "Latest run" else 0
+            extension, mime = exports.EXPORT_FORMATS[export_format]
+            with tempfile.NamedTemporaryFile(suffix=f".{extension}", delete=False) as export_file:
+                with metrics.span('export'):
+                    exports.write_export(
+                        history.iter_results(export_start), export_format, export_file,
+                        engine.csv_fieldnames(include_confidence, include_keywords, include_field_suggestions),
+                    )
+            try:
+                with open(export_file.name, 'rb') as export_data:
+                    st.download_button(
+                        label=f"📥 Download Results ({export_format.upper()})",
+                        data=export_data,
+                        file_name=f"classification_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}",
+                        mime=mime
+                    )
+            finally:
+                os.remove(export_file.name)
 
 # Instructions
 with st.expander("📖 How to use"):
@@ -532,6 +889,76 @@ with st.expander("📖 How to use"):
 13. Developing Diagnostics, Treatments, and Mitigations for Biopreparedness
     """)
 
+# Cache hit-rate readout
+if use_cache:
+    cache_stats = get_classification_cache().stats()
+    cache_status.caption(
+        f"♻️ Cache: {cache_stats['entries']:,} entries, "
+        f"{cache_stats['hit_rate']:.0%} hit rate "
+        f"({cache_stats['hits']:,} hits / {cache_stats['misses']:,} misses)"
+    )
+
+# API traffic avoided by the local pre-classifier this session
+if use_prefilter:
+    savings = st.session_state.prefilter_savings
+    prefilter_status.caption(
+        f"🎯 Local: {savings['titles']:,} titles classified without Gemini, "
+        f"about {savings['requests']:,} requests and {savings['tokens']:,} tokens saved"
+    )
+
+if use_cascade:
+    cascade_stats = get_cascade(cascade_min_confidence).stats()
+    if cascade_stats['tiers']['screening']['titles']:
+        screening_tier, full_tier = cascade_stats['tiers']['screening'], cascade_stats['tiers']['full']
+        cascade_status.caption(
+            f"🪜 Screening: {screening_tier['titles']:,} titles in {screening_tier['requests']:,} requests, "
+            f"{cascade_stats['accepted']:,} settled ({cascade_stats['acceptance_rate']:.0%}); "
+            f"full pass: {full_tier['titles']:,} titles in {full_tier['requests']:,} requests; "
+            f"{cascade_stats['tokens']:,} tokens in all, about "
+            f"{cascade_stats['full_response_tokens_avoided']:,} response tokens avoided"
+        )
+
+# Quota usage readout for this session's key or key pool
+guard_stats = api_client.stats() if api_client is not None else None
+if guard_stats is not None:
+    pool_summary = (
+        f"{len(guard_stats['keys'])} keys ({guard_stats['drained']} drained), " if 'keys' in guard_stats else ""
+    )
+    quota_status.caption(
+        f"🚦 Quota: {pool_summary}{guard_stats['requests']:,} requests, {guard_stats['tokens']:,} tokens, "
+        f"{guard_stats['retries']:,} retries ({guard_stats['rate_limited']:,} rate limited), "
+        f"{guard_stats['throttled_seconds']:.0f}s paced, circuit {guard_stats['circuit']}"
+    )
+
+# Stage timings and counters for this server process
+with diagnostics_panel:
+    metrics_snapshot = metrics.snapshot()
+    if metrics_snapshot['spans']:
+        st.markdown("**Stage timings** (ms)")
+        st.table({
+            stage: {
+                'count': summary['count'],
+                'mean': round(summary['mean_seconds'] * 1000, 1),
+                'p95': round(summary['p95_seconds'] * 1000, 1),
+                'max': round(summary['max_seconds'] * 1000, 1),
+            }
+            for stage, summary in metrics_snapshot['spans'].items()
+        })
+    if metrics_snapshot['counters']:
+        st.markdown("**Counters**")
+        st.table({
+            name: {'value': round(value, 1) if isinstance(value, float) else value}
+            for name, value in metrics_snapshot['counters'].items()
+        })
+    if not metrics_snapshot['spans'] and not metrics_snapshot['counters']:
+        st.caption("Nothing measured yet. Classify some titles first.")
+    st.download_button(
+        label="📥 Prometheus metrics",
+        data=metrics.to_prometheus(),
+        file_name="classifier_metrics.prom",
+        mime="text/plain"
+    )
+
 # API key help
 with st.expander("🔑 Need help getting a Gemini API key?"):
     st.markdown("""
@@ -549,3 +976,8 @@ with st.expander("🔑 Need help getting a Gemini API key?"):
 # Footer
 st.markdown("---")
 st.markdown("Built with ❤️ using Streamlit and Google Gemini AI | Optimized for research paper title classification")
+
+# Poll running jobs: rerun shortly so their new results show up
+if jobs_active:
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
@@ -0,0 +1,335 @@
+"""Throughput and cost benchmark against the local fake Gemini backend
+
+Drives the classification paths over synthetic title corpora without
+spending any quota and writes the measurements as a JSON baseline:
+
+    python benchmark.py --sizes 20 200 1000 --output baseline.json
+    python benchmark.py --sizes 20 200 1000 --compare baseline.json
+
+With --compare, each result is checked against the baseline and the run
+exits non-zero if a path got slower or more expensive beyond --tolerance.
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import threading
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import engine
+from cascade import Cascade
+from fake_gemini import FakeGeminiBackend
+from packing import CHARS_PER_TOKEN, BatchPacker
+from server import ClassificationServer, ClassificationService
+
+SUBJECTS = [
+    "soil microbial communities", "CRISPR base editors", "lignocellulosic biomass", "photosystem II",
+    "engineered yeast strains", "root exudates", "single-cell transcriptomes", "algal biofuels",
+    "air pollution exposure", "antimicrobial peptides", "protein structure", "grassland carbon fluxes",
+    "self-driving laboratories", "quantum biosensors", "the human gut microbiome", "bioplastic precursors",
+]
+METHODS = [
+    "Deep learning models of", "High-throughput screening of", "Metabolic engineering of",
+    "Multi-omics profiling of", "Field-deployable sensors for", "Mechanistic modeling of",
+    "Automated experimentation on", "Rapid diagnostics for", "Long-term monitoring of",
+]
+CONTEXTS = [
+    "", " under drought stress", " across environmental gradients", " at industrial scale",
+    " in controlled growth chambers", " for pandemic preparedness", " in coastal wetlands",
+]
+
+# Metrics where a higher value is worse, and where a lower value is worse
+HIGHER_IS_WORSE = ('api_calls_per_title', 'tokens_per_title', 'latency_p95', 'peak_memory_mb')
+LOWER_IS_WORSE = ('titles_per_second', 'success_rate')
+
+
+def synthetic_titles(count, seed=0):
+    """Deterministic, distinct research-style titles"""
+    rng = random.Random(seed)
+    return [
+        f"{rng.choice(METHODS)} {rng.choice(SUBJECTS)}{rng.choice(CONTEXTS)} (study {i})"
+        for i in range(count)
+    ]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def _timed(latencies, call, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        return call(*args, **kwargs)
+    finally:
+        latencies.append(time.perf_counter() - started)
+
+
+def run_single(titles, options, settings, latencies):
+    """One request per title, as the app does for a lone title"""
+    classified = 0
+    for title in titles[:settings.max_single_titles]:
+        try:
+            _timed(latencies, engine.classify_title, title, *options)
+            classified += 1
+        except Exception:
+            pass
+    return classified, min(len(titles), settings.max_single_titles)
+
+
+def run_batch(titles, options, settings, latencies):
+    """Packed batches, one request each, without re-requesting missing titles"""
+    packer = BatchPacker(*options, output_token_budget=settings.token_budget)
+    classified = 0
+    for batch in packer.pack(titles):
+        try:
+            classified += len(_timed(latencies, engine.classify_title_batch, batch, *options, packer=packer))
+        except Exception:
+            pass
+    return classified, len(titles)
+
+
+def run_recovery(titles, options, settings, latencies, stream=False, compact=False):
+    """Packed batches whose incomplete responses are re-requested (the app's fallback path)"""
+    packer = BatchPacker(*options, output_token_budget=settings.token_budget, compact=compact)
+    classified = 0
+    for batch in packer.pack(titles):
+        try:
+            results, _, _ = _timed(
+                latencies, engine.classify_batch_with_recovery, batch, *options, packer=packer, stream=stream,
+                compact=compact,
+            )
+            classified += len(results)
+        except Exception:
+            pass
+    return classified, len(titles)
+
+
+def run_stream(titles, options, settings, latencies):
+    return run_recovery(titles, options, settings, latencies, stream=True)
+
+
+def run_compact(titles, options, settings, latencies):
+    return run_recovery(titles, options, settings, latencies, compact=True)
+
+
+def run_concurrent(titles, options, settings, latencies):
+    """Packed batches with recovery, dispatched from a thread pool like the app and CLI"""
+    packer = BatchPacker(*options, output_token_budget=settings.token_budget)
+
+    def classify(batch):
+        try:
+            results, _, _ = _timed(latencies, engine.classify_batch_with_recovery, batch, *options, packer=packer)
+            return len(results)
+        except Exception:
+            return 0
+
+    with ThreadPoolExecutor(settings.concurrency) as executor:
+        return sum(executor.map(classify, packer.pack(titles))), len(titles)
+
+
+def run_cascade(titles, options, settings, latencies):
+    """Packed batches screened first, with only uncertain titles classified in full"""
+    packer = BatchPacker(*options, output_token_budget=settings.token_budget)
+    cascade = Cascade(min_confidence=settings.cascade_min_confidence)
+    classified = 0
+    for batch in packer.pack(titles):
+        try:
+            results, _, _ = _timed(latencies, cascade.classify, batch, *options, packer=packer)
+            classified += len(results)
+        except Exception:
+            pass
+    return classified, len(titles)
+
+
+def run_server(titles, options, settings, latencies):
+    """Single-title HTTP requests from many clients at once, coalesced by the local service"""
+    service = ClassificationService(
+        max_wait=settings.server_max_wait, concurrency=settings.concurrency,
+        output_token_budget=settings.token_budget, max_pending=len(titles),
+    )
+    server = ClassificationServer(('127.0.0.1', 0), service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/classify"
+    flags = dict(zip(('include_confidence', 'include_keywords', 'include_field_suggestions'), options))
+
+    def post(title):
+        request = urllib.request.Request(
+            url, json.dumps(dict(flags, title=title)).encode('utf-8'), {'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return json.load(response)
+
+    def classify(title):
+        try:
+            _timed(latencies, post, title)
+            return 1
+        except Exception:
+            return 0
+
+    try:
+        with ThreadPoolExecutor(settings.server_clients) as executor:
+            return sum(executor.map(classify, titles)), len(titles)
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+PATHS = {
+    'single': run_single,
+    'batch': run_batch,
+    'recovery': run_recovery,
+    'stream': run_stream,
+    'concurrent': run_concurrent,
+    'compact': run_compact,
+    'cascade': run_cascade,
+    'server': run_server,
+}
+
+
+def measure(path, size, settings):
+    """Run one path over a corpus of `size` titles and return its metrics"""
+    backend = FakeGeminiBackend(
+        latency=settings.latency, latency_jitter=settings.latency / 2,
+        latency_distribution=settings.latency_distribution, per_title_latency=settings.per_title_latency,
+        rate_limit_rate=settings.rate_limit_rate, malformed_rate=settings.malformed_rate,
+        truncation_rate=settings.truncation_rate, seed=settings.seed,
+    )
+    engine.set_model_factory(backend)
+    titles = synthetic_titles(size, settings.seed)
+    options = (True, True, False)
+    latencies = []
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        classified, attempted = PATHS[path](titles, options, settings, latencies)
+    finally:
+        elapsed = time.perf_counter() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        engine.set_model_factory(None)
+
+    counters = backend.counters
+    tokens = (counters['prompt_chars'] + counters['response_chars']) / CHARS_PER_TOKEN
+    return {
+        'path': path,
+        'titles': attempted,
+        'classified': classified,
+        'success_rate': classified / attempted if attempted else 0.0,
+        'wall_seconds': round(elapsed, 4),
+        'titles_per_second': round(classified / elapsed, 2) if elapsed else 0.0,
+        'api_calls': counters['calls'],
+        'api_calls_per_title': round(counters['calls'] / attempted, 4) if attempted else 0.0,
+        'tokens_per_title': round(tokens / attempted, 1) if attempted else 0.0,
+        'latency_p50': round(percentile(latencies, 0.50) or 0.0, 4),
+        'latency_p95': round(percentile(latencies, 0.95) or 0.0, 4),
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 2),
+        'injected': {name: counters[name] for name in ('rate_limited', 'malformed', 'truncated')},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return human-readable regressions of `results` against a baseline report"""
+    previous = {(entry['path'], entry['titles']): entry for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry['path'], entry['titles']))
+        if not before:
+            continue
+        for metric in HIGHER_IS_WORSE + LOWER_IS_WORSE:
+            old, new = before.get(metric), entry.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if metric in HIGHER_IS_WORSE else change < -tolerance
+            if worse:
+                regressions.append(
+                    f"{entry['path']} x{entry['titles']}: {metric} {old} -> {new} ({change:+.0%})"
+                )
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the classifier against a simulated Gemini backend")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 200, 1000], help="Corpus sizes to run")
+    parser.add_argument('--paths', nargs='+', choices=list(PATHS), default=list(PATHS), help="Paths to run")
+    parser.add_argument('--max-single-titles', type=int, default=50,
+                        help="Cap on titles sent one by one in the single path (default: 50)")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--token-budget', type=int, default=4000)
+    parser.add_argument('--cascade-min-confidence', type=float, default=7,
+                        help="Screening confidence that skips the full pass in the cascade path (default: 7)")
+    parser.add_argument('--server-clients', type=int, default=32,
+                        help="Clients sending one title per request at once in the server path (default: 32)")
+    parser.add_argument('--server-max-wait', type=float, default=0.05,
+                        help="Seconds the server path's service waits to fill a batch (default: 0.05)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Median seconds per simulated call")
+    parser.add_argument('--latency-distribution', choices=['uniform', 'lognormal', 'constant'], default='lognormal')
+    parser.add_argument('--per-title-latency', type=float, default=0.002,
+                        help="Extra simulated seconds per title in a batch")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Probability of a random 429")
+    parser.add_argument('--malformed-rate', type=float, default=0.05, help="Probability of a damaged response")
+    parser.add_argument('--truncation-rate', type=float, default=0.02, help="Probability of a cut-off response")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help="Write the report to this JSON file")
+    parser.add_argument('--compare', help="Baseline JSON report to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="Relative change tolerated before a metric counts as a regression (default: 0.15)")
+    return parser
+
+
+def main(argv=None):
+    settings = build_parser().parse_args(argv)
+    # Salvage and recovery warnings are expected with injected faults
+    logging.basicConfig(level=logging.ERROR, format="%(levelname)s %(message)s")
+    if settings.rate_limit_rate:
+        # 429s need the retrying guard; keep its backoff short so the benchmark stays fast
+        engine.configure("benchmark", 1000000, 1000000000)
+        engine.get_api_guard().backoff_base = 0.01
+
+    results = []
+    for size in settings.sizes:
+        for path in settings.paths:
+            entry = measure(path, size, settings)
+            results.append(entry)
+            print(
+                f"{path:>10} x{entry['titles']:<6} {entry['titles_per_second']:>9.1f} titles/s  "
+                f"{entry['api_calls_per_title']:.3f} calls/title  {entry['tokens_per_title']:>7.1f} tokens/title  "
+                f"p50 {entry['latency_p50']:.3f}s  p95 {entry['latency_p95']:.3f}s  "
+                f"{entry['peak_memory_mb']:.1f} MB  {entry['success_rate']:.1%} ok"
+            )
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'settings': {name: value for name, value in vars(settings).items() if name not in ('output', 'compare')},
+        'results': results,
+    }
+    if settings.output:
+        with open(settings.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if settings.compare:
+        with open(settings.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), settings.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against", settings.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+
+
+def normalize_title(title):
+    """Normalize a title so trivial whitespace and case differences share a cache entry"""
+    return re.sub(r'\s+', ' ', title).strip().lower()
+
+
+def prompt_fingerprint(*prompt_texts):
+    """Hash the prompt templates so cached results expire when the prompt changes"""
+    digest = hashlib.sha256()
+    for prompt_text in prompt_texts:
+        digest.update(prompt_text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+class ClassificationCache:
+    """SQLite-backed cache of classification results with LRU eviction
+
+    Entries are keyed by the normalized title, the enabled optional fields
+    and a fingerprint of the prompt text, so changing any of them never
+    serves a stale result. Once the cache holds more than `max_entries`
+    rows, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS classifications (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_classifications_last_used ON classifications (last_used)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(title, options, prompt_version):
+        """Build the cache key for a title under the given options and prompt version"""
+        key_source = json.dumps(
+            [normalize_title(title), sorted(options.items()), prompt_version]
+        )
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def get_many(self, titles, options, prompt_version):
+        """Look up several titles at once and return a {title: result} dict of the hits"""
+        keys = {self.make_key(title, options, prompt_version): title for title in titles}
+        hits = {}
+        now = time.time()
+
+        with metrics.span('cache_lookup'), self._lock:
+            key_list = list(keys)
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, result FROM classifications WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, result in rows:
+                    hits[keys[key]] = json.loads(result)
+
+            if hits:
+                hit_keys = [key for key, title in keys.items() if title in hits]
+                self._conn.executemany(
+                    "UPDATE classifications SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in hit_keys],
+                )
+            self._bump_stat('hits', len(hits))
+            self._bump_stat('misses', len(keys) - len(hits))
+            self._conn.commit()
+
+        metrics.increment('cache_hits', len(hits))
+        metrics.increment('cache_misses', len(keys) - len(hits))
+        return hits
+
+    def put_many(self, results, options, prompt_version):
+        """Store classification results, evicting the least recently used entries if needed"""
+        now = time.time()
+        rows = []
+        for result in results:
+            title = result.get('title')
+            if not title:
+                continue
+            stored = {k: v for k, v in result.items() if k != 'timestamp'}
+            rows.append((
+                self.make_key(title, options, prompt_version),
+                title,
+                json.dumps(stored),
+                now,
+                now,
+            ))
+        if not rows:
+            return
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO classifications (key, title, result, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def labelled_titles(self, limit=20000):
+        """Return (title, primary_strategy) pairs from the most recently used entries
+
+        Entries from every option set and prompt version are included; only
+        the label matters here.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT title, result FROM classifications ORDER BY last_used DESC LIMIT ?", (limit,)
+            ).fetchall()
+        labels = []
+        for title, result in rows:
+            strategy = json.loads(result).get('primary_strategy')
+            if strategy:
+                labels.append((title, strategy))
+        return labels
+
+    def _evict(self):
+        """Drop the least recently used rows beyond max_entries (caller holds the lock)"""
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM classifications").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM classifications WHERE key IN ("
+                "SELECT key FROM classifications ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+            self._bump_stat('evictions', overflow)
+
+    def _bump_stat(self, name, amount):
+        if amount:
+            self._conn.execute(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+
+    def stats(self):
+        """Return entry count, hit/miss counters and the hit rate"""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM classifications").fetchone()
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        lookups = hits + misses
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'hits': hits,
+            'misses': misses,
+            'evictions': counters.get('evictions', 0),
+            'hit_rate': hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """Remove every cached classification and reset the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM classifications")
+            self._conn.execute("DELETE FROM stats")
+            self._conn.commit()
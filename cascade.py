@@ -0,0 +1,214 @@
+import json
+import logging
+import threading
+from datetime import datetime
+
+import engine
+from metrics import metrics
+from packing import BASE_RESULT_TOKENS, MODEL_MAX_OUTPUT_TOKENS, estimate_tokens
+from stream_parser import salvage_json_array
+
+logger = logging.getLogger("classifier.cascade")
+
+# Expected screening output per title: {"title_number": n, "strategy_number": n, "confidence_score": n}
+SCREENING_RESULT_TOKENS = 20
+
+
+def _empty_tier():
+    return {'titles': 0, 'requests': 0, 'prompt_tokens': 0, 'response_tokens': 0}
+
+
+class Cascade:
+    """Cheap screening pass first, the full classification only for uncertain titles
+
+    A screening request asks for nothing but a strategy number and a
+    confidence per title, so its response is a small fraction of the full
+    one. Titles screened at `min_confidence` or above with a valid strategy
+    keep that answer. Titles below it, with a strategy that is not one of
+    the defined ones, or left out of the screening response are escalated
+    to the full prompt with descriptions and the enabled optional fields.
+
+    Per-tier titles, requests and tokens are counted so the threshold can
+    be tuned for throughput. Screening tokens are measured from the real
+    prompt and response; full-tier tokens are estimated from the prompt and
+    the results, as retries are not visible here.
+    """
+
+    def __init__(self, min_confidence=7, screening_batch_size=100):
+        self.min_confidence = min_confidence
+        self.screening_batch_size = screening_batch_size
+        self._lock = threading.Lock()
+        self._tiers = {'screening': _empty_tier(), 'full': _empty_tier()}
+        self._escalations = {'low_confidence': 0, 'invalid_strategy': 0, 'missing': 0}
+        self._accepted = 0
+        self._full_tokens_avoided = 0
+
+    def screen(self, titles, include_confidence, include_keywords, include_field_suggestions, client=None):
+        """Screen titles; returns ({title index: result} accepted, [indices to escalate])
+
+        API errors are raised. An unparseable screening response escalates
+        its titles instead.
+        """
+        accepted = {}
+        escalated = []
+        for start in range(0, len(titles), self.screening_batch_size):
+            chunk = titles[start:start + self.screening_batch_size]
+            answers = self._request_screening(chunk, client)
+            for offset, title in enumerate(chunk):
+                answer = answers.get(offset + 1)
+                reason = self._escalation_reason(answer)
+                if reason:
+                    escalated.append(start + offset)
+                    with self._lock:
+                        self._escalations[reason] += 1
+                    continue
+                strategy, confidence = answer
+                accepted[start + offset] = self._make_result(title, strategy, confidence, include_confidence)
+        with self._lock:
+            self._accepted += len(accepted)
+        metrics.increment('cascade_accepted', len(accepted))
+        metrics.increment('cascade_escalated', len(escalated))
+        return accepted, escalated
+
+    def _request_screening(self, titles, client=None):
+        """Send one screening request; returns {title_number: (strategy index or None, confidence or None)}"""
+        prompt = engine.create_screening_prompt(titles)
+        max_output_tokens = min(MODEL_MAX_OUTPUT_TOKENS, SCREENING_RESULT_TOKENS * len(titles) + 200)
+        with metrics.span('cascade_screening'):
+            response = engine.generate(prompt, max_output_tokens=max_output_tokens, client=client, candidate_count=1)
+        with self._lock:
+            tier = self._tiers['screening']
+            tier['titles'] += len(titles)
+            tier['requests'] += 1
+            tier['prompt_tokens'] += estimate_tokens(prompt)
+            tier['response_tokens'] += estimate_tokens(response)
+        try:
+            elements = engine.parse_json_response(response, is_batch=True)
+            if not isinstance(elements, list):
+                raise engine.ResponseParseError("Screening returned unexpected format", response)
+        except engine.ResponseParseError as e:
+            elements = salvage_json_array(response)
+            logger.warning("Salvaged %d screening answer(s) from an unparseable response: %s", len(elements), e)
+
+        answers = {}
+        for element in elements:
+            if not isinstance(element, dict):
+                continue
+            number = _as_number(element.get('title_number'))
+            if not isinstance(number, int) or not 1 <= number <= len(titles) or number in answers:
+                continue
+            strategy = engine.resolve_strategy(element.get('strategy_number') or element.get('primary_strategy'))
+            answers[number] = (strategy, _as_number(element.get('confidence_score')))
+        return answers
+
+    def _escalation_reason(self, answer):
+        if answer is None:
+            return 'missing'
+        strategy, confidence = answer
+        if strategy is None:
+            return 'invalid_strategy'
+        if confidence is None or confidence < self.min_confidence:
+            return 'low_confidence'
+        return None
+
+    @staticmethod
+    def _make_result(title, strategy, confidence, include_confidence):
+        """Build a result dict shaped like Gemini's for a title the screening pass settled
+
+        The screening pass asks for no explanation, so the description is
+        left empty and keywords and related_fields are absent even when
+        requested; classified_by marks where the answer came from.
+        """
+        name = engine.STRATEGIES[strategy][0]
+        result = {
+            'title': title,
+            'primary_strategy': f"{strategy + 1}. {name}",
+            'strategy_description': '',
+            'classified_by': 'screening',
+        }
+        if include_confidence:
+            result['confidence_score'] = confidence
+        result['timestamp'] = datetime.now().isoformat()
+        result['taxonomy_version'] = engine.TAXONOMY.version
+        return result
+
+    def classify(self, titles, include_confidence, include_keywords, include_field_suggestions,
+                 packer=None, stream=False, on_result=None, compact=False, client=None):
+        """Classify a batch through the cascade
+
+        A drop-in for engine.classify_batch_with_recovery with the same
+        return value. on_result receives screened results at once and full
+        results as they arrive. An API error on the screening request is
+        raised; one on the escalated titles marks them as failed so the
+        screened results are kept.
+        """
+        flags = (include_confidence, include_keywords, include_field_suggestions)
+        accepted, escalated = self.screen(titles, *flags, client=client)
+        if on_result:
+            for result in accepted.values():
+                on_result(result)
+
+        screening_requests = -(-len(titles) // self.screening_batch_size)
+        stats = {'requests': screening_requests, 'retry_requests': 0, 'bisections': 0, 'single_title_requests': 0}
+        full_results = []
+        failed_titles = []
+        escalated_titles = [titles[i] for i in escalated]
+        if escalated_titles:
+            try:
+                full_results, failed_titles, recovery_stats = engine.classify_batch_with_recovery(
+                    escalated_titles, *flags, packer=packer, stream=stream, on_result=on_result, compact=compact,
+                    client=client,
+                )
+            except Exception as e:
+                logger.warning("Full classification of %d escalated title(s) failed: %s", len(escalated_titles), e)
+                failed_titles = escalated_titles
+                recovery_stats = {'requests': 1}
+            for name, value in recovery_stats.items():
+                stats[name] = stats.get(name, 0) + value
+            self._count_full(escalated_titles, full_results, recovery_stats['requests'], flags, compact)
+
+        accepted_titles = [titles[i] for i in accepted]
+        if accepted_titles:
+            avoided = (
+                packer.estimate_batch_output(accepted_titles) if packer
+                else len(accepted_titles) * BASE_RESULT_TOKENS
+            )
+            with self._lock:
+                self._full_tokens_avoided += int(avoided)
+
+        results = engine.order_results(titles, {}, list(accepted.values()) + full_results)
+        return results, failed_titles, stats
+
+    def _count_full(self, titles, results, requests, flags, compact):
+        prompt = engine.create_batch_classification_prompt(titles, *flags, compact=compact)
+        response_tokens = sum(estimate_tokens(json.dumps(result)) for result in results)
+        with self._lock:
+            tier = self._tiers['full']
+            tier['titles'] += len(titles)
+            tier['requests'] += requests
+            tier['prompt_tokens'] += estimate_tokens(prompt)
+            tier['response_tokens'] += response_tokens
+
+    def stats(self):
+        """Per-tier titles, requests and tokens, escalation reasons and the rate of accepted titles"""
+        with self._lock:
+            tiers = {name: dict(tier) for name, tier in self._tiers.items()}
+            screened = tiers['screening']['titles']
+            return {
+                'min_confidence': self.min_confidence,
+                'tiers': tiers,
+                'accepted': self._accepted,
+                'escalated': dict(self._escalations),
+                'acceptance_rate': self._accepted / screened if screened else 0.0,
+                'tokens': sum(tier['prompt_tokens'] + tier['response_tokens'] for tier in tiers.values()),
+                'full_response_tokens_avoided': self._full_tokens_avoided,
+            }
+
+
+def _as_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else number
+
@@ -0,0 +1,432 @@
+"""Headless batch classification for large title files
+
+Titles are read lazily from a TXT, CSV/TSV, JSONL, BibTeX or RIS file,
+classified in batches and streamed to a JSONL or CSV file as each batch
+finishes. A checkpoint file records finished batches so an interrupted
+run picks up where it stopped:
+
+    python cli.py titles.csv --title-field title -o results.jsonl
+
+After the strategy descriptions are edited, --reclassify takes the
+results of an earlier run as input and sends only the titles the edit
+may have changed, copying the other results across:
+
+    python cli.py results.jsonl --reclassify -o updated.jsonl
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import engine
+import ingest
+from cache import ClassificationCache
+from packing import BatchPacker
+from prefilter import PreClassifier
+from cascade import Cascade
+from jobs import classify_batch
+from metrics import metrics
+from reclassify import Reclassifier
+from taxonomy import TaxonomyRegistry
+
+logger = logging.getLogger("classifier.cli")
+
+
+def iter_titles(path, input_format=None, title_field=None):
+    """Yield non-empty titles from a file one at a time"""
+    input_format = input_format or ingest.detect_format(path)
+    title_field = title_field or ingest.default_title_field(input_format)
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        try:
+            yield from ingest.iter_titles(f, input_format, title_field)
+        except ingest.IngestError as e:
+            raise SystemExit(f"{path}: {e}")
+
+
+def iter_stale_titles(path, reclassifier, keep, input_format=None, title_field=None, skip=lambda position: False,
+                      chunk_size=1000):
+    """Yield (position, title) of stored results that need classifying again
+
+    Results are read from a JSONL or CSV file of an earlier run a chunk at
+    a time; those still valid under the current taxonomy are passed to
+    `keep(positions, results)` instead.
+    """
+    input_format = input_format or ingest.detect_format(path)
+    title_field = title_field or 'title'
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        try:
+            records = enumerate(ingest.iter_records(f, input_format))
+            while True:
+                read = list(itertools.islice(records, chunk_size))
+                if not read:
+                    break
+                chunk = [
+                    (position, record) for position, record in read
+                    if not skip(position) and str(record.get(title_field) or '').strip()
+                ]
+                if not chunk:
+                    continue
+                results = [dict(record, title=str(record[title_field]).strip()) for _, record in chunk]
+                kept, stale = reclassifier.split(results)
+                stale_positions = {chunk[index][0] for index in stale}
+                keep([position for position, _ in chunk if position not in stale_positions], kept)
+                for index in stale:
+                    yield chunk[index][0], results[index]['title']
+        except ingest.IngestError as e:
+            raise SystemExit(f"{path}: {e}")
+
+
+class Checkpoint:
+    """Record of finished input positions, saved atomically after every batch
+
+    Batches finish roughly in input order, so the record keeps a watermark
+    below which every title is done plus the few finished positions above
+    it. Its size stays small no matter how long the input is, and it does
+    not depend on how titles were grouped into batches.
+    """
+
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.watermark = 0
+        self.done = set()
+
+    @classmethod
+    def load(cls, path, input_path):
+        checkpoint = cls(path, input_path)
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state['input_path'] != checkpoint.input_path:
+                raise SystemExit(
+                    f"Checkpoint {path} belongs to a different input file; delete it to start over"
+                )
+            checkpoint.watermark = state['watermark']
+            checkpoint.done = {
+                position for start, end in state['done'] for position in range(start, end)
+            }
+        return checkpoint
+
+    @property
+    def resuming(self):
+        return self.watermark > 0 or bool(self.done)
+
+    @property
+    def finished_count(self):
+        return self.watermark + len(self.done)
+
+    def is_done(self, position):
+        return position < self.watermark or position in self.done
+
+    def mark_done(self, positions):
+        self.done.update(positions)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+        self.save()
+
+    def _done_ranges(self):
+        """Finished positions above the watermark as [start, end) ranges"""
+        ranges = []
+        for position in sorted(self.done):
+            if ranges and ranges[-1][1] == position:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([position, position + 1])
+        return ranges
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'input_path': self.input_path,
+                'watermark': self.watermark,
+                'done': self._done_ranges(),
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+class ResultSink:
+    """Append classification results to a JSONL or CSV file, flushing after every batch"""
+
+    def __init__(self, path, output_format, fieldnames, append):
+        self.output_format = output_format
+        has_content = append and os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self._writer = None
+        if output_format == 'csv':
+            self._writer = csv.DictWriter(self._file, fieldnames=fieldnames, extrasaction='ignore')
+            if not has_content:
+                self._writer.writeheader()
+
+    def write(self, results):
+        for result in results:
+            if self._writer:
+                row = engine.result_to_csv_row(result)
+                # Kept so the file can be the input of a later --reclassify run
+                row['taxonomy_version'] = result.get('taxonomy_version', '')
+                self._writer.writerow(row)
+            else:
+                self._file.write(json.dumps(result) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run(args):
+    options = {
+        'include_confidence': args.confidence,
+        'include_keywords': args.keywords,
+        'include_field_suggestions': args.related_fields,
+    }
+    flags = tuple(options.values())
+    prompt_version = engine.get_prompt_version(*flags, compact=args.compact)
+    cache = None if args.no_cache else ClassificationCache(args.cache_path)
+    registry = TaxonomyRegistry(args.taxonomy_registry)
+    registry.register(engine.TAXONOMY)
+    logger.info("Taxonomy version %s (%d strategies)", engine.TAXONOMY.version, len(engine.TAXONOMY))
+
+    output_format = args.output_format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+    checkpoint_path = None if args.no_checkpoint else (args.checkpoint or f"{args.output}.checkpoint")
+    checkpoint = Checkpoint.load(checkpoint_path, args.input)
+    if checkpoint.resuming:
+        logger.info("Resuming from %s (%d titles already finished)",
+                    checkpoint_path, checkpoint.finished_count)
+    packer = BatchPacker(*flags, output_token_budget=args.token_budget, max_titles=args.max_batch_size,
+                         compact=args.compact)
+    pre_classifier = None
+    if args.prefilter:
+        pre_classifier = PreClassifier(
+            engine.STRATEGIES, cache.labelled_titles() if cache else (),
+            min_score=args.prefilter_min_score, min_margin=args.prefilter_min_margin,
+        )
+        logger.info("Local pre-classifier seeded with %d cached labels", pre_classifier.labelled)
+    cascade = Cascade(min_confidence=args.cascade_min_confidence) if args.cascade else None
+
+    totals = {
+        'titles': 0, 'duplicates': 0, 'cached': 0, 'local': 0, 'screened': 0, 'requests_saved': 0, 'tokens_saved': 0,
+        'failed': 0, 'failed_batches': 0, 'kept': 0,
+    }
+    started = time.perf_counter()
+    reclassifier = None
+    if args.reclassify:
+        reclassifier = Reclassifier(
+            registry,
+            pre_classifier=pre_classifier or PreClassifier(engine.STRATEGIES, cache.labelled_titles() if cache else ()),
+            assume_version=args.assume_taxonomy,
+        )
+
+        def keep(positions, results):
+            # Results the taxonomy edit cannot have changed go straight to the output
+            if positions:
+                sink.write(results)
+                checkpoint.mark_done(positions)
+                totals['kept'] += len(results)
+
+        remaining = iter_stale_titles(args.input, reclassifier, keep, args.input_format, args.title_field,
+                                      skip=checkpoint.is_done)
+    else:
+        remaining = (
+            (position, title)
+            for position, title in enumerate(iter_titles(args.input, args.input_format, args.title_field))
+            if not checkpoint.is_done(position)
+        )
+    batches = packer.pack(remaining, key=lambda item: item[1])
+
+    def finish(future):
+        batch_number, batch = pending.pop(future)
+        try:
+            results, counts, _ = future.result()
+        except Exception as e:
+            # Leave the batch out of the checkpoint so a resumed run retries it
+            logger.error("Batch %d failed: %s", batch_number + 1, e)
+            totals['failed_batches'] += 1
+            return
+        sink.write(results)
+        # Only titles that got a result are done; the rest are retried by a resumed run
+        classified = Counter(result.get('title') for result in results)
+        done_positions = []
+        for position, title in batch:
+            if classified[title] > 0:
+                classified[title] -= 1
+                done_positions.append(position)
+        checkpoint.mark_done(done_positions)
+        totals['titles'] += len(results)
+        for name in ('duplicates', 'cached', 'local', 'screened', 'requests_saved', 'tokens_saved'):
+            totals[name] += counts[name]
+        totals['failed'] += len(batch) - len(done_positions)
+        logger.info("Batch %d done: %d classified (%d duplicates, %d cached, %d local, %d screened), "
+                    "%.1f titles/s overall", batch_number + 1, len(results), counts['duplicates'], counts['cached'],
+                    counts['local'], counts['screened'], totals['titles'] / (time.perf_counter() - started))
+
+    fieldnames = engine.csv_fieldnames(*flags) + ['taxonomy_version']
+    with ResultSink(args.output, output_format, fieldnames, append=checkpoint.resuming) as sink, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        pending = {}
+        for batch_number, batch in enumerate(batches):
+            titles = [title for _, title in batch]
+            future = executor.submit(
+                classify_batch, titles, options, cache, prompt_version, packer, args.stream, pre_classifier,
+                args.near_duplicates, cascade=cascade, compact=args.compact,
+            )
+            pending[future] = (batch_number, batch)
+            # Keep only a couple of batches in flight per worker so memory stays flat
+            while len(pending) >= args.concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future)
+
+    elapsed = time.perf_counter() - started
+    packer_stats = packer.stats()
+    logger.info("Finished: %d titles in %.1fs (%d duplicates merged, %d from cache, %d failed titles, "
+                "%d failed batches)", totals['titles'], elapsed, totals['duplicates'], totals['cached'],
+                totals['failed'], totals['failed_batches'])
+    logger.info("Packing: %.1f titles per request, %d truncated responses, size correction %.2f",
+                packer_stats['avg_titles_per_batch'], packer_stats['truncations'], packer_stats['correction'])
+    if pre_classifier:
+        logger.info("Local pre-classifier: %d titles classified without Gemini, about %d requests and %d tokens saved",
+                    totals['local'], totals['requests_saved'], totals['tokens_saved'])
+    if reclassifier:
+        reclassify_stats = reclassifier.stats()
+        logger.info("Reclassify: %d results kept (%d already current), %d titles sent again: %d whose strategy "
+                    "changed, %d whose pre-score points at a changed strategy, %d from an unknown taxonomy version",
+                    totals['kept'], reclassify_stats['current'], reclassify_stats['resent'],
+                    reclassify_stats['strategy_changed'], reclassify_stats['prescore'],
+                    reclassify_stats['unknown_version'])
+    if cascade:
+        cascade_stats = cascade.stats()
+        for tier_name, tier in cascade_stats['tiers'].items():
+            logger.info("Cascade %s tier: %d titles, %d requests, %d prompt and %d response tokens",
+                        tier_name, tier['titles'], tier['requests'], tier['prompt_tokens'], tier['response_tokens'])
+        escalated = cascade_stats['escalated']
+        logger.info("Cascade: %d titles settled by screening (%.0f%%); escalated %d for low confidence, "
+                    "%d for an invalid strategy, %d missing; about %d response tokens avoided",
+                    cascade_stats['accepted'], cascade_stats['acceptance_rate'] * 100, escalated['low_confidence'],
+                    escalated['invalid_strategy'], escalated['missing'], cascade_stats['full_response_tokens_avoided'])
+    metrics.log_snapshot('run_finished')
+    if args.metrics_file:
+        with open(args.metrics_file, 'w', encoding='utf-8') as f:
+            if args.metrics_file.endswith('.json'):
+                json.dump(metrics.snapshot(), f, indent=2)
+            else:
+                f.write(metrics.to_prometheus())
+    api_guard = engine.get_key_pool() or engine.get_api_guard()
+    if api_guard is not None:
+        guard_stats = api_guard.stats()
+        logger.info("Quota: %d retries (%d rate limited), %.0fs spent waiting for quota, %d circuit trips",
+                    guard_stats['retries'], guard_stats['rate_limited'], guard_stats['throttled_seconds'],
+                    guard_stats['circuit_trips'])
+        for key_stats in guard_stats.get('keys', ()):
+            logger.info("Key %s: %d calls, %d rate limited, drained %d times",
+                        key_stats['key'], key_stats['calls'], key_stats['rate_limited'], key_stats['drains'])
+    return 1 if totals['failed_batches'] or totals['failed'] else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Classify research paper titles without the web UI")
+    parser.add_argument('input', help="TXT (one title per line), CSV/TSV, JSONL, BibTeX or RIS file of titles, "
+                                          "or with --reclassify the results of an earlier run")
+    parser.add_argument('-o', '--output', required=True, help="JSONL or CSV file to write results to")
+    parser.add_argument('--input-format', choices=sorted(set(ingest.INPUT_FORMATS.values())),
+                        help="Input format (default: guessed from the file extension)")
+    parser.add_argument('--output-format', choices=['jsonl', 'csv'],
+                        help="Output format (default: guessed from the file extension)")
+    parser.add_argument('--title-field',
+                        help="CSV column, JSONL/BibTeX field or RIS tag holding the title (default: title, "
+                             "or TI for RIS)")
+    parser.add_argument('--api-key', default=os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY'),
+                        help="Gemini API key, or several comma-separated keys written as KEY, KEY@ENDPOINT "
+                             "or KEY*WEIGHT to shard requests across them (default: $GEMINI_API_KEY or "
+                             "$GOOGLE_API_KEY)")
+    parser.add_argument('--token-budget', type=int, default=4000,
+                        help="Expected output tokens to pack into each request (default: 4000)")
+    parser.add_argument('--max-batch-size', type=int,
+                        help="Most titles per request (default: 50, or 150 with --compact)")
+    parser.add_argument('--compact', action='store_true',
+                        help="Ask for a lean response (title number, strategy number and the optional fields, "
+                             "no description) so far more titles fit in each request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Requests in flight at once (default: 4)")
+    parser.add_argument('--rpm', type=int, default=int(os.environ.get("CLASSIFIER_REQUESTS_PER_MINUTE", "15")),
+                        help="Requests per minute allowed for the key; 0 disables client-side pacing (default: 15)")
+    parser.add_argument('--tpm', type=int, default=int(os.environ.get("CLASSIFIER_TOKENS_PER_MINUTE", "1000000")),
+                        help="Tokens per minute allowed for the key (default: 1000000)")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream responses and parse results as they arrive")
+    parser.add_argument('--checkpoint', help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument('--no-checkpoint', action='store_true', help="Do not write a checkpoint file")
+    parser.add_argument('--cache-path', default=os.environ.get("CLASSIFIER_CACHE_PATH", "classification_cache.sqlite3"),
+                        help="Classification cache shared with the web app")
+    parser.add_argument('--no-cache', action='store_true', help="Always call Gemini, bypassing the cache")
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help="Also merge titles that differ only by spelling variants, split words or articles, "
+                             "not just ones that differ in case, punctuation or spacing")
+    parser.add_argument('--no-near-duplicates', dest='near_duplicates', action='store_false',
+                        help="Only merge titles that differ in case, punctuation or spacing (the default)")
+    parser.add_argument('--prefilter', action='store_true',
+                        help="Classify titles that clearly match one strategy locally, without calling Gemini")
+    parser.add_argument('--prefilter-min-score', type=float, default=0.35,
+                        help="Similarity a title needs for a local answer (default: 0.35)")
+    parser.add_argument('--prefilter-min-margin', type=float, default=0.12,
+                        help="Lead over the second-best strategy a local answer needs (default: 0.12)")
+    parser.add_argument('--cascade', action='store_true',
+                        help="Screen titles with a short strategy-and-confidence request first and send only "
+                             "uncertain ones for the full classification")
+    parser.add_argument('--cascade-min-confidence', type=float, default=7,
+                        help="Screening confidence (1-10) a title needs to skip the full classification (default: 7)")
+    parser.add_argument('--reclassify', action='store_true',
+                        help="Read the input as results of an earlier run (JSONL or CSV written by this tool) and "
+                             "classify again only titles whose strategy, or best two pre-scored strategies, "
+                             "changed since; the other results are copied to the output")
+    parser.add_argument('--assume-taxonomy', metavar='VERSION',
+                        help="With --reclassify, the taxonomy version that results without one were produced under "
+                             "(default: classify them again)")
+    parser.add_argument('--taxonomy-registry',
+                        help="SQLite file recording every taxonomy version results were produced under "
+                             "(default: the cache file)")
+    parser.add_argument('--no-confidence', dest='confidence', action='store_false',
+                        help="Do not ask for a confidence score")
+    parser.add_argument('--no-keywords', dest='keywords', action='store_false',
+                        help="Do not extract key terms")
+    parser.add_argument('--related-fields', action='store_true', help="Suggest related fields")
+    parser.add_argument('--metrics-file',
+                        help="Write stage timings and counters here at the end, as JSON if the name ends "
+                             "in .json and in Prometheus text format otherwise")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only log warnings and errors")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.taxonomy_registry = args.taxonomy_registry or args.cache_path
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    if not args.api_key:
+        build_parser().error(f"a Gemini API key is required (--api-key or $GEMINI_API_KEY); get one from {engine.API_KEY_HELP_URL}")
+    engine.configure(args.api_key, args.rpm, args.tpm)
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import difflib
+import re
+import unicodedata
+
+from metrics import metrics
+
+# How alike two differing words must be to count as spellings of one word
+# ("tumour"/"tumor", "modelling"/"modeling")
+SPELLING_VARIANT_RATIO = 0.85
+# Words a near-duplicate may add or drop
+OPTIONAL_WORDS = frozenset({'a', 'an', 'the'})
+# Distinct titles a skeleton bucket keeps to compare the rest against;
+# bounds the exact checks when many unrelated titles share a skeleton
+MAX_BUCKET_HEADS = 8
+
+_WORD = re.compile(r"[^\W_]+")
+_DIGITS = re.compile(r"\d")
+# Anything but word characters and the title separator; underscores are replaced beforehand
+_SEPARATORS = re.compile(r"[^\w\0]+")
+# The same for ASCII text, as a translation table
+_ASCII_SEPARATORS = {code: ' ' for code in range(1, 128) if not chr(code).isalnum()}
+# Spelling skeleton of canonical text: articles, vowels and spaces dropped,
+# letters that often stand in for each other merged and the letters
+# doubled in British spellings ("modelling", "programme") halved
+_SKELETON_LETTERS = str.maketrans('cqz', 'kks', 'aeiou ')
+_DOUBLED_LETTERS = [letter * 2 for letter in 'lms']
+
+
+def _canonical_words(title):
+    if not title.isascii():
+        title = unicodedata.normalize('NFKC', title)
+    return _WORD.findall(title.casefold())
+
+
+def canonical_title(title):
+    """Canonical form of a title: Unicode-normalized, case-folded, punctuation and extra whitespace removed"""
+    return ' '.join(_canonical_words(title))
+
+
+def _canonical_titles(titles):
+    """The canonical form of every title, normalized in one pass over all titles joined together"""
+    if not titles:
+        return []
+    text = '\0'.join(titles)
+    if text.count('\0') != len(titles) - 1:
+        # A title contains the separator itself
+        return [canonical_title(title) for title in titles]
+    if text.isascii():
+        text = text.lower().translate(_ASCII_SEPARATORS)
+    else:
+        text = _SEPARATORS.sub(' ', unicodedata.normalize('NFKC', text).casefold().replace('_', ' '))
+    return [' '.join(part.split()) for part in text.split('\0')]
+
+
+class _DisjointSet:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # Keep the earliest title as the root so it becomes the representative
+            if b < a:
+                a, b = b, a
+            self.parent[b] = a
+
+
+class TitleGroups:
+    """Titles grouped into sets of (near-)duplicates
+
+    `representatives` holds the first title of each group, in input order;
+    only those need classifying. fan_out() copies each representative's
+    result to every member of its group under the member's own title.
+    """
+
+    def __init__(self, titles, group_ids, canonical_titles):
+        self.titles = titles
+        self.group_ids = group_ids
+        self.representatives = []
+        self._group_of_representative = {}
+        for index, group in enumerate(group_ids):
+            if group == len(self.representatives):
+                self._group_of_representative[canonical_titles[index]] = group
+                self.representatives.append(titles[index])
+
+    @property
+    def duplicates(self):
+        """How many titles were folded into another title's group"""
+        return len(self.titles) - len(self.representatives)
+
+    def fan_out(self, results):
+        """Expand representative results to all group members, in the original title order
+
+        The representative keeps its own result object; other members get
+        a copy with their original title. Results that match no group are
+        appended unchanged at the end.
+        """
+        result_of_group = {}
+        unmatched = []
+        for result in results:
+            group = self._group_of_representative.get(canonical_title(result.get('title', '')))
+            if group is None or group in result_of_group:
+                unmatched.append(result)
+            else:
+                result_of_group[group] = result
+
+        expanded = []
+        for title, group in zip(self.titles, self.group_ids):
+            result = result_of_group.get(group)
+            if result is None:
+                continue
+            expanded.append(result if result.get('title') == title else dict(result, title=title))
+        return expanded + unmatched
+
+
+def group_titles(titles, near_duplicates=False):
+    """Group titles that are identical after canonicalization or, if asked, near-identical
+
+    Near-duplicates differ word by word, in order, only by spelling
+    variants ("tumour"/"tumor", "modelling"/"modeling", "sceptical"/
+    "skeptical"), words written apart or together ("bio plastic"/
+    "bioplastic") and the articles a, an and the, whatever the title's
+    length, and contain the same numbers, so "Part 1" and "Part 2" of a
+    series stay apart. Spelling variants are words with the same
+    consonants in order (c/k/q and s/z alike, doubled l, m and s counted
+    once) that are at least SPELLING_VARIANT_RATIO alike, so "sulphur"/
+    "sulfur" or "mice"/"mica" stay apart. Reordered titles and ones with a
+    different word ("yeast" vs "mice") are never merged.
+
+    Candidates are titles with the same spelling skeleton (articles,
+    vowels and spaces dropped), computed for all titles in one pass, so
+    finding them takes one dictionary lookup per title and is the same
+    in every process; each candidate is then checked word by word.
+    """
+    with metrics.span('dedupe'):
+        title_groups = _group_titles(titles, near_duplicates)
+    metrics.increment('duplicates_merged', title_groups.duplicates)
+    return title_groups
+
+
+def _group_titles(titles, near_duplicates):
+    titles = list(titles)
+    canonical_titles = _canonical_titles(titles)
+    canonical_ids = {}
+    canonical_of = [canonical_ids.setdefault(canonical, len(canonical_ids)) for canonical in canonical_titles]
+
+    groups = _DisjointSet(len(canonical_ids))
+    if near_duplicates and len(canonical_ids) > 1:
+        for a, b in _near_duplicate_pairs(list(canonical_ids)):
+            groups.union(a, b)
+
+    # Renumber groups by first appearance
+    group_numbers = {}
+    group_ids = [
+        group_numbers.setdefault(groups.find(canonical), len(group_numbers)) for canonical in canonical_of
+    ]
+    return TitleGroups(titles, group_ids, canonical_titles)
+
+
+def _spelling_skeletons(canonical_texts):
+    """The spelling skeleton of every canonical title, in one pass over them all"""
+    # Every word between single spaces, so articles can be dropped with plain replaces
+    text = ' {} '.format(' \n '.join(canonical_texts))
+    for article in OPTIONAL_WORDS:
+        text = text.replace(f' {article} ', ' ')
+    # Halving doubled letters after the vowels and spaces are gone works on a much shorter text
+    text = text.translate(_SKELETON_LETTERS)
+    for doubled in _DOUBLED_LETTERS:
+        text = text.replace(doubled, doubled[0])
+    return text.split('\n')
+
+
+def _near_duplicate_pairs(canonical_texts):
+    """Yield index pairs of distinct canonical titles that are near-duplicates"""
+    first_with_skeleton = {}
+    buckets = {}
+    for index, skeleton in enumerate(_spelling_skeletons(canonical_texts)):
+        first = first_with_skeleton.setdefault(skeleton, index)
+        # Titles of nothing but articles and vowels have no skeleton to match on
+        if first != index and skeleton:
+            buckets.setdefault(first, [first]).append(index)
+    for bucket in buckets.values():
+        heads = bucket[:1]
+        for other in bucket[1:]:
+            for head in heads:
+                if _is_near_duplicate(canonical_texts[head], canonical_texts[other]):
+                    yield head, other
+                    break
+            else:
+                if len(heads) < MAX_BUCKET_HEADS:
+                    heads.append(other)
+
+
+def _is_near_duplicate(a, b):
+    """Whether two distinct canonical titles are variants of one title"""
+    a_words, b_words = a.split(), b.split()
+    # Titles must contain the same numbers, so parts of a series stay apart
+    if _DIGITS.search(a) or _DIGITS.search(b):
+        if {word for word in a_words if _DIGITS.search(word)} != {word for word in b_words if _DIGITS.search(word)}:
+            return False
+    return _only_trivial_edits(a_words, b_words)
+
+
+def _is_spelling_variant(old, new):
+    return difflib.SequenceMatcher(None, old, new, autojunk=False).ratio() >= SPELLING_VARIANT_RATIO
+
+
+def _only_trivial_edits(a, b):
+    """Whether the words of `b` follow those of `a` in order, up to spellings, word splits and articles"""
+    kept_a = [word for word in a if word not in OPTIONAL_WORDS]
+    kept_b = [word for word in b if word not in OPTIONAL_WORDS]
+    # Usual case: the same words in the same places, some spelled differently
+    if len(kept_a) == len(kept_b) and all(
+        _is_spelling_variant(old, new) for old, new in zip(kept_a, kept_b) if old != new
+    ):
+        return True
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, kept_a, kept_b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+        removed, added = kept_a[i1:i2], kept_b[j1:j2]
+        # "single cell" vs "singlecell"
+        if ''.join(removed) == ''.join(added):
+            continue
+        if len(removed) != len(added):
+            return False
+        if not all(_is_spelling_variant(old, new) for old, new in zip(removed, added)):
+            return False
+    return True
@@ -0,0 +1,944 @@
+import difflib
+import functools
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from cache import normalize_title, prompt_fingerprint
+from metrics import metrics
+from packing import BASE_RESULT_TOKENS, CHARS_PER_TOKEN, COMPACT_RESULT_TOKENS, estimate_tokens
+from keypool import KeyClient, KeySpec, parse_api_keys, pool_for_keys
+from ratelimit import guard_for_key
+from stream_parser import JsonArrayStreamParser, salvage_json_array
+from taxonomy import TAXONOMY
+
+logger = logging.getLogger("classifier.engine")
+
+MODEL_NAME = 'gemini-1.5-flash'
+# The google-generativeai release whose client internals _model_for_key relies on
+PINNED_SDK_VERSION = '0.3.2'
+API_KEY_HELP_URL = "https://makersuite.google.com/app/apikey"
+
+
+class ResponseParseError(ValueError):
+    """Raised when no valid JSON can be recovered from a Gemini response"""
+
+    def __init__(self, message, response_text=None):
+        super().__init__(message)
+        self.response_text = response_text
+
+
+# Optional replacement for genai.GenerativeModel, e.g. a local fake backend
+_model_factory = None
+# Client-side quota enforcement for the configured key, if limits were given
+_api_guard = None
+# Used instead of the single key and guard when several keys or endpoints are configured
+_key_pool = None
+# The key genai is configured with and the model object reused for every call
+_configured_key = None
+_model = None
+_model_lock = threading.Lock()
+# Clients for callers that bring their own key, by key
+_clients = {}
+
+
+def _genai():
+    """Import google.generativeai on first use; it takes about half a second"""
+    import google.generativeai as genai
+    return genai
+
+
+def configure(api_key, requests_per_minute=None, tokens_per_minute=None):
+    """Point the Gemini client at the given API key, or at a pool of them
+
+    Calling it again with the same key is cheap, so it is safe to call on
+    every Streamlit rerun. With per-minute limits, every call goes through
+    the key's shared ApiGuard, which paces requests and retries transient
+    errors. Several comma-separated keys (see keypool.parse_api_keys) are
+    served by a shared KeyPool instead, with the limits applying per key.
+    """
+    global _api_guard, _key_pool, _configured_key, _model
+    specs = parse_api_keys(api_key)
+    if len(specs) > 1 or any(spec.endpoint or spec.weight != 1 for spec in specs):
+        _key_pool = pool_for_keys(specs, _model_for_key, requests_per_minute, tokens_per_minute)
+        _api_guard = None
+        return
+    _key_pool = None
+    api_key = specs[0].key if specs else api_key
+    with _model_lock:
+        if api_key != _configured_key:
+            _genai().configure(api_key=api_key)
+            _configured_key = api_key
+            # A model binds the configured key on its first call
+            _model = None
+    if requests_per_minute and tokens_per_minute:
+        _api_guard = guard_for_key(api_key, requests_per_minute, tokens_per_minute)
+    else:
+        _api_guard = None
+
+
+def set_model_factory(factory):
+    """Create models with `factory(model_name)` instead of genai.GenerativeModel; None restores it"""
+    global _model_factory, _model
+    with _model_lock:
+        _model_factory = factory
+        _model = None
+        _clients.clear()
+
+
+def use_key_pool(pool):
+    """Send every call through `pool`, e.g. a KeyPool over fake backends; None goes back to one key"""
+    global _key_pool
+    _key_pool = pool
+
+
+def get_api_guard():
+    return _api_guard
+
+
+def get_key_pool():
+    return _key_pool
+
+
+def get_model():
+    """Return the long-lived model object, creating it on first use"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = (_model_factory or _genai().GenerativeModel)(MODEL_NAME)
+        return _model
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_unpinned_sdk(version):
+    logger.warning("google-generativeai %s is installed but per-key models were written against %s; "
+                   "check that requests go out with the right key", version, PINNED_SDK_VERSION)
+
+
+def _model_for_key(spec):
+    """A model bound to one pooled key and endpoint rather than the globally configured key
+
+    google-generativeai 0.3 has no public way to give a model its own key,
+    so this builds a client through the private _ClientManager and sets
+    the model's private _client, which the model then uses instead of the
+    global default. requirements.txt pins the SDK for this reason. If an
+    upgrade moves either, this raises rather than letting the model fall
+    back to the globally configured key.
+    """
+    if _model_factory is not None:
+        return _model_factory(MODEL_NAME)
+    genai = _genai()
+    try:
+        from google.generativeai.client import _ClientManager
+    except ImportError:
+        _ClientManager = None
+    model = genai.GenerativeModel(MODEL_NAME)
+    if _ClientManager is None or not hasattr(_ClientManager, 'make_client') or not hasattr(model, '_client'):
+        raise RuntimeError(
+            f"google-generativeai {genai.__version__} cannot bind a model to its own API key; "
+            f"install the version pinned in requirements.txt ({PINNED_SDK_VERSION})"
+        )
+    if genai.__version__ != PINNED_SDK_VERSION:
+        _warn_unpinned_sdk(genai.__version__)
+    manager = _ClientManager()
+    manager.configure(
+        api_key=spec.key,
+        client_options={'api_endpoint': spec.endpoint} if spec.endpoint else None,
+    )
+    model._client = manager.make_client('generative')
+    return model
+
+
+def client_for_key(api_key, requests_per_minute=None, tokens_per_minute=None):
+    """A client for an API key, or a pool of them, that leaves the configured key alone
+
+    Background jobs and app sessions pass theirs to the classify
+    functions as `client`, so each runs on its own key and quota whatever
+    another thread configures. Clients and their guards are shared per
+    key, and the latest limits apply to everyone using the key, so they
+    are paced together.
+    """
+    specs = parse_api_keys(api_key)
+    if len(specs) > 1 or any(spec.endpoint or spec.weight != 1 for spec in specs):
+        return pool_for_keys(specs, _model_for_key, requests_per_minute, tokens_per_minute)
+    key = specs[0].key if specs else api_key
+    # Also applies these limits to the key's one guard
+    guard = (
+        guard_for_key(key, requests_per_minute, tokens_per_minute)
+        if requests_per_minute and tokens_per_minute else None
+    )
+    with _model_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = KeyClient(KeySpec(key, None, 1), _model_for_key, guard)
+        elif client.guard is None:
+            client.guard = guard
+        return client
+
+
+def warm_up():
+    """Do the one-time setup up front: import the SDK and precompile every prompt variant"""
+    if _model_factory is None:
+        _genai()
+    for flags in itertools.product((False, True), repeat=3):
+        _single_prompt_parts(*flags)
+        _batch_prompt_parts(*flags)
+        _compact_batch_prompt_parts(*flags)
+        get_prompt_version(*flags)
+
+
+def _generation_config(max_output_tokens, **generation_options):
+    # A plain dict is accepted by generate_content and needs no SDK import
+    return dict(temperature=0.1, max_output_tokens=max_output_tokens, **generation_options)
+
+
+def _guarded(call, prompt, max_output_tokens, measure=None, client=None):
+    """Run `call(model, guard)` through `client`, else the key pool or the configured ApiGuard, if any"""
+    # Reserve the worst case up front; measure() settles the real usage afterwards
+    pool = client or _key_pool
+    if pool is not None:
+        return pool.call(call, estimate_tokens(prompt) + max_output_tokens, measure=measure)
+    guard = _api_guard
+    if guard is None:
+        return call(get_model(), None)
+    return guard.call(lambda: call(get_model(), guard), estimate_tokens(prompt) + max_output_tokens, measure=measure)
+
+
+# The primary strategies offered to Gemini, as (name, description) pairs in prompt order
+STRATEGIES = TAXONOMY.strategies
+
+# The numbered strategy list exactly as it appears in the prompts
+STRATEGY_LIST_TEXT = TAXONOMY.list_text
+
+# Canonical strategy names, lowercased, for resolving what a response names
+_STRATEGY_KEYS = [name.lower() for name, _ in STRATEGIES]
+_STRATEGY_NUMBER = re.compile(r'^\s*(\d+)\s*[\.\-:)]?\s*(.*)$', re.S)
+
+# Stands in for the title(s) when a prompt template is split into its fixed parts
+_PLACEHOLDER = "\0"
+
+
+def create_classification_prompt(title, include_confidence, include_keywords, include_field_suggestions):
+    """Create the classification prompt for Gemini based on single title"""
+    head, tail = _single_prompt_parts(include_confidence, include_keywords, include_field_suggestions)
+    return head + title + tail
+
+
+def create_batch_classification_prompt(titles, include_confidence, include_keywords, include_field_suggestions,
+                                       compact=False):
+    """Create the classification prompt for multiple titles in one request
+
+    With compact=True the response schema is lean: a title number, a
+    strategy number and only the optional fields asked for.
+    """
+    parts = _compact_batch_prompt_parts if compact else _batch_prompt_parts
+    head, tail = parts(include_confidence, include_keywords, include_field_suggestions)
+    # Create numbered list of titles for the prompt
+    titles_list = "".join(f"{i}. \"{title}\"\n" for i, title in enumerate(titles, 1))
+    return head + titles_list + tail
+
+
+@functools.lru_cache(maxsize=None)
+def _single_prompt_parts(include_confidence, include_keywords, include_field_suggestions):
+    """The single-title prompt before and after the title, built once per option set"""
+    return tuple(_render_single_prompt(
+        _PLACEHOLDER, include_confidence, include_keywords, include_field_suggestions
+    ).split(_PLACEHOLDER))
+
+
+@functools.lru_cache(maxsize=None)
+def _batch_prompt_parts(include_confidence, include_keywords, include_field_suggestions):
+    """The batch prompt before and after the title list, built once per option set"""
+    return tuple(_render_batch_prompt(
+        _PLACEHOLDER, include_confidence, include_keywords, include_field_suggestions
+    ).split(_PLACEHOLDER))
+
+
+@functools.lru_cache(maxsize=None)
+def _compact_batch_prompt_parts(include_confidence, include_keywords, include_field_suggestions):
+    """The compact batch prompt before and after the title list, built once per option set"""
+    return tuple(_render_compact_batch_prompt(
+        _PLACEHOLDER, include_confidence, include_keywords, include_field_suggestions
+    ).split(_PLACEHOLDER))
+
+
+def _render_single_prompt(title, include_confidence, include_keywords, include_field_suggestions):
+    
+    optional_fields = []
+    if include_confidence:
+        optional_fields.append('"confidence_score": "number between 1-10"')
+    if include_keywords:
+        optional_fields.append('"keywords": ["array", "of", "key", "technical", "terms", "from", "title"]')
+    if include_field_suggestions:
+        optional_fields.append('"related_fields": ["array", "of", "related", "research", "areas"]')
+    
+    optional_fields_str = ",\n    ".join(optional_fields)
+    if optional_fields_str:
+        optional_fields_str = ",\n    " + optional_fields_str
+    
+    prompt = f"""
+You are an expert research paper classifier. Based ONLY on the research paper title provided, classify the research using the predefined primary strategies below.
+
+PRIMARY STRATEGIES (choose the most appropriate one):
+
+{STRATEGY_LIST_TEXT}
+
+Please return your response as a valid JSON object with the following structure:
+
+{{
+    "primary_strategy": "string (must be exactly one of the {len(STRATEGIES)} strategies listed above)",
+    "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
+}}
+
+Research Paper Title: "{title}"
+
+Analyze the title carefully and select the most appropriate primary strategy from the {len(STRATEGIES)} options above. Provide only the JSON response, no additional text.
+"""
+    
+    return prompt
+
+
+def _render_batch_prompt(titles_list, include_confidence, include_keywords, include_field_suggestions):
+    
+    optional_fields = []
+    if include_confidence:
+        optional_fields.append('"confidence_score": "number between 1-10"')
+    if include_keywords:
+        optional_fields.append('"keywords": ["array", "of", "key", "technical", "terms", "from", "title"]')
+    if include_field_suggestions:
+        optional_fields.append('"related_fields": ["array", "of", "related", "research", "areas"]')
+    
+    optional_fields_str = ",\n        ".join(optional_fields)
+    if optional_fields_str:
+        optional_fields_str = ",\n        " + optional_fields_str
+    
+    prompt = f"""
+You are an expert research paper classifier. Based ONLY on the research paper titles provided, classify each research using the predefined primary strategies below.
+
+PRIMARY STRATEGIES (choose the most appropriate one for each title):
+
+{STRATEGY_LIST_TEXT}
+
+Research Paper Titles to Classify:
+{titles_list}
+
+Please return your response as a valid JSON array where each object corresponds to the title with the same number, in order. Use this structure:
+
+[
+    {{
+        "title_number": 1,
+        "title": "exact title text",
+        "primary_strategy": "string (must be exactly one of the {len(STRATEGIES)} strategies listed above)",
+        "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
+    }},
+    {{
+        "title_number": 2,
+        "title": "exact title text",
+        "primary_strategy": "string (must be exactly one of the {len(STRATEGIES)} strategies listed above)",
+        "strategy_description": "string (2-3 sentence description explaining why this strategy was chosen for this title)"{optional_fields_str}
+    }}
+    // ... continue for all titles
+]
+
+Analyze each title carefully and select the most appropriate primary strategy from the {len(STRATEGIES)} options above. Provide only the JSON array response, no additional text.
+"""
+    
+    return prompt
+
+
+def create_screening_prompt(titles):
+    """Create the low-token screening prompt: only a strategy number and a confidence per title"""
+    head, tail = _screening_prompt_parts()
+    titles_list = "".join(f"{i}. \"{title}\"\n" for i, title in enumerate(titles, 1))
+    return head + titles_list + tail
+
+
+@functools.lru_cache(maxsize=None)
+def _screening_prompt_parts():
+    """The screening prompt before and after the title list, built once"""
+    return tuple(f"""
+You are an expert research paper classifier. Based ONLY on the research paper titles provided, pick the most appropriate primary strategy for each title from the numbered list below.
+
+PRIMARY STRATEGIES:
+
+{STRATEGY_LIST_TEXT}
+
+Research Paper Titles to Classify:
+{_PLACEHOLDER}
+Return a JSON array with one compact object per title, in order, and nothing else:
+
+[{{"title_number": 1, "strategy_number": 4, "confidence_score": 8}}, ...]
+
+strategy_number must be a number from 1 to {len(STRATEGIES)}. confidence_score is a number between 1-10; use a low score when the title is vague or fits several strategies.
+""".split(_PLACEHOLDER))
+
+
+def _render_compact_batch_prompt(titles_list, include_confidence, include_keywords, include_field_suggestions):
+    optional_fields = []
+    if include_confidence:
+        optional_fields.append('"confidence_score": number between 1-10')
+    if include_keywords:
+        optional_fields.append('"keywords": ["key", "technical", "terms", "from", "title"]')
+    if include_field_suggestions:
+        optional_fields.append('"related_fields": ["related", "research", "areas"]')
+    optional_fields_str = "".join(f", {field}" for field in optional_fields)
+
+    return f"""
+You are an expert research paper classifier. Based ONLY on the research paper titles provided, classify each research using the predefined primary strategies below.
+
+PRIMARY STRATEGIES (choose the most appropriate one for each title):
+
+{STRATEGY_LIST_TEXT}
+
+Research Paper Titles to Classify:
+{titles_list}
+
+Return a valid JSON array with one compact object per title, in order. Do not repeat the title or the strategy name; give the strategy's number from the list above:
+
+[
+    {{"title_number": 1, "strategy_number": number between 1-{len(STRATEGIES)}{optional_fields_str}}},
+    // ... one object for each title
+]
+
+Analyze each title carefully and select the most appropriate primary strategy from the {len(STRATEGIES)} options above. Provide only the JSON array response, no additional text.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def get_prompt_version(include_confidence, include_keywords, include_field_suggestions, compact=False):
+    """Fingerprint both prompt templates so cached results expire when a prompt is edited
+
+    Compact results lack descriptions, so they get a version of their own.
+    """
+    return prompt_fingerprint(
+        create_classification_prompt(
+            "{title}", include_confidence, include_keywords, include_field_suggestions
+        ),
+        create_batch_classification_prompt(
+            ["{title}"], include_confidence, include_keywords, include_field_suggestions, compact=compact
+        ),
+    )
+
+
+def resolve_strategy(value):
+    """The 0-based index of the strategy a response names, or None if it names none
+
+    Accepts a strategy number (as a number or a string), a name with or
+    without its numbering, or a misspelled or truncated name, which is
+    fuzzy-matched to the nearest canonical name. A name takes precedence
+    over a number that disagrees with it.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int):
+        return value - 1 if 1 <= value <= len(STRATEGIES) else None
+    if isinstance(value, str):
+        return _resolve_strategy_text(value)
+    return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve_strategy_text(text):
+    # There are only a handful of distinct values, so each is resolved once
+    number = None
+    match = _STRATEGY_NUMBER.match(text)
+    if match:
+        number, text = int(match.group(1)), match.group(2)
+    name = text.strip().strip('"\'.').lower()
+    if name:
+        if name in _STRATEGY_KEYS:
+            return _STRATEGY_KEYS.index(name)
+        close = difflib.get_close_matches(name, _STRATEGY_KEYS, n=1, cutoff=0.6)
+        if close:
+            return _STRATEGY_KEYS.index(close[0])
+    if number is not None and 1 <= number <= len(STRATEGIES):
+        return number - 1
+    return None
+
+
+def canonical_strategy(value):
+    """The numbered canonical name, e.g. "1. Strategy Name", of the strategy a response names, or None"""
+    index = resolve_strategy(value)
+    return None if index is None else f"{index + 1}. {STRATEGIES[index][0]}"
+
+
+def clean_strategy_name(primary_strategy):
+    """The canonical name of the strategy a response names, e.g. "1. Strategy Nme" becomes "Strategy Name"
+
+    Values that match no strategy only lose any leading numbering; ones
+    that are neither text nor a strategy number become empty.
+    """
+    if not isinstance(primary_strategy, str):
+        index = resolve_strategy(primary_strategy)
+        return '' if index is None else STRATEGIES[index][0]
+    return _clean_strategy_text(primary_strategy)
+
+
+@functools.lru_cache(maxsize=1024)
+def _clean_strategy_text(text):
+    # There are only a handful of distinct names, so each is cleaned once
+    index = _resolve_strategy_text(text)
+    if index is not None:
+        return STRATEGIES[index][0]
+    return re.sub(r'^\d+[\.\-\s]*', '', text).strip()
+
+
+def _usable_strategy(value):
+    """A response's primary_strategy as non-empty text, or None if it is unusable
+
+    A bare strategy number becomes the numbered name; a list, object or
+    other value that is not text is rejected so it never reaches exports.
+    """
+    if isinstance(value, str):
+        return value if value.strip() else None
+    return canonical_strategy(value)
+
+
+def _count_request(prompt):
+    metrics.increment('api_calls')
+    metrics.increment('prompt_chars', len(prompt))
+    metrics.increment('prompt_tokens', estimate_tokens(prompt))
+
+
+@contextmanager
+def _counting_errors():
+    try:
+        yield
+    except Exception:
+        metrics.increment('api_errors')
+        raise
+
+
+def generate(prompt, max_output_tokens, client=None, **generation_options):
+    """Send a prompt to Gemini and return the response text
+
+    `client` (see client_for_key) sends it on that key instead of the
+    configured one. API errors are not caught here; callers decide how to
+    report them.
+    """
+    def call(model, guard):
+        _count_request(prompt)
+        with metrics.span('api_call'), _counting_errors():
+            response = model.generate_content(
+                prompt,
+                generation_config=_generation_config(max_output_tokens, **generation_options),
+            )
+            text = response.text
+        metrics.increment('response_chars', len(text))
+        metrics.increment('response_tokens', estimate_tokens(text))
+        return text
+
+    return _guarded(
+        call, prompt, max_output_tokens,
+        measure=lambda text: estimate_tokens(prompt) + estimate_tokens(text), client=client,
+    )
+
+
+def generate_stream(prompt, max_output_tokens, client=None, **generation_options):
+    """Send a prompt to Gemini and yield the response text piece by piece as it arrives"""
+    def open_stream(model, guard):
+        _count_request(prompt)
+        with metrics.span('api_first_chunk'), _counting_errors():
+            response = model.generate_content(
+                prompt,
+                generation_config=_generation_config(max_output_tokens, **generation_options),
+                stream=True,
+            )
+            # Rate-limit and server errors surface with the first chunk, so fetch
+            # it inside the guard where they can still be retried
+            chunks = iter(response)
+            # The guard of the key that served the call settles the real usage below
+            return next(chunks, None), chunks, guard
+
+    started = time.perf_counter()
+    first_chunk, chunks, guard = _guarded(open_stream, prompt, max_output_tokens, client=client)
+    received_chars = 0
+    try:
+        for chunk in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks carrying only a finish reason or safety data have no text
+                continue
+            if text:
+                received_chars += len(text)
+                yield text
+    finally:
+        metrics.observe('api_stream', time.perf_counter() - started)
+        metrics.increment('response_chars', received_chars)
+        metrics.increment('response_tokens', received_chars // CHARS_PER_TOKEN)
+        if guard is not None:
+            guard.settle(
+                estimate_tokens(prompt) + max_output_tokens,
+                estimate_tokens(prompt) + received_chars // CHARS_PER_TOKEN,
+            )
+
+
+def request_single_classification(title, include_confidence, include_keywords, include_field_suggestions,
+                                  client=None):
+    """Classify a single title and return the raw response text"""
+    with metrics.span('prompt_build'):
+        prompt = create_classification_prompt(
+            title, include_confidence, include_keywords, include_field_suggestions
+        )
+    return generate(prompt, max_output_tokens=500, client=client)
+
+
+def parse_json_response(response_text, is_batch=False):
+    """Parse the JSON response from Gemini with improved error handling
+
+    Raises ResponseParseError if the response does not contain valid JSON.
+    """
+    with metrics.span('parse'):
+        try:
+            return _parse_json_text(response_text, is_batch)
+        except ResponseParseError:
+            metrics.increment('parse_failures')
+            raise
+
+
+def _parse_json_text(response_text, is_batch):
+    try:
+        # Clean the response text
+        response_text = response_text.strip()
+        
+        # Remove any markdown formatting
+        response_text = re.sub(r'```json\n?', '', response_text)
+        response_text = re.sub(r'```\n?', '', response_text)
+        response_text = re.sub(r'```', '', response_text)
+        
+        # Additional cleaning for common issues
+        response_text = response_text.replace('\n', ' ')
+        response_text = re.sub(r'\s+', ' ', response_text)
+        
+        # Try to find JSON in the response
+        if is_batch:
+            # For batch responses, look for array structure
+            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+        else:
+            # For single responses, look for object structure
+            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+            
+        if json_match:
+            json_str = json_match.group()
+            # Additional cleaning of the JSON string
+            json_str = re.sub(r',\s*}', '}', json_str)  # Remove trailing commas before }
+            json_str = re.sub(r',\s*]', ']', json_str)  # Remove trailing commas before ]
+            return json.loads(json_str)
+        else:
+            return json.loads(response_text)
+            
+    except json.JSONDecodeError as e:
+        raise ResponseParseError(f"JSON parsing error: {str(e)}", response_text) from e
+    except Exception as e:
+        raise ResponseParseError(f"Error parsing AI response: {str(e)}") from e
+
+
+def looks_truncated(response_text):
+    """Whether a batch response stops before its closing bracket"""
+    return not (response_text or '').strip().strip('`').strip().endswith(']')
+
+
+class BatchResultMatcher:
+    """Pairs objects from a batch response with the input titles they answer
+
+    Objects are matched by their echoed title first and by title_number
+    second, and the input title always replaces the echoed one. Objects
+    without a usable primary_strategy (see _usable_strategy), or that match
+    no unclaimed title, are dropped. Objects can be added one at a time as a response streams in.
+    """
+
+    def __init__(self, titles):
+        self.titles = titles
+        self.matched = {}
+        self._index_by_title = {}
+        for i, title in enumerate(titles):
+            self._index_by_title.setdefault(normalize_title(title), i)
+
+    def add(self, result):
+        """Match one response object; returns its title index, or None if it was dropped"""
+        if not isinstance(result, dict):
+            return None
+        strategy = _usable_strategy(result.get('primary_strategy'))
+        if strategy is None:
+            return None
+
+        title_idx = None
+        echoed_title = result.get('title')
+        if isinstance(echoed_title, str):
+            candidate = self._index_by_title.get(normalize_title(echoed_title))
+            if candidate is not None and candidate not in self.matched:
+                title_idx = candidate
+        if title_idx is None:
+            try:
+                candidate = int(result.get('title_number')) - 1
+            except (TypeError, ValueError):
+                candidate = None
+            if candidate is not None and 0 <= candidate < len(self.titles) and candidate not in self.matched:
+                title_idx = candidate
+        if title_idx is None:
+            return None
+
+        result['primary_strategy'] = strategy
+        result['title'] = self.titles[title_idx]
+        result['timestamp'] = datetime.now().isoformat()
+        result['taxonomy_version'] = TAXONOMY.version
+        self.matched[title_idx] = result
+        return title_idx
+
+
+def classify_title(title, include_confidence, include_keywords, include_field_suggestions, client=None):
+    """Classify one title and return its result dict
+
+    Raises on API errors and ResponseParseError on unparseable responses.
+    """
+    response = request_single_classification(
+        title, include_confidence, include_keywords, include_field_suggestions, client=client
+    )
+    result = parse_json_response(response, is_batch=False)
+    if not isinstance(result, dict):
+        raise ResponseParseError("Expected a JSON object for a single title", response)
+    strategy = _usable_strategy(result.get('primary_strategy'))
+    if strategy is None:
+        raise ResponseParseError("The response names no usable primary strategy", response)
+    result['primary_strategy'] = strategy
+    result['title'] = title
+    result['timestamp'] = datetime.now().isoformat()
+    result['taxonomy_version'] = TAXONOMY.version
+    return result
+
+
+def classify_title_batch(titles, include_confidence, include_keywords, include_field_suggestions,
+                         packer=None, stream=False, on_result=None, compact=False, client=None):
+    """Classify a batch of titles in one request
+
+    Returns a {title index: result} dict of the titles the response
+    answered; titles missing from it are simply absent. With stream=True
+    the response is parsed incrementally and on_result is called with each
+    result as soon as its object closes; otherwise on_result is called once
+    the whole response is in. Complete objects are salvaged from a
+    truncated or otherwise malformed array either way.
+
+    With compact=True the lean schema is requested and each object's
+    strategy number is expanded to the canonical strategy name.
+
+    When a BatchPacker is given it sizes max_output_tokens and learns from
+    the response. `client` sends the request on that key (see
+    client_for_key) rather than the configured one. Raises on API errors and ResponseParseError when the
+    response holds no usable objects at all.
+    """
+    with metrics.span('prompt_build'):
+        prompt = create_batch_classification_prompt(
+            titles, include_confidence, include_keywords, include_field_suggestions, compact=compact
+        )
+    max_output_tokens = packer.max_output_tokens(titles) if packer else 4000
+    matcher = BatchResultMatcher(titles)
+    expand = _expand_compact_result if compact else None
+
+    if stream:
+        parser = JsonArrayStreamParser()
+        pieces = []
+        for text in generate_stream(prompt, max_output_tokens=max_output_tokens, client=client, candidate_count=1):
+            pieces.append(text)
+            for element in parser.feed(text):
+                title_idx = matcher.add(expand(element) if expand else element)
+                if title_idx is not None and on_result:
+                    on_result(matcher.matched[title_idx])
+        response = ''.join(pieces)
+        truncated = not parser.closed
+        metrics.increment('malformed_objects', parser.malformed)
+    else:
+        response = generate(prompt, max_output_tokens=max_output_tokens, client=client, candidate_count=1)
+        truncated = looks_truncated(response)
+        try:
+            batch_results = parse_json_response(response, is_batch=True)
+            if not isinstance(batch_results, list):
+                raise ResponseParseError("Batch processing returned unexpected format", response)
+        except ResponseParseError as e:
+            batch_results = salvage_json_array(response)
+            metrics.increment('salvaged_responses')
+            if batch_results:
+                logger.warning("Salvaged %d complete object(s) from an unparseable response: %s",
+                               len(batch_results), e)
+        for element in batch_results:
+            title_idx = matcher.add(expand(element) if expand else element)
+            if title_idx is not None and on_result:
+                on_result(matcher.matched[title_idx])
+
+    if truncated:
+        metrics.increment('truncated_responses')
+    if packer:
+        packer.observe(titles, response, truncated=truncated)
+    if not matcher.matched:
+        raise ResponseParseError("Batch response contained no usable results", response)
+    return matcher.matched
+
+
+def _expand_compact_result(element):
+    """Turn a compact response object into a regular result; objects naming no strategy are left to be dropped"""
+    if not isinstance(element, dict):
+        return element
+    strategy = canonical_strategy(element.pop('strategy_number', None) or element.get('primary_strategy'))
+    if strategy is None:
+        metrics.increment('invalid_strategies')
+        element.pop('primary_strategy', None)
+    else:
+        element['primary_strategy'] = strategy
+    return element
+
+
+def classify_batch_with_recovery(titles, include_confidence, include_keywords, include_field_suggestions,
+                                 packer=None, stream=False, on_result=None, compact=False, client=None):
+    """Classify a batch, re-requesting only the titles its response left out
+
+    Titles missing or malformed in a response are sent again together. A
+    group that comes back with nothing usable is split in half, and single
+    titles use the one-title prompt (the compact batch prompt when
+    compact=True, so every result matches the run's prompt version), so
+    one bad title costs one or two extra calls rather than a call per title. `stream`, `on_result`,
+    `compact` and `client` are passed on to classify_title_batch; on_result
+    also receives results recovered by the retries.
+
+    Returns (results in input order, failed titles, recovery stats). Only
+    an API error on the first request is raised; later ones mark their
+    titles as failed so the results already recovered are kept.
+    """
+    flags = (include_confidence, include_keywords, include_field_suggestions)
+    results = {}
+    failed_titles = []
+    stats = {'requests': 0, 'retry_requests': 0, 'bisections': 0, 'single_title_requests': 0}
+    groups = deque([list(range(len(titles)))])
+
+    while groups:
+        indices = groups.popleft()
+        group_titles = [titles[i] for i in indices]
+        first_request = stats['requests'] == 0
+        stats['requests'] += 1
+        if not first_request:
+            stats['retry_requests'] += 1
+
+        try:
+            if len(indices) == 1:
+                stats['single_title_requests'] += 1
+            if len(indices) == 1 and not compact:
+                matched = {0: classify_title(group_titles[0], *flags, client=client)}
+                if on_result:
+                    on_result(matched[0])
+            else:
+                matched = classify_title_batch(
+                    group_titles, *flags, packer=packer, stream=stream, on_result=on_result, compact=compact,
+                    client=client,
+                )
+        except ResponseParseError as e:
+            logger.warning("Unusable response for %d title(s): %s", len(indices), e)
+            matched = {}
+        except Exception as e:
+            if first_request:
+                raise
+            logger.warning("Retry request for %d title(s) failed: %s", len(indices), e)
+            failed_titles.extend(group_titles)
+            continue
+
+        for local_idx, result in matched.items():
+            results[indices[local_idx]] = result
+        missing = [title_idx for local_idx, title_idx in enumerate(indices) if local_idx not in matched]
+        if not missing:
+            continue
+
+        if len(indices) == 1:
+            failed_titles.append(titles[indices[0]])
+        elif len(missing) < len(indices):
+            # The response made progress, so retry just the gaps together
+            groups.append(missing)
+        else:
+            stats['bisections'] += 1
+            middle = len(indices) // 2
+            groups.append(indices[:middle])
+            groups.append(indices[middle:])
+
+    metrics.increment('recovery_retry_requests', stats['retry_requests'])
+    metrics.increment('recovery_bisections', stats['bisections'])
+    metrics.increment('recovery_single_title_requests', stats['single_title_requests'])
+    metrics.increment('failed_titles', len(failed_titles))
+    return [results[i] for i in sorted(results)], failed_titles, stats
+
+
+def estimate_api_usage(titles, include_confidence, include_keywords, include_field_suggestions, packer=None,
+                       compact=False):
+    """Estimate the (requests, tokens) it would take to classify `titles` in batches"""
+    batches = packer.pack(titles) if packer else (titles[i:i + 10] for i in range(0, len(titles), 10))
+    requests = tokens = 0
+    for batch in batches:
+        prompt = create_batch_classification_prompt(
+            batch, include_confidence, include_keywords, include_field_suggestions, compact=compact
+        )
+        requests += 1
+        tokens += estimate_tokens(prompt)
+        if packer:
+            tokens += int(packer.estimate_batch_output(batch))
+        else:
+            tokens += len(batch) * (COMPACT_RESULT_TOKENS if compact else BASE_RESULT_TOKENS)
+    return requests, tokens
+
+
+def order_results(titles, cached_results, new_results):
+    """Merge cached and freshly classified results back into the order of `titles`
+
+    Results whose title cannot be matched to an input title are appended at the end.
+    """
+    new_by_title = {}
+    for result in new_results:
+        new_by_title.setdefault(normalize_title(result.get('title', '')), []).append(result)
+
+    results = []
+    for title in titles:
+        if title in cached_results:
+            result = dict(cached_results[title], title=title)
+            result['timestamp'] = datetime.now().isoformat()
+            # The cache key covers the prompt, so a hit was produced under the current taxonomy
+            result['taxonomy_version'] = TAXONOMY.version
+            results.append(result)
+        elif new_by_title.get(normalize_title(title)):
+            results.append(new_by_title[normalize_title(title)].pop(0))
+    for unmatched in new_by_title.values():
+        results.extend(unmatched)
+    return results
+
+
+CSV_BASE_FIELDS = ['title', 'primary_strategy', 'strategy_description']
+
+
+def csv_fieldnames(include_confidence, include_keywords, include_field_suggestions):
+    """Column order for CSV exports with the given optional fields"""
+    fieldnames = list(CSV_BASE_FIELDS)
+    if include_confidence:
+        fieldnames.append('confidence_score')
+    if include_keywords:
+        fieldnames.append('keywords')
+    if include_field_suggestions:
+        fieldnames.append('related_fields')
+    return fieldnames
+
+
+def result_to_csv_row(result):
+    """Flatten a classification result into a CSV row"""
+    row = {
+        'title': result.get('title', ''),
+        'primary_strategy': clean_strategy_name(result.get('primary_strategy', '')),
+        'strategy_description': result.get('strategy_description', ''),
+    }
+    if 'confidence_score' in result:
+        row['confidence_score'] = result['confidence_score']
+    if 'keywords' in result:
+        row['keywords'] = ', '.join(result['keywords']) if isinstance(result['keywords'], list) else str(result['keywords'])
+    if 'related_fields' in result:
+        row['related_fields'] = ', '.join(result['related_fields']) if isinstance(result['related_fields'], list) else str(result['related_fields'])
+    return row
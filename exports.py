@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+
+import engine
+
+# Results serialized per chunk written to the output file
+EXPORT_CHUNK_ROWS = 1000
+
+# Format name: (file extension, MIME type)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'json': ('json', 'application/json'),
+    'jsonl': ('jsonl', 'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def parquet_available():
+    """Whether the optional pyarrow dependency for Parquet exports is installed"""
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def available_formats():
+    return [name for name in EXPORT_FORMATS if name != 'parquet' or parquet_available()]
+
+
+def _chunks(results, size=EXPORT_CHUNK_ROWS):
+    chunk = []
+    for result in results:
+        chunk.append(result)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv(results, fieldnames):
+    """CSV text in chunks of EXPORT_CHUNK_ROWS rows, header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    for chunk in _chunks(results):
+        writer.writerows(engine.result_to_csv_row(result) for result in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_json(results):
+    """A pretty-printed JSON array, one chunk of results at a time"""
+    first = True
+    yield "["
+    for chunk in _chunks(results):
+        parts = []
+        for result in chunk:
+            text = json.dumps(result, indent=2)
+            parts.append(("\n  " if first else ",\n  ") + text.replace("\n", "\n  "))
+            first = False
+        yield "".join(parts)
+    yield "]" if first else "\n]"
+
+
+def iter_jsonl(results):
+    """One JSON object per line"""
+    for chunk in _chunks(results):
+        yield "".join(json.dumps(result) + "\n" for result in chunk)
+
+
+def write_parquet(results, fieldnames, file):
+    """Write results as Parquet, one row group per chunk; needs pyarrow"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Keywords and related fields stay lists and the confidence an integer; everything else is text
+    types = {'confidence_score': pa.int64(), 'keywords': pa.list_(pa.string()),
+             'related_fields': pa.list_(pa.string())}
+    converters = {'confidence_score': _to_int, 'keywords': _to_list, 'related_fields': _to_list}
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in fieldnames + ['timestamp']])
+    with pq.ParquetWriter(file, schema) as writer:
+        for chunk in _chunks(results):
+            columns = {}
+            for name in schema.names:
+                convert = converters.get(name, _to_text)
+                columns[name] = [convert(result.get(name)) for result in chunk]
+            writer.write_table(pa.table(columns, schema=schema))
+
+
+def _to_text(value):
+    return None if value is None else str(value)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_list(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return [str(item) for item in value]
+
+
+def write_export(results, output_format, file, fieldnames=None):
+    """Stream `results` into a binary file object in the given format
+
+    Results are read and serialized one chunk at a time, so a long history
+    never needs to be in memory as dicts and as text at once. `fieldnames`
+    selects the CSV and Parquet columns (default: every classification field).
+    """
+    fieldnames = fieldnames or engine.csv_fieldnames(True, True, True)
+    if output_format == 'parquet':
+        write_parquet(results, fieldnames, file)
+        return
+    if output_format == 'csv':
+        pieces = iter_csv(results, fieldnames)
+    elif output_format == 'json':
+        pieces = iter_json(results)
+    elif output_format == 'jsonl':
+        pieces = iter_jsonl(results)
+    else:
+        raise ValueError(f"Unknown export format: {output_format}")
+    for piece in pieces:
+        file.write(piece.encode('utf-8'))
@@ -0,0 +1,274 @@
+"""Local stand-in for the Gemini API
+
+FakeGeminiBackend answers classification prompts without any network
+access, with configurable latency, injected 429/5xx errors and damaged
+responses, so rate limiting, retries, recovery and concurrency can be
+exercised without spending quota:
+
+    engine.set_model_factory(FakeGeminiBackend(latency=0.3, requests_per_minute=60))
+
+Run this file directly to load it through the engine's rate limiter.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from keypool import KeyPool, KeySpec
+from packing import CHARS_PER_TOKEN
+
+STRATEGY_LINE = re.compile(r'^(\d{1,2})\. ([^"\n]+?) - ', re.MULTILINE)
+BATCH_TITLE_LINE = re.compile(r'^(\d+)\. "(.*)"$', re.MULTILINE)
+SINGLE_TITLE_LINE = re.compile(r'^Research Paper Title: "(.*)"$', re.MULTILINE)
+
+
+class FakeApiError(Exception):
+    """Error carrying an HTTP status code, like google.api_core exceptions"""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Mimics genai.GenerativeModel.generate_content for classification prompts"""
+
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        if isinstance(generation_config, dict):
+            max_output_tokens = generation_config.get('max_output_tokens')
+        else:
+            max_output_tokens = getattr(generation_config, 'max_output_tokens', None)
+        text = self.backend.handle(prompt, max_output_tokens)
+        if stream:
+            piece = self.backend.stream_chunk_chars
+            return [FakeResponse(text[i:i + piece]) for i in range(0, len(text), piece)]
+        return FakeResponse(text)
+
+
+class FakeGeminiBackend:
+    """Factory for fake Gemini models that share latency, error and quota settings
+
+    - latency / latency_jitter: seconds slept per call
+    - latency_distribution: 'uniform' (latency +/- jitter), 'lognormal'
+      (median `latency`, long right tail) or 'constant'
+    - per_title_latency: extra seconds per title in a batch prompt
+    - rate_limit_rate / server_error_rate: probability of a random 429 / 503
+    - requests_per_minute: server-side quota; calls beyond it in a sliding
+      one-minute window fail with 429, like the real API
+    - malformed_rate: probability that one object of a response is broken
+    - truncation_rate: probability that a response is cut off at random
+    Responses honour max_output_tokens, so oversized batches come back cut off.
+    """
+
+    def __init__(self, latency=0.2, latency_jitter=0.1, rate_limit_rate=0.0, server_error_rate=0.0,
+                 requests_per_minute=None, stream_chunk_chars=64, seed=None, latency_distribution='uniform',
+                 per_title_latency=0.0, malformed_rate=0.0, truncation_rate=0.0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.latency_distribution = latency_distribution
+        self.per_title_latency = per_title_latency
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.requests_per_minute = requests_per_minute
+        self.malformed_rate = malformed_rate
+        self.truncation_rate = truncation_rate
+        self.stream_chunk_chars = stream_chunk_chars
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent_calls = deque()
+        self.counters = {
+            'calls': 0, 'rate_limited': 0, 'server_errors': 0, 'truncated': 0, 'malformed': 0,
+            'prompt_chars': 0, 'response_chars': 0,
+        }
+
+    def __call__(self, model_name):
+        return FakeGenerativeModel(self, model_name)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _roll(self):
+        with self._lock:
+            return self._random.random()
+
+    def _over_quota(self):
+        if not self.requests_per_minute:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._recent_calls and now - self._recent_calls[0] > 60:
+                self._recent_calls.popleft()
+            if len(self._recent_calls) >= self.requests_per_minute:
+                return True
+            self._recent_calls.append(now)
+            return False
+
+    def sample_latency(self, title_count=1):
+        """Seconds one call takes under the configured latency distribution"""
+        with self._lock:
+            if self.latency_distribution == 'lognormal':
+                base = self.latency * self._random.lognormvariate(0, 0.5)
+            elif self.latency_distribution == 'constant':
+                base = self.latency
+            else:
+                base = self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter)
+        return max(0.0, base + self.per_title_latency * title_count)
+
+    def handle(self, prompt, max_output_tokens=None):
+        """Simulate one API call: quota check, latency, injected errors, then the answer"""
+        self._count('calls')
+        self._count('prompt_chars', len(prompt))
+        if self._over_quota() or self._roll() < self.rate_limit_rate:
+            self._count('rate_limited')
+            raise FakeApiError(429, "Resource has been exhausted (e.g. check quota).")
+        time.sleep(self.sample_latency(len(BATCH_TITLE_LINE.findall(prompt)) or 1))
+        if self._roll() < self.server_error_rate:
+            self._count('server_errors')
+            raise FakeApiError(503, "The service is currently unavailable.")
+
+        text = self.answer(prompt)
+        if self._roll() < self.malformed_rate:
+            self._count('malformed')
+            text = self._damage(text)
+        if max_output_tokens and len(text) > max_output_tokens * CHARS_PER_TOKEN:
+            self._count('truncated')
+            text = text[:max_output_tokens * CHARS_PER_TOKEN]
+        elif self._roll() < self.truncation_rate:
+            self._count('truncated')
+            text = text[:int(len(text) * self._roll())]
+        self._count('response_chars', len(text))
+        return text
+
+    def _damage(self, text):
+        """Break the JSON of one object the way models occasionally do"""
+        descriptions = [match.start() for match in re.finditer(r'"strategy_description": "', text)]
+        if not descriptions:
+            return "Here is the classification you asked for:\n" + text
+        position = descriptions[int(self._roll() * len(descriptions))]
+        # Drop the opening quote of the description, leaving a bare word
+        cut = position + len('"strategy_description": ')
+        return text[:cut] + text[cut + 1:]
+
+    def answer(self, prompt):
+        """Build a well-formed JSON answer for a single or batch classification prompt"""
+        strategies = [name for _, name in STRATEGY_LINE.findall(prompt)] or ["Unknown Strategy"]
+        include = {field: f'"{field}"' in prompt for field in ('confidence_score', 'keywords', 'related_fields')}
+
+        batch_titles = BATCH_TITLE_LINE.findall(prompt)
+        if batch_titles and '"strategy_number"' in prompt:
+            # Compact and screening prompts: a strategy number and the requested fields, nothing else
+            return json.dumps([
+                self._compact(title, strategies, include, title_number=int(number)) for number, title in batch_titles
+            ])
+        if batch_titles:
+            return json.dumps([
+                dict(self._classify(title, strategies, include), title_number=int(number), title=title)
+                for number, title in batch_titles
+            ], indent=2)
+        match = SINGLE_TITLE_LINE.search(prompt)
+        return json.dumps(self._classify(match.group(1) if match else '', strategies, include), indent=2)
+
+    @classmethod
+    def _compact(cls, title, strategies, include, title_number):
+        # Same strategy and optional fields as the full answer for this title
+        result = cls._classify(title, strategies, include)
+        compact = {'title_number': title_number, 'strategy_number': int(result.pop('primary_strategy').split('.')[0])}
+        del result['strategy_description']
+        compact.update(result)
+        return compact
+
+    @staticmethod
+    def _classify(title, strategies, include):
+        # Deterministic per title so repeated runs are comparable
+        digest = int(hashlib.md5(title.encode('utf-8')).hexdigest(), 16)
+        strategy_idx = digest % len(strategies)
+        result = {
+            'primary_strategy': f"{strategy_idx + 1}. {strategies[strategy_idx]}",
+            'strategy_description': (
+                f"The title \"{title}\" describes work that fits this strategy. "
+                "This is a simulated answer from the local fake backend."
+            ),
+        }
+        if include['confidence_score']:
+            result['confidence_score'] = 1 + digest % 10
+        if include['keywords']:
+            result['keywords'] = [word.lower() for word in re.findall(r'[A-Za-z]{4,}', title)[:5]]
+        if include['related_fields']:
+            result['related_fields'] = [strategies[(strategy_idx + 1) % len(strategies)]]
+        return result
+
+
+def main(argv=None):
+    import engine
+
+    parser = argparse.ArgumentParser(description="Drive the engine and its rate limiter against the fake backend")
+    parser.add_argument('--titles', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--server-rpm', type=int, default=120, help="Quota enforced by the fake server")
+    parser.add_argument('--client-rpm', type=int, default=120, help="Client-side limit (0 disables the limiter)")
+    parser.add_argument('--client-tpm', type=int, default=4000000)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.3)
+    parser.add_argument('--keys', type=int, default=1,
+                        help="Shard over this many fake keys, each with its own server quota")
+    args = parser.parse_args(argv)
+
+    backends = {
+        f"fake-key-{i}": FakeGeminiBackend(
+            latency=args.latency, rate_limit_rate=args.rate_limit_rate, requests_per_minute=args.server_rpm, seed=1 + i
+        )
+        for i in range(max(1, args.keys))
+    }
+    backend = backends["fake-key-0"]
+    engine.set_model_factory(backend)
+    client_rpm, client_tpm = args.client_rpm or None, args.client_tpm if args.client_rpm else None
+    if args.keys > 1:
+        specs = [KeySpec(key, None, 1.0) for key in backends]
+        engine.use_key_pool(KeyPool(specs, lambda spec: backends[spec.key](engine.MODEL_NAME), client_rpm, client_tpm))
+    else:
+        engine.configure("fake-key-0", client_rpm, client_tpm)
+
+    titles = [f"Simulated research title number {i} about enzymes" for i in range(args.titles)]
+    batches = [titles[i:i + 10] for i in range(0, len(titles), 10)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        outcomes = list(executor.map(
+            lambda batch: _classify_or_error(engine, batch), batches
+        ))
+    elapsed = time.perf_counter() - started
+
+    classified = sum(count for count, _ in outcomes)
+    errors = [error for _, error in outcomes if error]
+    print(f"classified {classified}/{len(titles)} titles in {elapsed:.1f}s, {len(errors)} failed batches")
+    for key, key_backend in backends.items():
+        print(f"server {key}:", key_backend.counters)
+    client = engine.get_key_pool() or engine.get_api_guard()
+    if client:
+        print("client:", client.stats())
+
+
+def _classify_or_error(engine, batch):
+    try:
+        results, _, _ = engine.classify_batch_with_recovery(batch, True, True, False)
+        return len(results), None
+    except Exception as e:
+        return 0, str(e)
+
+
+if __name__ == '__main__':
+    main()
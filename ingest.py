@@ -0,0 +1,292 @@
+"""Streaming readers for title files: plain text, CSV/TSV, JSONL, BibTeX and RIS
+
+Every reader takes a text file object and yields one record at a time,
+so files with hundreds of thousands of records are never held in memory
+as one string. Records are dicts of field name to value; plain text
+lines become {'title': line}.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+import re
+from contextlib import contextmanager
+
+INPUT_FORMATS = {
+    '.txt': 'txt',
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.tab': 'tsv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.bib': 'bibtex',
+    '.bibtex': 'bibtex',
+    '.ris': 'ris',
+}
+
+# Field names tried, case-insensitively, when guessing which one holds the title
+TITLE_FIELD_CANDIDATES = ('title', 'ti', 't1', 'paper title', 'article title')
+
+# BibTeX entry types that are not publications
+BIBTEX_SKIPPED_TYPES = {'comment', 'string', 'preamble'}
+
+_BIBTEX_ENTRY_START = re.compile(r'^\s*@\s*([A-Za-z]+)\s*[{(]')
+_RIS_LINE = re.compile(r'^([A-Z][A-Z0-9])  -(?: (.*))?$')
+_LATEX_ESCAPE = re.compile(r'\\([&%$#_{}])')
+_LATEX_BRACE = re.compile(r'(?<!\\)[{}]')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class IngestError(ValueError):
+    """Raised when a file cannot be read as the requested format"""
+
+
+def detect_format(name):
+    """Guess a file format from its extension, defaulting to plain text"""
+    return INPUT_FORMATS.get(os.path.splitext(name)[1].lower(), 'txt')
+
+
+@contextmanager
+def open_binary(binary_file, encoding='utf-8-sig'):
+    """Read a binary file object (e.g. a Streamlit upload) from the start as text, line by line
+
+    The file is decoded incrementally rather than into one string, and is
+    left open afterwards so it can be read again.
+    """
+    binary_file.seek(0)
+    stream = io.TextIOWrapper(binary_file, encoding=encoding, errors='replace', newline='')
+    try:
+        yield stream
+    finally:
+        stream.detach()
+
+
+def iter_records(f, input_format):
+    """Yield the records of a text file object one at a time"""
+    if input_format == 'txt':
+        return ({'title': line} for line in f)
+    if input_format in ('csv', 'tsv'):
+        return csv.DictReader(f, delimiter='\t' if input_format == 'tsv' else ',')
+    if input_format == 'jsonl':
+        return _iter_jsonl(f)
+    if input_format == 'bibtex':
+        return _iter_bibtex(f)
+    if input_format == 'ris':
+        return _iter_ris(f)
+    raise IngestError(f"Unsupported input format: {input_format}")
+
+
+def sample_fields(f, input_format, records=50):
+    """Field names seen in the first few records, in first-seen order"""
+    if input_format == 'txt':
+        return ['title']
+    reader = iter_records(f, input_format)
+    fields = dict.fromkeys(getattr(reader, 'fieldnames', None) or ())
+    for record in itertools.islice(reader, records):
+        fields.update(dict.fromkeys(record))
+    return [field for field in fields if field is not None]
+
+
+def default_title_field(input_format):
+    """The title field of a format's usual exports"""
+    return 'TI' if input_format == 'ris' else 'title'
+
+
+def guess_title_field(fields):
+    """The field most likely to hold titles, or the first field"""
+    by_name = {field.strip().lower(): field for field in fields}
+    for candidate in TITLE_FIELD_CANDIDATES:
+        if candidate in by_name:
+            return by_name[candidate]
+    return fields[0] if fields else 'title'
+
+
+def iter_titles(f, input_format, title_field='title'):
+    """Yield the non-empty titles of a text file object one at a time"""
+    if input_format == 'txt':
+        title_field = 'title'
+    records = iter_records(f, input_format)
+    fieldnames = getattr(records, 'fieldnames', None)
+    if fieldnames and title_field not in fieldnames:
+        raise IngestError(f"Column '{title_field}' not found; available columns: {', '.join(fieldnames)}")
+    clean = _clean_latex if input_format == 'bibtex' else None
+    seen_records = found_field = False
+    for record in records:
+        seen_records = True
+        title = record.get(title_field)
+        if title is None:
+            continue
+        found_field = True
+        if not isinstance(title, str):
+            title = str(title)
+        if clean:
+            title = clean(title)
+        title = title.strip()
+        if title:
+            yield title
+    if seen_records and not found_field:
+        raise IngestError(f"No record has a '{title_field}' field")
+
+
+def _iter_jsonl(f):
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise IngestError(f"Line {line_number} is not valid JSON: {e}") from None
+        if isinstance(record, dict):
+            yield record
+
+
+def _iter_ris(f):
+    """RIS records: tag lines up to an 'ER' line; untagged lines continue the previous field
+
+    Repeated tags (authors, keywords) keep their first value; T1 titles
+    are filed under TI.
+    """
+    record = {}
+    tag = None
+    for line in f:
+        line = line.rstrip('\r\n')
+        match = _RIS_LINE.match(line)
+        if match:
+            tag, value = match.group(1), (match.group(2) or '').strip()
+            # Exporters use either tag for the primary title
+            if tag == 'T1':
+                tag = 'TI'
+            if tag == 'ER':
+                if record:
+                    yield record
+                record, tag = {}, None
+            elif tag not in record:
+                record[tag] = value
+            else:
+                tag = None
+        elif tag and line.strip():
+            record[tag] = f"{record[tag]} {line.strip()}"
+    if record:
+        yield record
+
+
+def _iter_bibtex(f):
+    """BibTeX entries as {'entry_type', 'key', field: value} dicts
+
+    Lines are collected only until the current entry's braces balance, so
+    memory is bounded by the largest single entry.
+    """
+    entry = None
+    depth = 0
+    for line in f:
+        if entry is None:
+            match = _BIBTEX_ENTRY_START.match(line)
+            if not match:
+                continue
+            entry = []
+            depth = 0
+            # Entries are delimited by braces or, rarely, parentheses
+            opener = match.group(0)[-1]
+            closer = '}' if opener == '{' else ')'
+        entry.append(line)
+        depth += _brace_balance(line, opener, closer)
+        if depth <= 0:
+            record = _parse_bibtex_entry(''.join(entry))
+            entry = None
+            if record is not None:
+                yield record
+    if entry:
+        record = _parse_bibtex_entry(''.join(entry))
+        if record is not None:
+            yield record
+
+
+def _brace_balance(line, opener='{', closer='}'):
+    if '\\' not in line:
+        return line.count(opener) - line.count(closer)
+    balance = 0
+    escaped = False
+    for char in line:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == opener:
+            balance += 1
+        elif char == closer:
+            balance -= 1
+    return balance
+
+
+def _parse_bibtex_entry(text):
+    match = _BIBTEX_ENTRY_START.match(text)
+    entry_type = match.group(1).lower()
+    if entry_type in BIBTEX_SKIPPED_TYPES:
+        return None
+    body = text[match.end():].rstrip()
+    if body.endswith(('}', ')')):
+        body = body[:-1]
+    key, _, fields = body.partition(',')
+    record = {'entry_type': entry_type, 'key': key.strip()}
+    position = 0
+    while position < len(fields):
+        equals = fields.find('=', position)
+        if equals < 0:
+            break
+        name = fields[position:equals].strip(' \t\r\n,').lower()
+        value, position = _read_bibtex_value(fields, equals + 1)
+        if name:
+            record[name] = value
+    return record
+
+
+def _read_bibtex_value(text, position):
+    """Read a braced, quoted or bare value (with # concatenation) starting at `position`"""
+    parts = []
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            break
+        opener = text[position]
+        if opener in '{"':
+            closer = '}' if opener == '{' else '"'
+            depth = 0
+            start = position + 1
+            position += 1
+            while position < len(text):
+                char = text[position]
+                if char == '\\':
+                    position += 2
+                    continue
+                if char == '{':
+                    depth += 1
+                elif char == closer and depth == 0:
+                    break
+                elif char == '}':
+                    depth -= 1
+                position += 1
+            parts.append(text[start:position])
+            position += 1
+        else:
+            end = position
+            while end < len(text) and text[end] not in ',#':
+                end += 1
+            parts.append(text[position:end].strip())
+            position = end
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position < len(text) and text[position] == '#':
+            position += 1
+            continue
+        break
+    # Skip to just past the comma ending this field
+    comma = text.find(',', position)
+    return ''.join(parts), (len(text) if comma < 0 else comma + 1)
+
+
+def _clean_latex(value):
+    """Drop the braces and common escapes BibTeX uses to protect capitalization and symbols"""
+    value = _LATEX_ESCAPE.sub(r'\1', _LATEX_BRACE.sub('', value))
+    return _WHITESPACE.sub(' ', value.replace('~', ' '))
@@ -0,0 +1,375 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import engine
+from dedupe import group_titles
+from metrics import metrics
+from packing import BatchPacker
+
+logger = logging.getLogger("classifier.jobs")
+
+# Jobs still waiting or running; everything else is finished
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def classify_batch(batch, options, cache, prompt_version, packer, stream=False, pre_classifier=None,
+                   near_duplicates=False, prefilter_min_score=None, prefilter_min_margin=None, cascade=None,
+                   compact=False, client=None):
+    """Classify one batch, answering from the cache and the local pre-classifier first
+
+    Titles within the batch that are identical once canonicalized, or
+    near-identical if `near_duplicates` is set, are classified once and
+    share the result. Only the remaining titles are sent to Gemini, through
+    the Cascade if one is given, and only titles missing from its response
+    are re-requested. `compact` selects the lean response schema and must
+    match the packer and prompt version; `client` (see
+    engine.client_for_key) sends the requests on that key instead of the
+    configured one. Returns (results, counts, failed_titles) where counts
+    holds the merged duplicates, the cached, locally classified and
+    screened titles and the estimated requests and tokens saved locally.
+    API errors for the batch request itself propagate so the caller can
+    retry the batch later.
+    """
+    title_groups = group_titles(batch, near_duplicates=near_duplicates)
+    representatives = title_groups.representatives
+    cached = cache.get_many(representatives, options, prompt_version) if cache else {}
+    to_send = [title for title in representatives if title not in cached]
+    flags = (options['include_confidence'], options['include_keywords'], options['include_field_suggestions'])
+    counts = {
+        'duplicates': title_groups.duplicates, 'cached': len(cached), 'local': 0, 'screened': 0,
+        'requests_saved': 0, 'tokens_saved': 0,
+    }
+
+    local_results = []
+    if pre_classifier and to_send:
+        accepted, ambiguous = pre_classifier.split(to_send, prefilter_min_score, prefilter_min_margin)
+        if accepted:
+            local_titles = [to_send[i] for i in accepted]
+            local_results = [
+                pre_classifier.make_result(to_send[i], prediction, *flags) for i, prediction in accepted.items()
+            ]
+            if ambiguous:
+                # The request still goes out, just with a shorter response
+                tokens_saved = int(packer.estimate_batch_output(local_titles))
+            else:
+                _, tokens_saved = engine.estimate_api_usage(local_titles, *flags, packer=packer, compact=compact)
+            counts.update(local=len(local_titles), requests_saved=0 if ambiguous else 1, tokens_saved=tokens_saved)
+        to_send = [to_send[i] for i in ambiguous]
+
+    new_results = []
+    failed_titles = []
+    if to_send:
+        classify = cascade.classify if cascade else engine.classify_batch_with_recovery
+        new_results, failed_titles, recovery_stats = classify(
+            to_send, *flags, packer=packer, stream=stream, compact=compact, client=client
+        )
+        for title in failed_titles:
+            logger.error("Failed to classify %r", title)
+        if recovery_stats['retry_requests']:
+            logger.warning("Recovered an incomplete response with %d extra request(s)",
+                           recovery_stats['retry_requests'])
+        # Screened results lack the description and optional fields, so only full ones are cached
+        full_results = [result for result in new_results if result.get('classified_by') != 'screening']
+        counts['screened'] = len(new_results) - len(full_results)
+        if cache and full_results:
+            cache.put_many(full_results, options, prompt_version)
+
+    results = engine.order_results(representatives, cached, new_results + local_results)
+    return title_groups.fan_out(results), counts, failed_titles
+
+
+class JobQueue:
+    """Background classification jobs with progress persisted to SQLite
+
+    submit() stores the titles and returns a job id at once; a small pool
+    of worker threads takes jobs in submission order and classifies each
+    in packed batches, several at a time. Every finished batch commits its
+    results and progress, so a page that polls status() and results() sees
+    partial results, and nothing is lost if the browser tab goes away.
+
+    The API key and the shared packer and pre-classifier are only kept in
+    memory. Jobs that were queued or running when the server stopped are
+    marked 'interrupted' on the next start and continue from their
+    unfinished titles once resume() is given a key again.
+    """
+
+    def __init__(self, path, workers=2, max_age=7 * 24 * 3600):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                options TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                stats TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_titles (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                PRIMARY KEY (job_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS job_results (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                result TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_job_results_job ON job_results (job_id, seq);
+            """
+        )
+        expired = time.time() - max_age
+        for table in ('job_titles', 'job_results'):
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE job_id IN (SELECT id FROM jobs WHERE updated_at < ?)", (expired,)
+            )
+        self._conn.execute("DELETE FROM jobs WHERE updated_at < ?", (expired,))
+        # Jobs this process did not start have lost their worker
+        self._conn.execute(
+            "UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')"
+        )
+        self._conn.commit()
+
+        self._queue = queue.Queue()
+        self._settings = {}
+        self._cancelled = set()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"classification-job-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, titles, api_key, options, near_duplicates=False, compact=False, **settings):
+        """Queue titles for classification and return the new job's id
+
+        `options` holds the include_* flags; they, near_duplicates and
+        compact are stored with the job. Other keyword settings are
+        passed to the run: requests_per_minute, tokens_per_minute, cache,
+        packer, pre_classifier, prefilter_min_score, prefilter_min_margin,
+        cascade, stream and concurrency.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, status, options, total, created_at, updated_at) "
+                    "VALUES (?, 'queued', ?, 0, ?, ?)",
+                    (job_id, json.dumps(dict(options, near_duplicates=near_duplicates, compact=compact)), now, now),
+                )
+                # Titles may be a generator over an uploaded file; they are stored as they are read
+                total = self._conn.executemany(
+                    "INSERT INTO job_titles (job_id, position, title) VALUES (?, ?, ?)",
+                    ((job_id, position, title) for position, title in enumerate(titles)),
+                ).rowcount
+                self._conn.execute("UPDATE jobs SET total = ? WHERE id = ?", (total, job_id))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        self._enqueue(job_id, dict(settings, api_key=api_key))
+        metrics.increment('jobs_submitted')
+        return job_id
+
+    def resume(self, job_id, api_key, **settings):
+        """Queue an interrupted or failed job, or a completed one with failed titles, again
+
+        Only its unfinished and failed titles are classified.
+        """
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', failed = 0, error = NULL, updated_at = ? "
+                "WHERE id = ? AND (status IN ('interrupted', 'failed') OR (status = 'completed' AND failed > 0))",
+                (time.time(), job_id),
+            ).rowcount
+            if updated:
+                self._conn.execute(
+                    "UPDATE job_titles SET state = 'pending' WHERE job_id = ? AND state = 'failed'", (job_id,)
+                )
+            self._conn.commit()
+        if updated:
+            self._enqueue(job_id, dict(settings, api_key=api_key))
+        return bool(updated)
+
+    def cancel(self, job_id):
+        """Stop a job after the batches already in flight; finished results are kept"""
+        self._cancelled.add(job_id)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status IN (?, ?, ?)",
+                (time.time(), job_id, 'queued', 'running', 'interrupted'),
+            )
+            self._conn.commit()
+
+    def status(self, job_id):
+        """Progress of a job as a dict, or None if there is no such job"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, options, total, done, failed, stats, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, status, options, total, done, failed, stats, error, created_at, updated_at = row
+        return {
+            'id': job_id,
+            'status': status,
+            'options': json.loads(options),
+            'total': total,
+            'done': done,
+            'failed': failed,
+            'progress': (done + failed) / total if total else 1.0,
+            'stats': json.loads(stats) if stats else {},
+            'error': error,
+            'created_at': created_at,
+            'updated_at': updated_at,
+        }
+
+    def results(self, job_id, after=0, limit=1000):
+        """Results stored after sequence number `after`, and the sequence number to poll from next"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, result FROM job_results WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [json.loads(result) for _, result in rows], (rows[-1][0] if rows else after)
+
+    def _enqueue(self, job_id, settings):
+        self._cancelled.discard(job_id)
+        self._settings[job_id] = settings
+        self._queue.put(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            settings = self._settings.pop(job_id, None)
+            if settings is None or job_id in self._cancelled:
+                continue
+            try:
+                with metrics.span('job'):
+                    self._run(job_id, **settings)
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                self._finish(job_id, 'failed', str(e))
+
+    def _run(self, job_id, api_key, requests_per_minute=None, tokens_per_minute=None, cache=None, packer=None,
+             pre_classifier=None, prefilter_min_score=None, prefilter_min_margin=None, cascade=None, stream=False,
+             concurrency=4):
+        options = self.status(job_id)['options']
+        near_duplicates = options.pop('near_duplicates', False)
+        compact = options.pop('compact', False)
+        flags = (options['include_confidence'], options['include_keywords'], options['include_field_suggestions'])
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+            self._conn.commit()
+        # The job's own key and quota guard; reconfiguring the engine here would switch
+        # every other job and app session over to this key
+        client = engine.client_for_key(api_key, requests_per_minute, tokens_per_minute)
+        prompt_version = engine.get_prompt_version(*flags, compact=compact)
+        packer = packer or BatchPacker(*flags, compact=compact)
+        with self._lock:
+            pending_titles = self._conn.execute(
+                "SELECT position, title FROM job_titles WHERE job_id = ? AND state = 'pending' ORDER BY position",
+                (job_id,),
+            ).fetchall()
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = {}
+
+            def finish(future):
+                batch = in_flight.pop(future)
+                try:
+                    results, counts, _ = future.result()
+                except Exception as e:
+                    logger.error("Job %s: batch of %d titles failed: %s", job_id, len(batch), e)
+                    errors.append(str(e))
+                    results, counts = [], {}
+                self._record_batch(job_id, batch, results, counts)
+
+            for batch in packer.pack(pending_titles, key=lambda item: item[1]):
+                if job_id in self._cancelled:
+                    break
+                future = executor.submit(
+                    classify_batch, [title for _, title in batch], options, cache, prompt_version, packer,
+                    stream, pre_classifier, near_duplicates, prefilter_min_score, prefilter_min_margin, cascade,
+                    compact, client,
+                )
+                in_flight[future] = batch
+                # Keep only a couple of batches per worker in flight so a huge job stays flat in memory
+                while len(in_flight) >= concurrency * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+
+        if job_id in self._cancelled:
+            return
+        status = self.status(job_id)
+        failed_completely = status['failed'] and not status['done']
+        self._finish(job_id, 'failed' if failed_completely else 'completed', errors[0] if errors else None)
+
+    def _record_batch(self, job_id, batch, results, counts):
+        """Store a finished batch's results and progress in one transaction
+
+        A position is done only if a result came back for its title; every
+        other one, such as a duplicate of a title that failed, is marked
+        failed so resume() retries it.
+        """
+        classified = Counter(result.get('title') for result in results)
+        states = []
+        for position, title in batch:
+            if classified[title] > 0:
+                classified[title] -= 1
+                states.append(('done', job_id, position))
+            else:
+                states.append(('failed', job_id, position))
+        failed = sum(state == 'failed' for state, _, _ in states)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO job_results (job_id, result) VALUES (?, ?)",
+                [(job_id, json.dumps(result)) for result in results],
+            )
+            self._conn.executemany("UPDATE job_titles SET state = ? WHERE job_id = ? AND position = ?", states)
+            (stats,) = self._conn.execute("SELECT stats FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            stats = json.loads(stats) if stats else {}
+            for name, value in counts.items():
+                stats[name] = stats.get(name, 0) + value
+            self._conn.execute(
+                "UPDATE jobs SET done = done + ?, failed = failed + ?, stats = ?, updated_at = ? WHERE id = ?",
+                (len(batch) - failed, failed, json.dumps(stats), time.time(), job_id),
+            )
+            self._conn.commit()
+
+    def _finish(self, job_id, status, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                (status, error, time.time(), job_id),
+            )
+            self._conn.commit()
+        metrics.increment(f'jobs_{status}')
+        metrics.log_snapshot('job_finished')
@@ -0,0 +1,252 @@
+import threading
+import time
+from collections import namedtuple
+
+from metrics import metrics
+from ratelimit import CircuitOpenError, backoff_delay, guard_for_key, is_rate_limit_error, is_retryable_error
+
+# One API key, the endpoint to call with it (None for the default) and its share of the traffic
+KeySpec = namedtuple('KeySpec', ['key', 'endpoint', 'weight'])
+
+
+def parse_api_keys(text):
+    """Parse comma- or newline-separated keys written as KEY, KEY@ENDPOINT or KEY*WEIGHT
+
+    A weight of 2 means the key has twice the configured per-minute quota
+    and is given twice the traffic.
+    """
+    specs = []
+    for entry in (text or '').replace('\n', ',').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        weight = 1.0
+        if '*' in entry:
+            entry, _, weight_text = entry.rpartition('*')
+            try:
+                weight = float(weight_text)
+            except ValueError:
+                raise ValueError(f"Invalid weight {weight_text!r} for an API key") from None
+            if weight <= 0:
+                raise ValueError("API key weights must be positive")
+        key, _, endpoint = entry.partition('@')
+        specs.append(KeySpec(key.strip(), endpoint.strip() or None, weight))
+    return specs
+
+
+def mask_key(key):
+    """Show only the end of a key, for logs and the UI"""
+    return f"…{key[-4:]}" if len(key) > 4 else "…"
+
+
+class PooledKey:
+    """A key in the pool: its spec, model, quota guard and routing state"""
+
+    def __init__(self, spec, model_factory, guard):
+        self.spec = spec
+        self.label = mask_key(spec.key) + (f"@{spec.endpoint}" if spec.endpoint else "")
+        self.guard = guard
+        self.in_flight = 0
+        self.calls = 0
+        self.drains = 0
+        self.drained_until = 0.0
+        self.consecutive_drains = 0
+        self._model_factory = model_factory
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._model_factory(self.spec)
+        return self._model
+
+    def available(self, now):
+        if now < self.drained_until:
+            return False
+        return self.guard is None or not self.guard.breaker.refusing_calls()
+
+
+class KeyClient:
+    """One API key's model and quota guard, with the same call() as a KeyPool
+
+    For callers that bring their own key rather than using the one the
+    engine is configured with. Retries are left to the guard, as for the
+    configured key.
+    """
+
+    def __init__(self, spec, model_factory, guard=None):
+        self.spec = spec
+        self.guard = guard
+        self._model_factory = model_factory
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                self._model = self._model_factory(self.spec)
+            return self._model
+
+    def call(self, fn, estimated_tokens, measure=None):
+        """Run `fn(model, guard)` on this key, through its guard if it has one"""
+        if self.guard is None:
+            return fn(self.model, None)
+        return self.guard.call(lambda: fn(self.model, self.guard), estimated_tokens, measure=measure)
+
+    def stats(self):
+        """The key's quota counters, or None without per-minute limits"""
+        return self.guard.stats() if self.guard else None
+
+
+class KeyPool:
+    """Spread Gemini calls over several API keys and endpoints
+
+    Every call goes to the available key with the least load: the calls
+    it has in flight relative to its weight, then the calls it has served.
+    Each key keeps its own client-side quota through the process-wide
+    ApiGuard for that key. A key that answers with a rate-limit error is
+    drained: it gets no traffic for `drain_seconds`, doubling on repeated
+    drains, and the call is retried at once on another key. Only when
+    every key is drained or failing does a call wait.
+    """
+
+    def __init__(self, specs, model_factory, requests_per_minute=None, tokens_per_minute=None,
+                 drain_seconds=30.0, max_drain_seconds=300.0, max_retries=5):
+        if not specs:
+            raise ValueError("A key pool needs at least one API key")
+        self.drain_seconds = drain_seconds
+        self.max_drain_seconds = max_drain_seconds
+        self.max_retries = max_retries
+        self.members = [
+            PooledKey(spec, model_factory, self._guard(spec, requests_per_minute, tokens_per_minute))
+            for spec in specs
+        ]
+        self.failovers = 0
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def _guard(spec, requests_per_minute, tokens_per_minute):
+        """The key's shared guard with its weighted share of the limits, or None without limits"""
+        if not (requests_per_minute and tokens_per_minute):
+            return None
+        return guard_for_key(
+            spec.key, max(1, int(requests_per_minute * spec.weight)), max(1, int(tokens_per_minute * spec.weight))
+        )
+
+    def set_limits(self, requests_per_minute, tokens_per_minute):
+        """Apply new per-minute limits to every key's guard"""
+        with self._condition:
+            for member in self.members:
+                member.guard = self._guard(member.spec, requests_per_minute, tokens_per_minute)
+
+    def __len__(self):
+        return len(self.members)
+
+    def _acquire(self):
+        """Pick the least-loaded available key, waiting if every key is drained"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                candidates = [member for member in self.members if member.available(now)]
+                if candidates:
+                    member = min(
+                        candidates,
+                        key=lambda m: ((m.in_flight + 1) / m.spec.weight, m.calls / m.spec.weight),
+                    )
+                    member.in_flight += 1
+                    member.calls += 1
+                    return member
+                # Wait for the first drain to run out (or a breaker to allow a probe)
+                wake_at = min(member.drained_until for member in self.members)
+                self._condition.wait(max(0.05, min(wake_at - now, 1.0)))
+
+    def _release(self, member, drained=False):
+        with self._condition:
+            member.in_flight -= 1
+            if drained:
+                member.consecutive_drains += 1
+                member.drains += 1
+                member.drained_until = time.monotonic() + min(
+                    self.max_drain_seconds, self.drain_seconds * 2 ** (member.consecutive_drains - 1)
+                )
+            else:
+                member.consecutive_drains = 0
+            self._condition.notify_all()
+
+    def call(self, fn, estimated_tokens, measure=None):
+        """Run `fn(model, guard)` on the best key, failing over to others on quota and server errors"""
+        for attempt in range(self.max_retries + 1):
+            member = self._acquire()
+            drained = False
+            try:
+                if member.guard is None:
+                    return fn(member.model, None)
+                # The pool does the retrying, on whichever key is best at the time
+                return member.guard.call(
+                    lambda: fn(member.model, member.guard), estimated_tokens, measure=measure, max_retries=0
+                )
+            except Exception as e:
+                if not (is_retryable_error(e) or isinstance(e, CircuitOpenError)):
+                    raise
+                drained = is_rate_limit_error(e)
+                if drained:
+                    metrics.increment('key_drains')
+                if attempt == self.max_retries:
+                    raise
+                with self._condition:
+                    self.failovers += 1
+                metrics.increment('key_failovers')
+            finally:
+                self._release(member, drained)
+            # Back off once every key has had a go at a failing call
+            if not drained and attempt + 1 >= len(self.members):
+                time.sleep(backoff_delay(attempt + 1 - len(self.members)))
+
+    def stats(self):
+        """Quota counters summed over the pool, plus a row per key"""
+        now = time.monotonic()
+        keys = []
+        totals = {'requests': 0, 'tokens': 0, 'retries': 0, 'rate_limited': 0, 'errors': 0, 'throttled_seconds': 0.0,
+                  'circuit_trips': 0}
+        open_circuits = 0
+        with self._condition:
+            for member in self.members:
+                guard_stats = member.guard.stats() if member.guard else {}
+                for name in totals:
+                    totals[name] += guard_stats.get(name, 0)
+                open_circuits += guard_stats.get('circuit') == 'open'
+                keys.append({
+                    'key': member.label,
+                    'weight': member.spec.weight,
+                    'in_flight': member.in_flight,
+                    'calls': member.calls,
+                    'drains': member.drains,
+                    'drained_seconds_left': max(0.0, member.drained_until - now),
+                    'requests': guard_stats.get('requests', member.calls),
+                    'rate_limited': guard_stats.get('rate_limited', 0),
+                })
+        totals['retries'] += self.failovers
+        totals['circuit'] = 'closed' if not open_circuits else f"open on {open_circuits} of {len(self.members)} keys"
+        totals['keys'] = keys
+        totals['drained'] = sum(1 for key in keys if key['drained_seconds_left'] > 0)
+        return totals
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool_for_keys(specs, model_factory, requests_per_minute=None, tokens_per_minute=None):
+    """Return the process-wide pool for a set of keys, so every session using them shares it
+
+    Limits given here replace the pool's current ones, on the keys' shared guards.
+    """
+    pool_id = tuple(specs)
+    with _pools_lock:
+        pool = _pools.get(pool_id)
+        if pool is None:
+            pool = _pools[pool_id] = KeyPool(specs, model_factory, requests_per_minute, tokens_per_minute)
+        elif requests_per_minute and tokens_per_minute:
+            pool.set_limits(requests_per_minute, tokens_per_minute)
+        return pool
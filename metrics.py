@@ -0,0 +1,122 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger("classifier.metrics")
+
+# Recent durations kept per span for percentiles
+SPAN_SAMPLES = 1024
+
+
+class _SpanStats:
+    __slots__ = ('count', 'total', 'max', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SPAN_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def summary(self):
+        ordered = sorted(self.samples)
+
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else 0.0,
+            'p50_seconds': percentile(0.50),
+            'p95_seconds': percentile(0.95),
+            'max_seconds': self.max,
+        }
+
+
+class Metrics:
+    """Thread-safe process-wide counters and timing spans
+
+    Counters only go up (characters sent, parse failures, cache hits...).
+    Spans time a stage of the pipeline and keep a count, the total and
+    recent samples for percentiles. Everything can be read back as a dict,
+    as one JSON log line or as Prometheus text exposition format.
+    """
+
+    def __init__(self, prefix='classifier'):
+        self.prefix = prefix
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._spans = {}
+
+    def increment(self, name, amount=1):
+        if not amount:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = _SpanStats()
+            span.add(seconds)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as one sample of the named span, even if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started_at,
+                'counters': dict(sorted(self._counters.items())),
+                'spans': {name: span.summary() for name, span in sorted(self._spans.items())},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._counters.clear()
+            self._spans.clear()
+
+    def log_snapshot(self, event='metrics'):
+        """Emit the current snapshot as one structured JSON log line"""
+        logger.info(json.dumps(dict(self.snapshot(), event=event), sort_keys=True))
+
+    def to_prometheus(self):
+        """Render counters and spans in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot['counters'].items():
+            metric = f"{self.prefix}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        if snapshot['spans']:
+            metric = f"{self.prefix}_stage_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for name, summary in snapshot['spans'].items():
+                lines += [
+                    f'{metric}{{stage="{name}",quantile="0.5"}} {summary["p50_seconds"]:.6f}',
+                    f'{metric}{{stage="{name}",quantile="0.95"}} {summary["p95_seconds"]:.6f}',
+                    f'{metric}_sum{{stage="{name}"}} {summary["total_seconds"]:.6f}',
+                    f'{metric}_count{{stage="{name}"}} {summary["count"]}',
+                ]
+        return "\n".join(lines) + "\n"
+
+
+# Shared by the engine, the cache and the UI
+metrics = Metrics()
@@ -0,0 +1,134 @@
+import threading
+
+# Gemini tokenizers average roughly four characters per token for English text
+CHARS_PER_TOKEN = 4
+
+# gemini-1.5-flash refuses max_output_tokens above this
+MODEL_MAX_OUTPUT_TOKENS = 8192
+
+# Estimated output tokens for one batch result object: JSON keys, title_number,
+# the strategy name and a 2-3 sentence description. The echoed title is added
+# per title, and each enabled optional field adds its own share.
+BASE_RESULT_TOKENS = 110
+# The same for the compact schema: {"title_number": n, "strategy_number": n}, with no echoed title
+COMPACT_RESULT_TOKENS = 16
+OPTIONAL_FIELD_TOKENS = {
+    'include_confidence': 8,
+    'include_keywords': 30,
+    'include_field_suggestions': 30,
+}
+
+
+def estimate_tokens(text):
+    """Cheap token estimate for a piece of text"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class BatchPacker:
+    """Packs titles into batch requests sized by an output token budget
+
+    Each title is charged its expected share of the response: a fixed cost
+    per result object, the echoed title and the enabled optional fields.
+    Titles are added to a batch until the estimate reaches the budget.
+    After every response the packer compares the real response size with
+    its estimate and keeps a running correction factor. Truncated
+    responses push the factor up sharply so the next batches shrink.
+
+    With compact=True titles are charged for the compact schema, which
+    echoes neither the title nor a description, so several times as many
+    fit in a batch; max_titles defaults to 150 rather than 50 to match.
+    """
+
+    def __init__(self, include_confidence, include_keywords, include_field_suggestions,
+                 output_token_budget=4000, max_titles=None, prompt_token_budget=30000,
+                 headroom=1.25, smoothing=0.3, compact=False):
+        self.output_token_budget = output_token_budget
+        self.max_titles = max_titles or (150 if compact else 50)
+        self.prompt_token_budget = prompt_token_budget
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.compact = compact
+        self.per_result_tokens = COMPACT_RESULT_TOKENS if compact else BASE_RESULT_TOKENS
+        if include_confidence:
+            self.per_result_tokens += OPTIONAL_FIELD_TOKENS['include_confidence']
+        if include_keywords:
+            self.per_result_tokens += OPTIONAL_FIELD_TOKENS['include_keywords']
+        if include_field_suggestions:
+            self.per_result_tokens += OPTIONAL_FIELD_TOKENS['include_field_suggestions']
+
+        self.correction = 1.0
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._titles = 0
+        self._truncations = 0
+
+    def _raw_title_output(self, title):
+        # Compact responses do not echo the title
+        return self.per_result_tokens + (0 if self.compact else estimate_tokens(title))
+
+    def estimate_title_output(self, title):
+        """Expected response tokens for one title, including the learned correction"""
+        return self._raw_title_output(title) * self.correction
+
+    def estimate_batch_output(self, titles):
+        return sum(self.estimate_title_output(title) for title in titles)
+
+    def _uncorrected_estimate(self, titles):
+        return sum(self._raw_title_output(title) for title in titles)
+
+    def max_output_tokens(self, titles):
+        """max_output_tokens to request for a batch, leaving headroom over the estimate"""
+        requested = max(self.estimate_batch_output(titles) * self.headroom, self.output_token_budget)
+        return int(min(requested, MODEL_MAX_OUTPUT_TOKENS))
+
+    def pack(self, items, key=None):
+        """Yield lists of items whose titles fit the token budget
+
+        `items` may be any iterable; `key` extracts the title from an item.
+        Items are consumed lazily, so very long inputs are never held in memory.
+        """
+        batch = []
+        batch_output = 0.0
+        batch_prompt = 0
+        for item in items:
+            title = key(item) if key else item
+            title_output = self.estimate_title_output(title)
+            # Each title also appears once in the numbered prompt list
+            title_prompt = estimate_tokens(title) + 4
+            if batch and (
+                batch_output + title_output > self.output_token_budget
+                or batch_prompt + title_prompt > self.prompt_token_budget
+                or len(batch) >= self.max_titles
+            ):
+                yield batch
+                batch, batch_output, batch_prompt = [], 0.0, 0
+            batch.append(item)
+            batch_output += title_output
+            batch_prompt += title_prompt
+        if batch:
+            yield batch
+
+    def observe(self, titles, response_text, truncated=False):
+        """Update the correction factor from a batch response"""
+        estimated = self._uncorrected_estimate(titles)
+        with self._lock:
+            self._batches += 1
+            self._titles += len(titles)
+            if truncated:
+                self._truncations += 1
+                # A cut-off response only tells us the real size was larger
+                self.correction *= 1.5
+            elif response_text and estimated > 0:
+                observed_ratio = estimate_tokens(response_text) / estimated
+                self.correction += self.smoothing * (observed_ratio - self.correction)
+            self.correction = min(max(self.correction, 0.25), 8.0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'titles': self._titles,
+                'avg_titles_per_batch': self._titles / self._batches if self._batches else 0.0,
+                'truncations': self._truncations,
+                'correction': self.correction,
+            }
@@ -0,0 +1,202 @@
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics
+from taxonomy import TAXONOMY
+
+TOKEN_PATTERN = re.compile(r"[a-z][a-z0-9]+")
+STOPWORDS = frozenset("""
+a about across after against all along also among an and any are as at based be between beyond both
+but by can could do does during each for from has have how in including into is it its like more
+most new non not novel of on or other over rather than that the their these this those through to
+toward towards under understanding using via was we what when where which while with within without
+""".split())
+
+# Weight of a strategy's own name and description relative to one labelled title
+DESCRIPTION_WEIGHT = 3.0
+
+
+def tokenize(text):
+    """Lowercase content words of a title or description, with a light plural strip"""
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def strategy_key(name):
+    """Comparable form of a strategy name, ignoring numbering, case and punctuation"""
+    name = re.sub(r'^\d+[\.\-\s]*', '', name or '')
+    return ' '.join(re.findall(r'[a-z0-9]+', name.lower()))
+
+
+class PreClassifier:
+    """Local TF-IDF nearest-centroid classifier for obvious titles
+
+    Each strategy gets a centroid built from its name and description in
+    the prompt plus any titles already labelled with it (e.g. from the
+    classification cache). A batch of titles is scored against all
+    centroids in one sparse-times-dense matrix product. A title is accepted
+    locally only when its best cosine similarity reaches `min_score` and
+    beats the runner-up by at least `min_margin`; everything else is left
+    for Gemini.
+    """
+
+    def __init__(self, strategies, labelled_titles=(), min_score=0.35, min_margin=0.12):
+        self.strategies = list(strategies)
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self._strategy_index = {strategy_key(name): i for i, (name, _) in enumerate(self.strategies)}
+        self._lock = threading.Lock()
+        self._scored = 0
+        self._accepted = 0
+        self.labelled = 0
+        self._fit(labelled_titles)
+
+    def strategy_index(self, name):
+        """Index of the strategy with this name, or None if it is not one of ours"""
+        return self._strategy_index.get(strategy_key(name))
+
+    def _fit(self, labelled_titles):
+        # Names are repeated so they weigh more than a long description
+        documents = [tokenize(f"{name} {name} {description}") for name, description in self.strategies]
+        labels = list(range(len(self.strategies)))
+        for title, strategy in labelled_titles:
+            index = self.strategy_index(strategy)
+            if index is not None:
+                documents.append(tokenize(title))
+                labels.append(index)
+        self.labelled = len(labels) - len(self.strategies)
+
+        self.vocabulary = {}
+        for tokens in documents:
+            for token in tokens:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+        rows, cols = self._term_coordinates(documents)
+
+        # Smoothed inverse document frequency, as in scikit-learn
+        document_frequency = np.zeros(len(self.vocabulary))
+        np.add.at(document_frequency, np.unique(np.stack([rows, cols]), axis=1)[1], 1)
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+
+        weights = self._normalized_weights(rows, cols, len(documents))
+        # Description documents get a fixed weight, labelled titles add up
+        document_weight = np.where(rows < len(self.strategies), DESCRIPTION_WEIGHT, 1.0)
+        centroids = np.zeros((len(self.vocabulary), len(self.strategies)))
+        np.add.at(centroids, (cols, np.asarray(labels)[rows]), weights * document_weight)
+        norms = np.linalg.norm(centroids, axis=0)
+        self.centroids = centroids / np.where(norms > 0, norms, 1)
+
+    def _term_coordinates(self, documents):
+        """(document, term) index pairs for every known token occurrence"""
+        rows, cols = [], []
+        for row, tokens in enumerate(documents):
+            for token in tokens:
+                col = self.vocabulary.get(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        return np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+
+    def _normalized_weights(self, rows, cols, document_count):
+        """L2-normalized TF-IDF weight of each (document, term) occurrence
+
+        Repeated occurrences each carry a share, so summing them gives the
+        term frequency times the IDF.
+        """
+        weights = self.idf[cols]
+        # Squared norm of each document: sum over distinct terms of (tf * idf)^2
+        pairs, counts = np.unique(np.stack([rows, cols]), axis=1, return_counts=True)
+        squared = np.zeros(document_count)
+        np.add.at(squared, pairs[0], (counts * self.idf[pairs[1]]) ** 2)
+        norms = np.sqrt(squared)
+        return weights / np.where(norms > 0, norms, 1)[rows]
+
+    def score(self, titles):
+        """Cosine similarity of every title to every strategy centroid, shape (titles, strategies)"""
+        rows, cols = self._term_coordinates([tokenize(title) for title in titles])
+        scores = np.zeros((len(titles), len(self.strategies)))
+        if len(rows):
+            weights = self._normalized_weights(rows, cols, len(titles))
+            np.add.at(scores, rows, weights[:, None] * self.centroids[cols])
+        return scores
+
+    def split(self, titles, min_score=None, min_margin=None):
+        """Separate titles that can be classified locally from those that need Gemini
+
+        Returns ({title index: (strategy index, score, runner-up index)}, [ambiguous title indexes]).
+        """
+        min_score = self.min_score if min_score is None else min_score
+        min_margin = self.min_margin if min_margin is None else min_margin
+        if not titles:
+            return {}, []
+
+        with metrics.span('prefilter'):
+            scores = self.score(titles)
+        ranked = np.argsort(-scores, axis=1)
+        best, runner_up = ranked[:, 0], ranked[:, 1]
+        rows = np.arange(len(titles))
+        best_scores = scores[rows, best]
+        confident = (best_scores >= min_score) & (best_scores - scores[rows, runner_up] >= min_margin)
+
+        accepted = {
+            int(i): (int(best[i]), float(best_scores[i]), int(runner_up[i]))
+            for i in np.flatnonzero(confident)
+        }
+        ambiguous = [int(i) for i in np.flatnonzero(~confident)]
+        with self._lock:
+            self._scored += len(titles)
+            self._accepted += len(accepted)
+        metrics.increment('prefilter_accepted', len(accepted))
+        metrics.increment('prefilter_forwarded', len(ambiguous))
+        return accepted, ambiguous
+
+    def make_result(self, title, prediction, include_confidence, include_keywords, include_field_suggestions):
+        """Build a result dict shaped like Gemini's for a locally accepted title
+
+        There is no model-written description or related fields to give, so
+        both are left empty; classified_by marks the result as local.
+        """
+        strategy, score, _ = prediction
+        name = self.strategies[strategy][0]
+        result = {
+            'title': title,
+            'primary_strategy': f"{strategy + 1}. {name}",
+            'strategy_description': '',
+            'classified_by': 'prefilter',
+        }
+        if include_confidence:
+            result['confidence_score'] = min(10, max(1, round(score * 10)))
+        if include_keywords:
+            result['keywords'] = self._matching_terms(title, strategy)
+        if include_field_suggestions:
+            result['related_fields'] = []
+        result['timestamp'] = datetime.now().isoformat()
+        result['taxonomy_version'] = TAXONOMY.version
+        return result
+
+    def _matching_terms(self, title, strategy, limit=5):
+        """Title words that contributed most to the match"""
+        words = {}
+        for word in re.findall(r"[A-Za-z][A-Za-z0-9\-]+", title):
+            tokens = tokenize(word)
+            col = self.vocabulary.get(tokens[0]) if tokens else None
+            if col is not None and word.lower() not in words:
+                words[word.lower()] = self.idf[col] * self.centroids[col, strategy]
+        return [word for word, weight in sorted(words.items(), key=lambda item: -item[1]) if weight > 0][:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'scored': self._scored,
+                'accepted': self._accepted,
+                'accept_rate': self._accepted / self._scored if self._scored else 0.0,
+                'labelled_titles': self.labelled,
+            }
@@ -0,0 +1,288 @@
+import hashlib
+import random
+import threading
+import time
+
+from metrics import metrics
+
+# HTTP status codes worth retrying: rate limited and transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'InternalServerError', 'ServiceUnavailable',
+    'DeadlineExceeded', 'GatewayTimeout', 'BadGateway',
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+
+def error_status(error):
+    """HTTP status code of an API error, if it carries one"""
+    code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def is_rate_limit_error(error):
+    return error_status(error) == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+
+def is_retryable_error(error):
+    """Whether an API error is transient and worth retrying"""
+    if error_status(error) in RETRYABLE_STATUS_CODES:
+        return True
+    if type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    message = str(error)
+    return any(marker in message for marker in ('429', 'Resource has been exhausted', '503', '500 Internal'))
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_minute`
+
+    An idle client can burst up to `capacity` tokens and is then paced at
+    the refill rate.
+    """
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """Block until `amount` tokens are available, take them and return the seconds waited"""
+        # A request larger than the whole bucket could never be served otherwise
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        with self._condition:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate_per_second
+                started = time.monotonic()
+                self._condition.wait(delay)
+                waited += time.monotonic() - started
+
+    def refund(self, amount):
+        """Give back tokens that were reserved but not used"""
+        with self._condition:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+            self._condition.notify_all()
+
+    def set_rate(self, rate_per_minute, capacity):
+        """Change the refill rate and capacity, keeping the bucket as full, proportionally, as it was"""
+        with self._condition:
+            self._refill()
+            self._tokens = self._tokens * capacity / self.capacity
+            self.rate_per_second = rate_per_minute / 60.0
+            self.capacity = capacity
+            self._condition.notify_all()
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server reports the quota is exhausted"""
+        with self._condition:
+            self._refill()
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class CircuitBreaker:
+    """Stops calls after repeated failures and lets a probe through after a cool-down
+
+    closed: calls flow normally. open: calls fail fast with CircuitOpenError
+    until `reset_timeout` seconds have passed. half-open: one probe call is
+    allowed; its success closes the circuit, its failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.trips = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'half-open' and self._probing:
+                raise CircuitOpenError("Gemini is failing repeatedly; waiting for a test request to succeed")
+            if self.state == 'open':
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(
+                        f"Gemini is failing repeatedly; pausing requests for {remaining:.0f}s"
+                    )
+                self.state = 'half-open'
+                self._probing = True
+
+    def refusing_calls(self):
+        """Whether before_call() would currently raise CircuitOpenError"""
+        with self._lock:
+            if self.state == 'half-open':
+                return self._probing
+            return self.state == 'open' and time.monotonic() < self._opened_at + self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._probing = False
+            self._failures += 1
+            if self.state == 'half-open' or self._failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+class ApiGuard:
+    """Client-side quota enforcement for one API key
+
+    Each per-minute limit is split into a small burst allowance and a
+    refill rate that together never exceed the limit in any 60-second
+    window, so the client stays under a sliding-window server quota. Every
+    call reserves one request and its estimated tokens from the buckets,
+    then settles the token reservation once the actual usage is known.
+    Retryable errors are retried with jittered exponential backoff. A 429 also drains the request bucket so concurrent callers
+    slow down together. Repeated failures open the circuit breaker.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retries=5, burst_fraction=0.1,
+                 backoff_base=1.0, backoff_cap=60.0, failure_threshold=5, reset_timeout=30.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.burst_fraction = burst_fraction
+        self.requests = TokenBucket(*self._bucket_size(requests_per_minute, burst_fraction))
+        self.tokens = TokenBucket(*self._bucket_size(tokens_per_minute, burst_fraction))
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'tokens': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'errors': 0,
+            'throttled_seconds': 0.0,
+        }
+
+    @staticmethod
+    def _bucket_size(limit_per_minute, burst_fraction):
+        """(refill rate, capacity) of a bucket that never exceeds the limit in any minute"""
+        burst = max(1, int(limit_per_minute * burst_fraction))
+        return max(limit_per_minute - burst, 1), burst
+
+    def set_limits(self, requests_per_minute, tokens_per_minute):
+        """Change the per-minute limits in place, rescaling the buckets rather than replacing them"""
+        with self._lock:
+            if (requests_per_minute, tokens_per_minute) == (self.requests_per_minute, self.tokens_per_minute):
+                return
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+        self.requests.set_rate(*self._bucket_size(requests_per_minute, self.burst_fraction))
+        self.tokens.set_rate(*self._bucket_size(tokens_per_minute, self.burst_fraction))
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+        for name in ('retries', 'rate_limited', 'throttled_seconds'):
+            if name in amounts:
+                metrics.increment(f"quota_{name}", amounts[name])
+
+    def call(self, fn, estimated_tokens, measure=None, max_retries=None):
+        """Run `fn()` within the quota, retrying transient errors
+
+        `measure(result)` may return the tokens the call really used, which
+        replaces the estimate in the token bucket. `max_retries` overrides
+        the guard's own retry limit, e.g. 0 when the caller fails over to
+        another key instead.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            self.breaker.before_call()
+            waited = self.requests.acquire(1) + self.tokens.acquire(estimated_tokens)
+            self._count(throttled_seconds=waited)
+            try:
+                result = fn()
+            except Exception as e:
+                self.tokens.refund(estimated_tokens)
+                if not is_retryable_error(e):
+                    # The service answered (e.g. a bad request), so it is not unhealthy
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                rate_limited = is_rate_limit_error(e)
+                self._count(errors=1, rate_limited=int(rate_limited))
+                if rate_limited:
+                    self.requests.drain()
+                if attempt == max_retries:
+                    raise
+                self._count(retries=1)
+                time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+                continue
+
+            self.breaker.record_success()
+            self._count(requests=1, tokens=estimated_tokens)
+            if measure:
+                self.settle(estimated_tokens, measure(result))
+            return result
+
+    def settle(self, reserved_tokens, used_tokens):
+        """Replace a token reservation with the usage measured after the call"""
+        if used_tokens < reserved_tokens:
+            self.tokens.refund(reserved_tokens - used_tokens)
+        self._count(tokens=used_tokens - reserved_tokens)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['circuit'] = self.breaker.state
+        stats['circuit_trips'] = self.breaker.trips
+        stats['requests_per_minute'] = self.requests_per_minute
+        stats['tokens_per_minute'] = self.tokens_per_minute
+        return stats
+
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def guard_for_key(api_key, requests_per_minute, tokens_per_minute):
+    """Return the process-wide ApiGuard for an API key, so every user of a key shares its quota
+
+    There is exactly one guard per key. Asking for it with other limits
+    updates that guard in place, so callers with different settings still
+    draw on the same buckets and together stay within the key's quota.
+    """
+    key_id = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()
+    with _guards_lock:
+        guard = _guards.get(key_id)
+        if guard is None:
+            guard = _guards[key_id] = ApiGuard(requests_per_minute, tokens_per_minute)
+        else:
+            guard.set_limits(requests_per_minute, tokens_per_minute)
+        return guard
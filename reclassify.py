@@ -0,0 +1,91 @@
+"""Pick the stored results a taxonomy edit may have changed
+
+Editing one strategy description changes the prompt, so every cached
+result expires, yet most titles would get the same answer again. Results
+are tagged with the taxonomy version they were produced under; comparing
+that version's strategies (from the TaxonomyRegistry) with the current
+ones shows which entries changed, and only titles that touch one of them
+are sent again.
+"""
+import numpy as np
+
+from metrics import metrics
+from taxonomy import TAXONOMY
+
+
+class Reclassifier:
+    """Keep stored results a taxonomy edit cannot have changed, send the rest again
+
+    A result produced under an older registered taxonomy is sent again
+    when its strategy was edited, renumbered or removed, or when the local
+    pre-score of its title (a PreClassifier over the current taxonomy)
+    ranks a changed or added strategy first or second, since the title may
+    now belong there. Without a pre-classifier only the first check is
+    made. Results tagged with an unknown version are always sent again,
+    as are untagged ones unless `assume_version` names the version they
+    were produced under. Kept results are retagged with the current
+    version.
+    """
+
+    def __init__(self, registry, taxonomy=TAXONOMY, pre_classifier=None, assume_version=None):
+        if pre_classifier is not None and len(pre_classifier.strategies) != len(taxonomy):
+            raise ValueError("The pre-classifier must score against the current taxonomy")
+        self.registry = registry
+        self.taxonomy = taxonomy
+        self.pre_classifier = pre_classifier
+        self.assume_version = assume_version
+        self._changes = {}
+        self.counts = {'current': 0, 'kept': 0, 'strategy_changed': 0, 'prescore': 0, 'unknown_version': 0}
+
+    def changes(self, version):
+        """(older taxonomy, changed positions) for a stored version, or None if it is not registered"""
+        if version not in self._changes:
+            older = self.registry.get(version)
+            self._changes[version] = None if older is None else (older, self.taxonomy.changed_since(older))
+        return self._changes[version]
+
+    def split(self, results):
+        """Split stored results; returns (results to keep, indices of results to classify again)"""
+        kept = []
+        resend = []
+        to_score = []
+        for index, result in enumerate(results):
+            version = result.get('taxonomy_version') or self.assume_version
+            if version == self.taxonomy.version:
+                self.counts['current'] += 1
+                kept.append(dict(result, taxonomy_version=version))
+                continue
+            changes = self.changes(version) if version else None
+            if changes is None:
+                self.counts['unknown_version'] += 1
+                resend.append(index)
+                continue
+            older, changed = changes
+            strategy = older.index(result.get('primary_strategy'))
+            if strategy is None or strategy in changed:
+                self.counts['strategy_changed'] += 1
+                resend.append(index)
+            else:
+                to_score.append((index, changed))
+
+        if to_score and self.pre_classifier is not None:
+            with metrics.span('reclassify_prescore'):
+                scores = self.pre_classifier.score([results[index].get('title', '') for index, _ in to_score])
+            top_two = np.argsort(-scores, axis=1)[:, :2]
+        for row, (index, changed) in enumerate(to_score):
+            if self.pre_classifier is not None and changed.intersection(top_two[row].tolist()):
+                self.counts['prescore'] += 1
+                resend.append(index)
+            else:
+                self.counts['kept'] += 1
+                kept.append(dict(results[index], taxonomy_version=self.taxonomy.version))
+
+        metrics.increment('reclassify_kept', len(kept))
+        metrics.increment('reclassify_resent', len(resend))
+        return kept, sorted(resend)
+
+    def stats(self):
+        """Results kept and sent again, by reason"""
+        counts = dict(self.counts)
+        counts['resent'] = counts['strategy_changed'] + counts['prescore'] + counts['unknown_version']
+        return counts
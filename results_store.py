@@ -0,0 +1,308 @@
+import heapq
+import itertools
+import json
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from engine import clean_strategy_name
+
+# Result fields kept as attributes; anything else goes into `extra`
+RECORD_FIELDS = (
+    'title', 'primary_strategy', 'strategy_description', 'confidence_score',
+    'keywords', 'related_fields', 'classified_by', 'timestamp',
+)
+
+# Orders page() can return results in
+SORT_ORDERS = ('newest', 'oldest', 'confidence_desc', 'confidence_asc')
+
+_SQL_ORDER = {
+    'newest': "seq DESC",
+    'oldest': "seq",
+    'confidence_desc': "confidence IS NULL, confidence DESC, seq DESC",
+    'confidence_asc': "confidence IS NULL, confidence, seq DESC",
+}
+
+
+def confidence_value(value):
+    """A confidence score as a float, or None when it is missing or not a number"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _sort_key(sort, position, confidence):
+    """The Python equivalent of _SQL_ORDER for one result"""
+    if sort == 'newest':
+        return (-position,)
+    if sort == 'oldest':
+        return (position,)
+    if confidence is None:
+        return (True, 0.0, -position)
+    return (False, -confidence if sort == 'confidence_desc' else confidence, -position)
+
+
+class ResultRecord:
+    """Compact form of one classification result
+
+    Strategy names are normalized once here ("1. Name" becomes "Name"), so
+    exports never clean them again, and interned, so every record shares
+    the same string objects. Lists become tuples.
+    """
+
+    __slots__ = RECORD_FIELDS + ('extra',)
+
+    def __init__(self, title=None, primary_strategy=None, strategy_description=None, confidence_score=None,
+                 keywords=None, related_fields=None, classified_by=None, timestamp=None, extra=None):
+        self.title = title
+        self.primary_strategy = (
+            sys.intern(clean_strategy_name(primary_strategy)) if isinstance(primary_strategy, str) else primary_strategy
+        )
+        self.strategy_description = strategy_description
+        self.confidence_score = confidence_score
+        self.keywords = tuple(keywords) if isinstance(keywords, list) else keywords
+        self.related_fields = (
+            tuple(sys.intern(field) if isinstance(field, str) else field for field in related_fields)
+            if isinstance(related_fields, list) else related_fields
+        )
+        self.classified_by = sys.intern(classified_by) if isinstance(classified_by, str) else classified_by
+        self.timestamp = timestamp
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, result):
+        fields = {name: result[name] for name in RECORD_FIELDS if name in result}
+        extra = {name: value for name, value in result.items() if name not in RECORD_FIELDS}
+        return cls(extra=extra, **fields)
+
+    def to_dict(self):
+        """The result as the dict the engine produced; fields that were absent stay absent"""
+        result = {}
+        for name in RECORD_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = list(value) if isinstance(value, tuple) else value
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+
+class ResultsStore:
+    """A session's classification history with bounded memory use
+
+    The newest `window` results stay in memory as ResultRecords. When the
+    window overflows, its older half is spilled to a SQLite file shared by
+    all sessions, keyed by this store's session id. page() reads newest
+    first across both, so the history view never loads the whole history.
+    Spilled rows older than `max_age` seconds are pruned when a store opens
+    the file.
+
+    page() and count() take the same filters: a strategy, a minimum
+    confidence and a `start` position, so one run's results can be viewed
+    on their own. Sorting by confidence merges the sort keys of both tiers
+    and only then loads the results on the requested page.
+    """
+
+    def __init__(self, path, window=1000, max_age=7 * 24 * 3600):
+        self.path = path
+        self.window = max(2, window)
+        self.max_age = max_age
+        self.session_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._records = []
+        self._spilled = 0
+        self._conn = None
+
+    def __len__(self):
+        with self._lock:
+            return self._spilled + len(self._records)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @property
+    def spilled(self):
+        """How many results live on disk rather than in memory"""
+        return self._spilled
+
+    def append(self, result):
+        self.extend([result])
+
+    def extend(self, results):
+        records = [ResultRecord.from_dict(result) for result in results]
+        if not records:
+            return
+        with self._lock:
+            self._records.extend(records)
+            if len(self._records) > self.window:
+                self._spill(len(self._records) - self.window // 2)
+
+    def _spill(self, count):
+        """Move the oldest `count` in-memory records to SQLite (caller holds the lock)"""
+        conn = self._connection()
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO results (session, seq, title, primary_strategy, confidence, result, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (self.session_id, self._spilled + offset, record.title, record.primary_strategy,
+                 confidence_value(record.confidence_score), json.dumps(record.to_dict()), now)
+                for offset, record in enumerate(self._records[:count])
+            ],
+        )
+        conn.commit()
+        del self._records[:count]
+        self._spilled += count
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    session TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    title TEXT,
+                    primary_strategy TEXT,
+                    confidence REAL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (session, seq)
+                )
+                """
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(results)")}
+            if 'confidence' not in columns:
+                # Files written before results could be sorted by confidence
+                self._conn.execute("ALTER TABLE results ADD COLUMN confidence REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_created_at ON results (created_at)")
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.max_age,))
+            self._conn.commit()
+        return self._conn
+
+    def _recent_matches(self, strategy, min_confidence, start):
+        """(position, confidence, record) of in-memory records passing the filters (caller holds the lock)"""
+        matches = []
+        for position, record in enumerate(self._records[max(0, start - self._spilled):],
+                                          max(start, self._spilled)):
+            if strategy is not None and record.primary_strategy != strategy:
+                continue
+            confidence = confidence_value(record.confidence_score)
+            if min_confidence is not None and (confidence is None or confidence < min_confidence):
+                continue
+            matches.append((position, confidence, record))
+        return matches
+
+    def _spilled_filter(self, strategy, min_confidence, start):
+        query = " WHERE session = ?"
+        params = [self.session_id]
+        if strategy is not None:
+            query += " AND primary_strategy = ?"
+            params.append(strategy)
+        if min_confidence is not None:
+            query += " AND confidence >= ?"
+            params.append(min_confidence)
+        if start:
+            query += " AND seq >= ?"
+            params.append(start)
+        return query, params
+
+    def page(self, offset=0, limit=10, strategy=None, min_confidence=None, sort='newest', start=0):
+        """Up to `limit` result dicts in `sort` order, skipping the first `offset` matches
+
+        Only results at position `start` or later, with this primary_strategy
+        and with at least `min_confidence`, count as matches.
+        """
+        if sort not in SORT_ORDERS:
+            raise ValueError(f"Unknown sort order: {sort}")
+        with self._lock:
+            recent = [
+                (_sort_key(sort, position, confidence), position, record)
+                for position, confidence, record in self._recent_matches(strategy, min_confidence, start)
+            ]
+            recent.sort(key=lambda item: item[0])
+            spilled = []
+            if self._spilled > start:
+                # Only sort keys are read for the rows ahead of the page
+                query, params = self._spilled_filter(strategy, min_confidence, start)
+                spilled = [
+                    (_sort_key(sort, seq, confidence), seq, None)
+                    for seq, confidence in self._connection().execute(
+                        f"SELECT seq, confidence FROM results{query} ORDER BY {_SQL_ORDER[sort]} LIMIT ?",
+                        params + [offset + limit],
+                    )
+                ]
+            chosen = list(itertools.islice(
+                heapq.merge(recent, spilled, key=lambda item: item[0]), offset, offset + limit
+            ))
+            spilled_seqs = [position for _, position, record in chosen if record is None]
+            loaded = {}
+            if spilled_seqs:
+                placeholders = ", ".join("?" * len(spilled_seqs))
+                loaded = {
+                    seq: json.loads(result) for seq, result in self._connection().execute(
+                        f"SELECT seq, result FROM results WHERE session = ? AND seq IN ({placeholders})",
+                        [self.session_id] + spilled_seqs,
+                    )
+                }
+        return [record.to_dict() if record is not None else loaded[position] for _, position, record in chosen]
+
+    def count(self, strategy=None, min_confidence=None, start=0):
+        """How many results match the filters page() takes"""
+        if strategy is None and min_confidence is None:
+            return max(0, len(self) - start)
+        with self._lock:
+            total = len(self._recent_matches(strategy, min_confidence, start))
+            if self._spilled > start:
+                query, params = self._spilled_filter(strategy, min_confidence, start)
+                (spilled,) = self._connection().execute(f"SELECT COUNT(*) FROM results{query}", params).fetchone()
+                total += spilled
+        return total
+
+    def strategies(self):
+        """Distinct primary strategies in the history, sorted"""
+        with self._lock:
+            names = {record.primary_strategy for record in self._records}
+            if self._spilled:
+                names.update(row[0] for row in self._connection().execute(
+                    "SELECT DISTINCT primary_strategy FROM results WHERE session = ?", (self.session_id,)
+                ))
+        return sorted(name for name in names if name)
+
+    def __iter__(self):
+        return self.iter_results()
+
+    def iter_results(self, start=0, chunk_size=1000):
+        """Result dicts from position `start` on, oldest first, reading spilled rows in chunks
+
+        Only one chunk of dicts exists at a time, so exports of a long
+        history stay flat in memory.
+        """
+        with self._lock:
+            spilled = self._spilled
+            records = self._records[max(0, start - spilled):]
+        for chunk_start in range(start, spilled, chunk_size):
+            with self._lock:
+                rows = self._connection().execute(
+                    "SELECT result FROM results WHERE session = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                    (self.session_id, chunk_start, min(chunk_start + chunk_size, spilled)),
+                ).fetchall()
+            for (result,) in rows:
+                yield json.loads(result)
+        for record in records:
+            yield record.to_dict()
+
+    def clear(self):
+        """Forget every result of this session, in memory and on disk"""
+        with self._lock:
+            self._records = []
+            if self._spilled:
+                self._connection().execute("DELETE FROM results WHERE session = ?", (self.session_id,))
+                self._conn.commit()
+            self._spilled = 0
@@ -0,0 +1,434 @@
+"""Local HTTP/JSON classification service with request micro-batching
+
+Lets other systems classify titles without the web UI:
+
+    python server.py --port 8765
+    curl -s localhost:8765/classify -d '{"title": "Deep learning models of protein structure"}'
+
+Titles from concurrent requests that arrive within --max-wait seconds of
+each other are coalesced into one batch classification request, and
+each caller gets back only its own results. Under load, batches grow up
+to the packer's title and token limits instead of more requests being
+sent. The service holds at most --max-pending titles; beyond that
+requests are turned away with 503 and a Retry-After header.
+
+Endpoints:
+    POST /classify  {"title": ...} or {"titles": [...]}, optionally with
+                    include_confidence, include_keywords and
+                    include_field_suggestions
+    GET  /health    queue depth and batching counters as JSON
+    GET  /metrics   counters and stage timings in Prometheus text format
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import engine
+from cache import ClassificationCache
+from jobs import classify_batch
+from metrics import metrics
+from packing import BatchPacker
+from taxonomy import TaxonomyRegistry
+
+logger = logging.getLogger("classifier.server")
+
+OPTION_NAMES = ('include_confidence', 'include_keywords', 'include_field_suggestions')
+DEFAULT_OPTIONS = (True, True, False)
+
+# Request limits, checked before anything is queued
+MAX_BODY_BYTES = 1024 * 1024
+MAX_REQUEST_TITLES = 500
+MAX_TITLE_CHARS = 2000
+
+
+class ServiceBusy(Exception):
+    """Raised when the service already holds as many titles as it accepts"""
+
+
+class TitleNotClassified(Exception):
+    """Raised for a title the batch request came back without"""
+
+
+class _Group:
+    """Titles waiting to be sent with the same options, oldest first"""
+
+    def __init__(self, flags, packer):
+        self.flags = flags
+        self.packer = packer
+        self.waiting = []
+        self.output_tokens = 0.0
+
+    def add(self, title, future):
+        tokens = self.packer.estimate_title_output(title)
+        self.waiting.append((title, future, time.monotonic(), tokens))
+        self.output_tokens += tokens
+
+    def oldest(self):
+        return self.waiting[0][2]
+
+    def full(self):
+        return len(self.waiting) >= self.packer.max_titles or self.output_tokens >= self.packer.output_token_budget
+
+    def take(self):
+        """Remove and return the oldest titles that fit in one request"""
+        count = tokens = 0
+        for _, _, _, title_tokens in self.waiting:
+            if count and (count >= self.packer.max_titles or tokens + title_tokens > self.packer.output_token_budget):
+                break
+            count += 1
+            tokens += title_tokens
+        batch, self.waiting = self.waiting[:count], self.waiting[count:]
+        self.output_tokens -= tokens
+        return [(title, future) for title, future, _, _ in batch]
+
+
+class ClassificationService:
+    """Coalesce titles from many callers into few batch requests
+
+    submit() queues titles and returns a Future per title. A dispatcher
+    thread sends a group of titles with the same options once it fills a
+    request (the packer's max_titles or output token budget) or its oldest
+    title has waited `max_wait` seconds, and only while fewer than
+    `concurrency` batches are in flight, so batches get larger rather than
+    more numerous when requests pile up. Batches go through
+    jobs.classify_batch, so the cache and recovery of incomplete responses
+    apply. Titles are only merged when identical once canonicalized, never
+    as near-duplicates, since a batch mixes titles from different callers.
+    """
+
+    def __init__(self, cache=None, max_wait=0.05, max_pending=2000, concurrency=4, output_token_budget=4000,
+                 max_batch_size=None, compact=False, request_timeout=120.0):
+        self.cache = cache
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.output_token_budget = output_token_budget
+        self.max_batch_size = max_batch_size
+        self.compact = compact
+        self.request_timeout = request_timeout
+        self._condition = threading.Condition()
+        self._groups = {}
+        self._pending = 0
+        self._in_flight = 0
+        self._closed = False
+        self._counts = {'requests': 0, 'titles': 0, 'batches': 0, 'batched_titles': 0, 'rejected': 0, 'failed': 0}
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='classify')
+        self._dispatcher = threading.Thread(target=self._dispatch, name='dispatcher', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, titles, include_confidence=True, include_keywords=True, include_field_suggestions=False):
+        """Queue titles for the next batch; returns one Future per title
+
+        Raises ServiceBusy if they would take the service over `max_pending`
+        and TypeError if an include_* option is not a bool.
+        """
+        flags = (include_confidence, include_keywords, include_field_suggestions)
+        if not all(isinstance(flag, bool) for flag in flags):
+            raise TypeError("The include_* options must be true or false")
+        with self._condition:
+            if self._closed or self._pending + len(titles) > self.max_pending:
+                self._counts['rejected'] += 1
+                metrics.increment('service_rejected')
+                raise ServiceBusy("shutting down" if self._closed else
+                                  f"{self._pending} titles already waiting; {len(titles)} more would pass "
+                                  f"the limit of {self.max_pending}")
+            group = self._groups.get(flags)
+            if group is None:
+                group = self._groups[flags] = _Group(flags, BatchPacker(
+                    *flags, output_token_budget=self.output_token_budget, max_titles=self.max_batch_size,
+                    compact=self.compact,
+                ))
+            futures = []
+            for title in titles:
+                future = Future()
+                group.add(title, future)
+                futures.append(future)
+            self._pending += len(titles)
+            self._counts['requests'] += 1
+            self._counts['titles'] += len(titles)
+            self._condition.notify_all()
+        metrics.increment('service_requests')
+        metrics.increment('service_titles', len(titles))
+        return futures
+
+    def _next_batch(self, now):
+        """A (group, batch) ready to send, or (None, seconds until the next one is due)"""
+        wait_for = None
+        for group in self._groups.values():
+            if not group.waiting:
+                continue
+            due_in = group.oldest() + self.max_wait - now
+            if group.full() or due_in <= 0:
+                return group, group.take()
+            wait_for = due_in if wait_for is None else min(wait_for, due_in)
+        return None, wait_for
+
+    def _dispatch(self):
+        with self._condition:
+            while not self._closed:
+                wait_for = None
+                while self._in_flight < self.concurrency:
+                    group, batch = self._next_batch(time.monotonic())
+                    if group is None:
+                        wait_for = batch
+                        break
+                    self._in_flight += 1
+                    self._executor.submit(self._run_batch, group, batch)
+                # With every slot busy, wait for a batch to finish rather than for a deadline
+                self._condition.wait(wait_for if self._in_flight < self.concurrency else None)
+
+    def _run_batch(self, group, batch):
+        titles = list(dict.fromkeys(title for title, _ in batch))
+        options = dict(zip(OPTION_NAMES, group.flags))
+        prompt_version = engine.get_prompt_version(*group.flags, compact=self.compact)
+        failed = 0
+        try:
+            with metrics.span('service_batch'):
+                results, _, _ = classify_batch(titles, options, self.cache, prompt_version, group.packer,
+                                               near_duplicates=False, compact=self.compact)
+        except Exception as e:
+            logger.error("Batch of %d titles failed: %s", len(titles), e)
+            failed = len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            by_title = {result['title']: result for result in results}
+            for title, future in batch:
+                result = by_title.get(title)
+                if result is None:
+                    failed += 1
+                    future.set_exception(TitleNotClassified(f"Gemini returned no classification for {title!r}"))
+                else:
+                    # Callers sending the same title get their own copy
+                    future.set_result(dict(result))
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._pending -= len(batch)
+                self._counts['batches'] += 1
+                self._counts['batched_titles'] += len(batch)
+                self._counts['failed'] += failed
+                self._condition.notify_all()
+            metrics.increment('service_batches')
+            metrics.increment('service_batched_titles', len(batch))
+
+    def stats(self):
+        """Queue depth, batches in flight and request, title and batch counters"""
+        with self._condition:
+            counts = dict(self._counts)
+            counts.update(pending=self._pending, in_flight_batches=self._in_flight)
+        counts['avg_titles_per_batch'] = counts['batched_titles'] / counts['batches'] if counts['batches'] else 0.0
+        return counts
+
+    def close(self):
+        """Stop taking titles, fail the ones still waiting and let running batches finish"""
+        with self._condition:
+            self._closed = True
+            waiting = [future for group in self._groups.values() for _, future, _, _ in group.waiting]
+            for group in self._groups.values():
+                group.waiting = []
+                group.output_tokens = 0.0
+            self._pending -= len(waiting)
+            self._condition.notify_all()
+        for future in waiting:
+            future.set_exception(ServiceBusy("shutting down"))
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+
+class ClassificationServer(ThreadingHTTPServer):
+    """HTTP server handing requests to a shared ClassificationService"""
+
+    daemon_threads = True
+    # Many callers connect at once; the default backlog of 5 makes the rest wait out a SYN retry
+    request_queue_size = 128
+
+    def __init__(self, address, service):
+        super().__init__(address, ClassificationHandler)
+        self.service = service
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    server_version = "ResearchClassifier/1.0"
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        service = self.server.service
+        if path == '/health':
+            self._send_json(200, dict(service.stats(), status='ok'))
+        elif path == '/metrics':
+            stats = service.stats()
+            lines = [metrics.to_prometheus().rstrip('\n')]
+            for name in ('pending', 'in_flight_batches'):
+                metric = f"{metrics.prefix}_service_{name}"
+                lines += [f"# TYPE {metric} gauge", f"{metric} {stats[name]}"]
+            self._send(200, "\n".join(lines) + "\n", 'text/plain; version=0.0.4')
+        else:
+            self._send_json(404, {'error': f"Unknown path {path}"})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if path != '/classify':
+            self._send_json(404, {'error': f"Unknown path {path}"})
+            return
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(400, {'error': "Invalid Content-Length"})
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {'error': f"Request body over {MAX_BODY_BYTES} bytes"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'null')
+        except ValueError as e:
+            self._send_json(400, {'error': f"Request body is not valid JSON: {e}"})
+            return
+
+        single = isinstance(body, dict) and 'title' in body
+        titles = [body['title']] if single else body.get('titles') if isinstance(body, dict) else None
+        if not isinstance(titles, list) or not titles or not all(isinstance(title, str) for title in titles):
+            self._send_json(400, {'error': 'Send {"title": "..."} or {"titles": ["...", ...]}'})
+            return
+        titles = [title.strip() for title in titles]
+        if not all(titles):
+            self._send_json(400, {'error': "Titles must not be empty"})
+            return
+        if len(titles) > MAX_REQUEST_TITLES or any(len(title) > MAX_TITLE_CHARS for title in titles):
+            self._send_json(413, {'error': f"At most {MAX_REQUEST_TITLES} titles of up to {MAX_TITLE_CHARS} "
+                                           f"characters per request"})
+            return
+        flags = [body.get(name, default) for name, default in zip(OPTION_NAMES, DEFAULT_OPTIONS)]
+        invalid = [name for name, flag in zip(OPTION_NAMES, flags) if not isinstance(flag, bool)]
+        if invalid:
+            self._send_json(400, {'error': f"{', '.join(invalid)} must be true or false"})
+            return
+
+        try:
+            futures = service.submit(titles, *flags)
+        except ServiceBusy as e:
+            self._send_json(503, {'error': f"Service busy: {e}"}, headers={'Retry-After': '1'})
+            return
+        deadline = time.monotonic() + service.request_timeout
+        results = []
+        failed = []
+        for title, future in zip(titles, futures):
+            try:
+                results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+            except FutureTimeoutError:
+                self._send_json(504, {'error': f"No answer within {service.request_timeout:g}s"})
+                return
+            except Exception as e:
+                failed.append({'title': title, 'error': str(e)})
+
+        if not single:
+            self._send_json(200, {'results': results, 'failed': failed})
+        elif failed:
+            self._send_json(502, {'error': failed[0]['error']})
+        else:
+            self._send_json(200, {'result': results[0]})
+
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload), 'application/json', headers)
+
+    def _send(self, status, text, content_type, headers=None):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Serve title classification over HTTP, batching concurrent requests")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument('--api-key', default=os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY'),
+                        help="Gemini API key, or several comma-separated keys written as KEY, KEY@ENDPOINT "
+                             "or KEY*WEIGHT to shard requests across them (default: $GEMINI_API_KEY or "
+                             "$GOOGLE_API_KEY)")
+    parser.add_argument('--rpm', type=int, default=int(os.environ.get("CLASSIFIER_REQUESTS_PER_MINUTE", "15")),
+                        help="Requests per minute allowed for the key; 0 disables client-side pacing (default: 15)")
+    parser.add_argument('--tpm', type=int, default=int(os.environ.get("CLASSIFIER_TOKENS_PER_MINUTE", "1000000")),
+                        help="Tokens per minute allowed for the key (default: 1000000)")
+    parser.add_argument('--max-wait', type=float, default=0.05,
+                        help="Seconds a title may wait for others to share its request (default: 0.05)")
+    parser.add_argument('--max-pending', type=int, default=2000,
+                        help="Titles waiting or being classified before requests get 503 (default: 2000)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Batch requests in flight at once (default: 4)")
+    parser.add_argument('--token-budget', type=int, default=4000,
+                        help="Expected output tokens to pack into each request (default: 4000)")
+    parser.add_argument('--max-batch-size', type=int,
+                        help="Most titles per request (default: 50, or 150 with --compact)")
+    parser.add_argument('--compact', action='store_true',
+                        help="Ask for a lean response (no description) so far more titles fit in each request")
+    parser.add_argument('--request-timeout', type=float, default=120.0,
+                        help="Seconds a caller waits for its results before getting 504 (default: 120)")
+    parser.add_argument('--cache-path', default=os.environ.get("CLASSIFIER_CACHE_PATH", "classification_cache.sqlite3"),
+                        help="Classification cache shared with the web app")
+    parser.add_argument('--no-cache', action='store_true', help="Always call Gemini, bypassing the cache")
+    parser.add_argument('--fake', action='store_true',
+                        help="Answer from the simulated backend in fake_gemini.py instead of Gemini, for load tests "
+                             "(implies --no-cache)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only log warnings and errors")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    if args.fake:
+        from fake_gemini import FakeGeminiBackend
+
+        engine.set_model_factory(FakeGeminiBackend(latency=0.2, per_title_latency=0.002))
+    elif not args.api_key:
+        build_parser().error(f"a Gemini API key is required (--api-key or $GEMINI_API_KEY); get one from {engine.API_KEY_HELP_URL}")
+    else:
+        engine.configure(args.api_key, args.rpm, args.tpm)
+        TaxonomyRegistry(args.cache_path).register(engine.TAXONOMY)
+
+    service = ClassificationService(
+        # Simulated answers must not end up in the cache the app and CLI read
+        cache=None if args.no_cache or args.fake else ClassificationCache(args.cache_path),
+        max_wait=args.max_wait, max_pending=args.max_pending, concurrency=args.concurrency,
+        output_token_budget=args.token_budget, max_batch_size=args.max_batch_size, compact=args.compact,
+        request_timeout=args.request_timeout,
+    )
+    server = ClassificationServer((args.host, args.port), service)
+    logger.info("Listening on http://%s:%d (POST /classify, GET /health, GET /metrics)", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        stats = service.stats()
+        logger.info("Served %d requests for %d titles in %d batches (%.1f titles per batch), %d rejected",
+                    stats['requests'], stats['titles'], stats['batches'], stats['avg_titles_per_batch'],
+                    stats['rejected'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import json
+import re
+
+
+class JsonArrayStreamParser:
+    """Incrementally pull complete objects out of a JSON array as text arrives
+
+    Text is fed in arbitrary pieces; every call to feed() returns the
+    top-level array elements whose closing brace has arrived since the
+    previous call. Anything around the array (markdown fences, prose,
+    commas, comments) is ignored, and an element that fails to decode is
+    skipped and counted rather than aborting the stream. Because complete
+    elements are returned as soon as they close, a truncated response
+    still yields everything before the cut.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.closed = False
+        self.malformed = 0
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        """Consume a piece of text and return the elements it completed"""
+        elements = []
+        for char in text:
+            if self.closed:
+                break
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                continue
+
+            if self._depth == 0:
+                # Between elements: wait for the next object or the end of the array
+                if char == '{':
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == ']':
+                    self.closed = True
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    element = self._decode(''.join(self._buffer))
+                    self._buffer = []
+                    if element is not None:
+                        elements.append(element)
+        return elements
+
+    def _decode(self, element_text):
+        # Same trailing-comma cleanup as parse_json_response
+        element_text = re.sub(r',\s*}', '}', element_text)
+        element_text = re.sub(r',\s*]', ']', element_text)
+        try:
+            return json.loads(element_text)
+        except json.JSONDecodeError:
+            self.malformed += 1
+            return None
+
+
+def salvage_json_array(response_text):
+    """Return the complete objects of a JSON array response, even if it was cut off"""
+    return JsonArrayStreamParser().feed(response_text or '')
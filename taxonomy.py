@@ -0,0 +1,224 @@
+"""The strategy taxonomy: the strategies offered to Gemini, versioned
+
+Every strategy has a fingerprint of its number, name and description as
+they appear in the prompts, and the taxonomy's version is a hash of all
+of them. Results are tagged with the version they were produced under,
+and the TaxonomyRegistry keeps each version's strategies so a later edit
+can be compared entry by entry: only results touching a changed strategy
+need classifying again (see reclassify.py).
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+Strategy = namedtuple('Strategy', ['name', 'description'])
+
+_STRATEGY_LABEL = re.compile(r'^\s*(?:(\d+)\s*[\.\-:)]?)?\s*(.*?)\s*$', re.S)
+
+
+def _digest(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+class Taxonomy:
+    """An ordered set of strategies with per-strategy fingerprints and a version
+
+    Behaves as a sequence of Strategy(name, description) tuples. A
+    strategy's fingerprint covers its number too, since the prompts and
+    compact responses refer to strategies by number.
+    """
+
+    def __init__(self, strategies):
+        self.strategies = tuple(Strategy(*strategy) for strategy in strategies)
+        # The numbered strategy list exactly as it appears in the prompts
+        self.lines = tuple(
+            f"{number}. {name} - {description}" for number, (name, description) in enumerate(self.strategies, 1)
+        )
+        self.list_text = "\n".join(self.lines)
+        self.fingerprints = tuple(_digest(line) for line in self.lines)
+        self.version = _digest(*self.fingerprints)
+        self._names = {name.lower(): index for index, (name, _) in enumerate(self.strategies)}
+
+    def __len__(self):
+        return len(self.strategies)
+
+    def __iter__(self):
+        return iter(self.strategies)
+
+    def __getitem__(self, index):
+        return self.strategies[index]
+
+    def index(self, label):
+        """0-based index of the strategy a stored label names ("3. Name" or "Name"), or None"""
+        if not isinstance(label, str):
+            return None
+        number, name = _STRATEGY_LABEL.match(label).groups()
+        index = self._names.get(name.lower())
+        if index is not None:
+            return index
+        if number and not name and 1 <= int(number) <= len(self):
+            return int(number) - 1
+        return None
+
+    def changed_since(self, older):
+        """Positions (0-based) whose strategy was added, removed or edited since `older`"""
+        return {
+            index for index in range(max(len(self), len(older)))
+            if index >= len(self) or index >= len(older) or self.fingerprints[index] != older.fingerprints[index]
+        }
+
+    def to_json(self):
+        return json.dumps([list(strategy) for strategy in self.strategies])
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text))
+
+
+class TaxonomyRegistry:
+    """Every taxonomy version results were produced under, in a SQLite file
+
+    It shares the classification cache's file by default. Register the
+    current taxonomy wherever results are produced so they can be compared
+    against it after the strategies are edited.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS taxonomies (
+                version TEXT PRIMARY KEY,
+                strategies TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._loaded = {}
+
+    def register(self, taxonomy):
+        """Record a taxonomy version; registering it again is a no-op"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO taxonomies (version, strategies, created_at) VALUES (?, ?, ?)",
+                (taxonomy.version, taxonomy.to_json(), time.time()),
+            )
+            self._conn.commit()
+            self._loaded[taxonomy.version] = taxonomy
+
+    def get(self, version):
+        """The taxonomy registered under `version`, or None"""
+        with self._lock:
+            if version not in self._loaded:
+                row = self._conn.execute(
+                    "SELECT strategies FROM taxonomies WHERE version = ?", (version,)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._loaded[version] = Taxonomy.from_json(row[0])
+            return self._loaded[version]
+
+    def versions(self):
+        """(version, created_at) of every registered taxonomy, oldest first"""
+        with self._lock:
+            return self._conn.execute("SELECT version, created_at FROM taxonomies ORDER BY created_at").fetchall()
+
+
+# The 13 primary strategies offered to Gemini, in prompt order
+TAXONOMY = Taxonomy([
+    (
+        "Advancing Data Science and Computing for Biology",
+        "Develop AI/ML methods and improve data management systems to predict biological functions and enable "
+        "multimodal data analysis across scales, while ensuring ethical AI standards and data security.",
+    ),
+    (
+        "Growing Next-Generation Omics and Gene-Editing Tools",
+        "Develop and apply advanced molecular profiling technologies including next-generation sequencing "
+        "platforms, high-throughput metabolomics pipelines, and precision gene-editing systems. Focus on "
+        "creating new analytical methods, laboratory techniques, computational frameworks, and bioinformatics "
+        "workflows for processing multi-omics data to characterize biological systems at unprecedented "
+        "resolution and scale. This category emphasizes technology development and methodological advancement "
+        "rather than applying existing genomic techniques to study specific organisms, ecosystems, or "
+        "ecological questions. It includes creating new tools, workflows, and analytical capabilities, not "
+        "genome sequencing projects, taxonomic studies, or microbial characterization using standard methods.",
+    ),
+    (
+        "Developing Hardware to Support and Understand Biology",
+        "Create advanced bioreactors, growth chambers, sensors, and imaging systems to measure biological "
+        "phenomena at relevant scales, including quantum sensing and transportable field systems.",
+    ),
+    (
+        "Accelerating Experimentation by Integrating Technologies",
+        "Build integrated, automated laboratory systems moving toward self-driving labs that seamlessly "
+        "combine data collection, robotics, and AI to accelerate biological discovery.",
+    ),
+    (
+        "Developing New, Sustainable, Effective Bioproducts",
+        "Identify and engineer biological pathways to create renewable alternatives to petroleum-based "
+        "materials, including polymers, chemicals, fuels, and coatings with improved properties.",
+    ),
+    (
+        "Enabling Optimized Bioconversion of Diverse Feedstocks",
+        "Design and engineer microbial systems, enzyme pathways, and bioprocessing technologies to convert "
+        "renewable and waste materials into target products. Emphasize optimization of conversion efficiency, "
+        "pathway engineering, and bioprocess scale-up for transforming lignocellulosic biomass, organic waste "
+        "streams, and non-food feedstocks into fuels, chemicals, and materials.",
+    ),
+    (
+        "Discovering Fundamentals in Photosynthesis and Beyond",
+        "Understand and improve natural photosynthetic processes and develop artificial photosynthesis "
+        "systems to directly convert sunlight into fuels and chemicals.",
+    ),
+    (
+        "Uncovering Molecular Foundations for Predictive Ecology",
+        "Investigate fundamental molecular mechanisms that drive ecological processes and community dynamics "
+        "in natural environments using molecular techniques to understand biological interactions. Focus on "
+        "applying genomic, transcriptomic, and other molecular approaches to study species interactions, "
+        "ecosystem function, environmental responses, and ecological relationships through controlled "
+        "experimentation and molecular characterization of ecological phenomena. This category includes "
+        "genome sequencing of environmental organisms, microbial ecology studies, taxonomic characterization, "
+        "strain isolation, and molecular analysis of ecological communities rather than developing new "
+        "analytical technologies or computational methods.",
+    ),
+    (
+        "Building Models to Bridge the Gap Between Lab and Natural Systems",
+        "Construct mathematical, computational, and theoretical frameworks that translate mechanistic "
+        "understanding from controlled laboratory conditions to complex natural environments. Develop "
+        "multi-scale modeling approaches, parameter estimation methods, and validation strategies that "
+        "account for environmental variability and system complexity.",
+    ),
+    (
+        "Accelerating Environmental Solutions with Biology",
+        "Apply biological approaches to address environmental challenges like carbon sequestration, ecosystem "
+        "resilience, and nutrient cycling from bench to field scale.",
+    ),
+    (
+        "Understanding Biological Processes Vital to Health",
+        "Study fundamental human biology to establish health baselines, identify disease biomarkers, and "
+        "understand genetic variations that affect disease susceptibility and treatment response.",
+    ),
+    (
+        "Addressing Environmental Impacts on People",
+        "Investigate how environmental factors like air pollution, radiation, heat, and chemical exposures "
+        "affect human health and the human microbiome.",
+    ),
+    (
+        "Developing Diagnostics, Treatments, and Mitigations for Biopreparedness",
+        "Engineer biosensing platforms, therapeutic delivery systems, and countermeasure technologies for "
+        "detecting and responding to biological threats. Could also be to secure a more stable supply chain "
+        "for crucial biological products like crops and drugs. Focus on developing portable diagnostic "
+        "devices, novel antimicrobial strategies, and preventive biotechnologies that can be rapidly deployed "
+        "for public health protection and biosecurity applications. ",
+    ),
+])